@@ -0,0 +1,286 @@
+"""Index of the download cache with size bounded eviction, also usable as a command line tool for stats and gc."""
+import os
+import re
+import time
+import sqlite3
+import argparse
+import threading
+
+import download_locks
+
+CACHE_INDEX_FILENAME = "cache_index.sqlite"
+
+EVICTION_POLICIES = ["lru", "lfu"]
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(size_string):
+    # e.g. 500G, 1.5T or a plain number of bytes
+    match = re.match(r"^\s*([\d.]+)\s*([KMGT]?)B?\s*$", str(size_string).upper())
+    if match is None:
+        raise ValueError("Invalid size {}".format(size_string))
+
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def format_size(size):
+    for unit in ["", "K", "M", "G", "T"]:
+        if size < 1024 or unit == "T":
+            return "{:.1f}{}".format(size, unit) if unit else "{}".format(size)
+        size /= 1024
+
+
+class CacheIndex:
+    """
+    Keeps track of the size, access and origin of every file in the cache, and of the links pointing at them from
+    the output folders so eviction never removes a file that something still links to
+    """
+
+    def __init__(self, cache_directory):
+        self.cache_directory = os.path.realpath(cache_directory)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(self.cache_directory, CACHE_INDEX_FILENAME), timeout=60, check_same_thread=False)
+
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    cache_filename TEXT PRIMARY KEY,
+                    mri TEXT,
+                    file_size INTEGER,
+                    checksum TEXT,
+                    created REAL,
+                    last_access REAL,
+                    access_count INTEGER
+                )
+            """)
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS links (
+                    cache_filename TEXT,
+                    link_path TEXT,
+                    PRIMARY KEY (cache_filename, link_path)
+                )
+            """)
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def record_entry(self, cache_filename, mri, checksum=None):
+        now = time.time()
+        file_size = os.path.getsize(cache_filename)
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries (cache_filename, mri, file_size, checksum, created, last_access, access_count) VALUES (?, ?, ?, ?, ?, ?, 1)",
+                (cache_filename, mri, file_size, checksum, now, now))
+            self._connection.commit()
+
+    def record_access(self, cache_filename, mri=None):
+        with self._lock:
+            updated = self._connection.execute(
+                "UPDATE entries SET last_access = ?, access_count = access_count + 1 WHERE cache_filename = ?",
+                (time.time(), cache_filename)).rowcount
+            self._connection.commit()
+
+        # Files that were cached before the index existed
+        if updated == 0 and os.path.isfile(cache_filename):
+            self.record_entry(cache_filename, mri)
+
+    def record_link(self, cache_filename, link_path):
+        with self._lock:
+            self._connection.execute("INSERT OR IGNORE INTO links (cache_filename, link_path) VALUES (?, ?)", (cache_filename, os.path.abspath(link_path)))
+            self._connection.commit()
+
+    def get_entry(self, cache_filename):
+        with self._lock:
+            row = self._connection.execute("SELECT mri, file_size, checksum FROM entries WHERE cache_filename = ?", (cache_filename,)).fetchone()
+
+        if row is None:
+            return None
+
+        return {"mri": row[0], "file_size": row[1], "checksum": row[2]}
+
+    def _is_pinned(self, cache_filename):
+        # Anything still linked from an output folder has to stay
+        with self._lock:
+            link_paths = [row[0] for row in self._connection.execute("SELECT link_path FROM links WHERE cache_filename = ?", (cache_filename,))]
+
+        pinned = False
+        stale_link_paths = []
+        for link_path in link_paths:
+            if os.path.islink(link_path) and os.path.realpath(link_path) == cache_filename:
+                pinned = True
+            else:
+                stale_link_paths.append(link_path)
+
+        with self._lock:
+            self._connection.executemany("DELETE FROM links WHERE cache_filename = ? AND link_path = ?", [(cache_filename, link_path) for link_path in stale_link_paths])
+            self._connection.commit()
+
+        return pinned
+
+    def remove_entry(self, cache_filename):
+        with self._lock:
+            self._connection.execute("DELETE FROM entries WHERE cache_filename = ?", (cache_filename,))
+            self._connection.execute("DELETE FROM links WHERE cache_filename = ?", (cache_filename,))
+            self._connection.commit()
+
+    def sync(self):
+        """
+        Brings the index in line with what is on disk, adding files it does not know about and dropping removed ones
+        """
+        indexed_filenames = set()
+        with self._lock:
+            for (cache_filename,) in self._connection.execute("SELECT cache_filename FROM entries").fetchall():
+                indexed_filenames.add(cache_filename)
+
+        on_disk_filenames = set()
+        for hash_folder in os.scandir(self.cache_directory):
+            # The cache is laid out in two character hash folders
+            if not hash_folder.is_dir() or len(hash_folder.name) != 2:
+                continue
+
+            for cache_file in os.scandir(hash_folder.path):
+                if cache_file.name.startswith(".") or not cache_file.is_file():
+                    continue
+
+                on_disk_filenames.add(cache_file.path)
+
+                if cache_file.path not in indexed_filenames:
+                    file_stat = cache_file.stat()
+                    with self._lock:
+                        self._connection.execute(
+                            "INSERT OR IGNORE INTO entries (cache_filename, mri, file_size, checksum, created, last_access, access_count) VALUES (?, NULL, ?, NULL, ?, ?, 0)",
+                            (cache_file.path, file_stat.st_size, file_stat.st_mtime, max(file_stat.st_atime, file_stat.st_mtime)))
+
+        with self._lock:
+            self._connection.commit()
+
+        for cache_filename in indexed_filenames - on_disk_filenames:
+            self.remove_entry(cache_filename)
+
+    def stats(self):
+        with self._lock:
+            entry_count, total_size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM entries").fetchone()
+            oldest_access = self._connection.execute("SELECT MIN(last_access) FROM entries").fetchone()[0]
+            link_count = self._connection.execute("SELECT COUNT(*) FROM links").fetchone()[0]
+
+        return {"entries": entry_count, "total_size": total_size, "oldest_access": oldest_access, "links": link_count}
+
+    def gc(self, max_bytes, policy="lru", dry_run=False):
+        """
+        Evicts entries until the cache fits in max_bytes, least recently (lru) or least frequently (lfu) used first
+
+        Entries being downloaded or linked right now are skipped, as are files that were only found on disk by sync
+        since links made to them before the index existed are not known
+
+        Returns the list of evicted cache filenames
+        """
+        if policy == "lfu":
+            order_by = "access_count ASC, last_access ASC"
+        else:
+            order_by = "last_access ASC"
+
+        with self._lock:
+            total_size = self._connection.execute("SELECT COALESCE(SUM(file_size), 0) FROM entries").fetchone()[0]
+            candidates = self._connection.execute("SELECT cache_filename, file_size, access_count FROM entries ORDER BY " + order_by).fetchall()
+
+        evicted_filenames = []
+        for cache_filename, file_size, access_count in candidates:
+            if total_size <= max_bytes:
+                break
+
+            if access_count == 0:
+                continue
+
+            if dry_run:
+                if not self._is_pinned(cache_filename):
+                    print("Would evict", cache_filename, format_size(file_size))
+                    evicted_filenames.append(cache_filename)
+                    total_size -= file_size
+                continue
+
+            with download_locks.cache_entry_lock(cache_filename, blocking=False) as acquired:
+                if not acquired:
+                    print("Skipping", cache_filename, "which is in use")
+                    continue
+
+                if self._is_pinned(cache_filename):
+                    continue
+
+                print("Evicting", cache_filename, format_size(file_size))
+                for filename in [cache_filename, download_locks.cache_entry_lock_filename(cache_filename)]:
+                    try:
+                        os.remove(filename)
+                    except FileNotFoundError:
+                        pass
+                self.remove_entry(cache_filename)
+
+            evicted_filenames.append(cache_filename)
+            total_size -= file_size
+
+        return evicted_filenames
+
+
+_cache_indexes = {}
+_cache_indexes_lock = threading.Lock()
+
+
+def get_cache_index(cache_directory):
+    # One index per cache directory shared by all the download threads
+    cache_directory = os.path.realpath(cache_directory)
+
+    with _cache_indexes_lock:
+        if cache_directory not in _cache_indexes:
+            _cache_indexes[cache_directory] = CacheIndex(cache_directory)
+
+        return _cache_indexes[cache_directory]
+
+
+def close_cache_indexes():
+    with _cache_indexes_lock:
+        for cache_index in _cache_indexes.values():
+            cache_index.close()
+        _cache_indexes.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Managing the download cache')
+    parser.add_argument('command', choices=['stats', 'gc'])
+    parser.add_argument('cache_directory', help='cache folder used with --cache_directory')
+    parser.add_argument('--max_size', default=None, help='Size the cache should be brought down to by gc, e.g. 500G')
+    parser.add_argument('--policy', default='lru', choices=EVICTION_POLICIES, help='Eviction policy for gc')
+    parser.add_argument('--dryrun', action='store_true', default=False, help="Report what gc would evict without removing anything")
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.cache_directory):
+        print("Cache directory does not exist")
+        exit(1)
+
+    cache_index = CacheIndex(args.cache_directory)
+    cache_index.sync()
+
+    if args.command == "gc":
+        if args.max_size is None:
+            print("--max_size is required for gc")
+            exit(1)
+
+        evicted_filenames = cache_index.gc(parse_size(args.max_size), policy=args.policy, dry_run=args.dryrun)
+        print("Evicted", len(evicted_filenames), "files")
+
+    cache_stats = cache_index.stats()
+    print("Entries", cache_stats["entries"])
+    print("Total size", format_size(cache_stats["total_size"]))
+    print("Links", cache_stats["links"])
+    if cache_stats["oldest_access"] is not None:
+        print("Oldest access", time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(cache_stats["oldest_access"])))
+
+    cache_index.close()
+
+if __name__ == "__main__":
+    main()
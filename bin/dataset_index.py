@@ -0,0 +1,173 @@
+"""In memory index of an existing dataset directory, so checking for files does not cost a stat call per USI."""
+import os
+import gzip
+import argparse
+import threading
+
+import download_locks
+
+_dataset_index_config = {
+    "manifest": None,
+}
+
+
+def configure_dataset_index(manifest=None):
+    _dataset_index_config["manifest"] = manifest
+
+
+def _open_manifest(manifest_filename, mode):
+    if manifest_filename.endswith(".gz"):
+        return gzip.open(manifest_filename, mode + "t")
+
+    return open(manifest_filename, mode)
+
+
+def _scan_folder(root_directory, folder):
+    """
+    Lists every file under folder relative to root_directory, vendor .d folders are listed as a whole
+    """
+    relative_paths = []
+
+    pending_folders = [folder]
+    while len(pending_folders) > 0:
+        current_folder = pending_folders.pop()
+
+        try:
+            folder_entries = list(os.scandir(os.path.join(root_directory, current_folder)))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+
+        for folder_entry in folder_entries:
+            relative_path = os.path.join(current_folder, folder_entry.name)
+
+            if folder_entry.is_dir():
+                # Bruker .d folders are one data file, no need to look inside of them
+                if folder_entry.name.lower().endswith(".d"):
+                    relative_paths.append(relative_path)
+                else:
+                    pending_folders.append(relative_path)
+            else:
+                relative_paths.append(relative_path)
+
+    return relative_paths
+
+
+class DatasetIndex:
+    """
+    Set of collection/dataset/relative path entries in the dataset directory
+
+    With a manifest everything is loaded up front, otherwise each dataset folder is scanned the first time it is asked about
+    """
+
+    def __init__(self, root_directory, manifest_filename=None):
+        self.root_directory = root_directory
+
+        self._lock = threading.Lock()
+        self._entries = set()
+        self._scanned_datasets = set()
+        self._from_manifest = manifest_filename is not None
+
+        if manifest_filename is not None:
+            with _open_manifest(manifest_filename, "r") as f:
+                for line in f:
+                    relative_path = line.strip()
+                    if len(relative_path) > 0:
+                        self._entries.add(os.path.normpath(relative_path))
+
+            print("Loaded", len(self._entries), "entries from dataset manifest", manifest_filename)
+
+    def _ensure_scanned(self, collection_name, dataset_id):
+        dataset_key = (collection_name, dataset_id)
+
+        with self._lock:
+            if self._from_manifest or dataset_key in self._scanned_datasets:
+                return
+
+        # Only one thread scans a dataset, the others wait for it instead of scanning again
+        with download_locks.key_lock(("dataset_index", self.root_directory) + dataset_key):
+            with self._lock:
+                if dataset_key in self._scanned_datasets:
+                    return
+
+            relative_paths = _scan_folder(self.root_directory, os.path.join(collection_name, dataset_id))
+
+            with self._lock:
+                self._entries.update(relative_paths)
+                self._scanned_datasets.add(dataset_key)
+
+    def lookup(self, collection_name, path_in_dataset_folder, filename):
+        """
+        Returns the full path of the file in the dataset directory, or None if it is not there
+
+        Only a hit is checked on disk, so a stale manifest or a file removed since the scan is never linked to
+        """
+        dataset_id = os.path.normpath(path_in_dataset_folder).split(os.sep)[0]
+        self._ensure_scanned(collection_name, dataset_id)
+
+        relative_path = os.path.normpath(os.path.join(collection_name, path_in_dataset_folder, filename))
+
+        with self._lock:
+            if relative_path not in self._entries:
+                return None
+
+        full_path = os.path.join(self.root_directory, relative_path)
+        if not os.path.exists(full_path):
+            with self._lock:
+                self._entries.discard(relative_path)
+            return None
+
+        return full_path
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+_dataset_indexes = {}
+_dataset_indexes_lock = threading.Lock()
+
+
+def get_dataset_index(root_directory):
+    # One index per dataset directory shared by all the download threads
+    with _dataset_indexes_lock:
+        if root_directory not in _dataset_indexes:
+            _dataset_indexes[root_directory] = DatasetIndex(root_directory, manifest_filename=_dataset_index_config["manifest"])
+
+        return _dataset_indexes[root_directory]
+
+
+def clear_dataset_indexes():
+    with _dataset_indexes_lock:
+        _dataset_indexes.clear()
+
+
+def build_manifest(root_directory, manifest_filename):
+    """
+    Scans the whole dataset directory once and writes every file to the manifest, one relative path per line
+    """
+    entry_count = 0
+    with _open_manifest(manifest_filename, "w") as f:
+        for relative_path in _scan_folder(root_directory, ""):
+            f.write(relative_path + "\n")
+            entry_count += 1
+
+    return entry_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Building a manifest of an existing dataset directory')
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('existing_dataset_directory', help='dataset directory used with --existing_dataset_directory')
+    parser.add_argument('manifest', help='Output manifest, gzipped if it ends in .gz')
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.existing_dataset_directory):
+        print("Dataset directory does not exist")
+        exit(1)
+
+    entry_count = build_manifest(args.existing_dataset_directory, args.manifest)
+    print("Wrote", entry_count, "entries to", args.manifest)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Global bandwidth budget and free disk space admission, shared by all the downloads in the process."""
+import os
+import threading
+
+from host_control import TokenBucket
+
+# Bytes per second across all the downloads, 0 means no limit
+DEFAULT_BANDWIDTH_LIMIT = 0
+
+# Bytes to always leave free on the filesystems we download to
+DEFAULT_MIN_FREE_SPACE = 0
+
+# While a download waits for space, free space is checked again this often in case something else freed it
+SPACE_RECHECK_INTERVAL = 5
+
+_admission_config = {
+    "min_free_space": DEFAULT_MIN_FREE_SPACE,
+}
+
+_bandwidth_bucket = None
+
+# Bytes still to be written by the downloads in flight, per filesystem
+_reserved_bytes = {}
+_space_condition = threading.Condition()
+
+
+class DiskSpaceError(OSError):
+    """
+    Raised when a download does not fit on its filesystem even once the downloads in flight are done
+    """
+
+
+def configure_admission(bandwidth_limit=None, min_free_space=None):
+    global _bandwidth_bucket
+
+    if bandwidth_limit is not None:
+        # A second worth of bytes can go at once, so bursts after a pause are not throttled
+        _bandwidth_bucket = TokenBucket(bandwidth_limit) if bandwidth_limit > 0 else None
+
+    if min_free_space is not None:
+        _admission_config["min_free_space"] = min_free_space
+
+
+def throttle(byte_count):
+    """
+    Called with every chunk received, blocks as long as the downloads together are over the bandwidth limit
+    """
+    if _bandwidth_bucket is not None:
+        _bandwidth_bucket.take(byte_count)
+
+
+class DiskReservation:
+    """
+    Space set aside for a download, it shrinks as the bytes are written since they then show up in the free space
+    """
+
+    def __init__(self, device, size):
+        self.device = device
+        self.remaining = size
+
+    def consume(self, byte_count):
+        with _space_condition:
+            byte_count = min(byte_count, self.remaining)
+            self.remaining -= byte_count
+            _reserved_bytes[self.device] -= byte_count
+
+    def release(self):
+        with _space_condition:
+            _reserved_bytes[self.device] -= self.remaining
+            self.remaining = 0
+            _space_condition.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def _existing_folder(filename):
+    folder = os.path.dirname(os.path.abspath(filename))
+    while not os.path.isdir(folder):
+        folder = os.path.dirname(folder)
+
+    return folder
+
+
+def _available_space(folder, device):
+    stat = os.statvfs(folder)
+    return stat.f_bavail * stat.f_frsize - _reserved_bytes.get(device, 0) - _admission_config["min_free_space"]
+
+
+def try_reserve(filename, size):
+    """
+    Reserves size bytes on the filesystem of filename, returns None if they do not fit next to the downloads in flight
+    """
+    folder = _existing_folder(filename)
+    device = os.stat(folder).st_dev
+
+    with _space_condition:
+        if size > 0 and _available_space(folder, device) < size:
+            return None
+
+        _reserved_bytes[device] = _reserved_bytes.get(device, 0) + size
+        return DiskReservation(device, size)
+
+
+def reserve(filename, size):
+    """
+    Reserves size bytes on the filesystem of filename, deferring the download until the downloads in flight have
+    finished if they do not fit yet. Raises DiskSpaceError when they do not fit with nothing else in flight
+    """
+    folder = _existing_folder(filename)
+    device = os.stat(folder).st_dev
+
+    with _space_condition:
+        deferred = False
+        while size > 0 and _available_space(folder, device) < size:
+            if _reserved_bytes.get(device, 0) <= 0:
+                raise DiskSpaceError("Not enough free space in {} for {} bytes".format(folder, size))
+
+            if not deferred:
+                print("Deferring", filename, "until there is space for", size, "bytes")
+                deferred = True
+
+            _space_condition.wait(SPACE_RECHECK_INTERVAL)
+
+        _reserved_bytes[device] = _reserved_bytes.get(device, 0) + size
+        return DiskReservation(device, size)
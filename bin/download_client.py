@@ -0,0 +1,168 @@
+"""Importable client for downloading USIs from a long running process instead of running the script once per batch."""
+import os
+import asyncio
+from dataclasses import dataclass, fields
+
+# Re-exported so a client only needs this module
+from download_options import DownloadConfig
+
+@dataclass
+class DownloadResult:
+    """
+    One row of the summary
+    """
+    usi: str
+    target_path: str = None
+    status: str = None
+    cache_filename: str = None
+    checksum: str = None
+    host: str = None
+    resolve_seconds: float = None
+    queue_seconds: float = None
+    transfer_seconds: float = None
+    conversion_wait_seconds: float = None
+    finalize_seconds: float = None
+    total_seconds: float = None
+    downloaded_bytes: int = None
+    throughput_mb_per_second: float = None
+
+    @property
+    def ok(self):
+        return self.status is not None and "ERROR" not in self.status
+
+    @classmethod
+    def from_dict(cls, result):
+        return cls(**{field.name: result.get(field.name) for field in fields(cls)})
+
+
+class DownloadClient:
+    """
+    Downloads USIs with the same code path as the command line, keeping the HTTP connections, resolved links, cache
+    index and job ledger between calls
+
+    The settings are process wide, so there should be one client per process
+    """
+
+    def __init__(self, config):
+        # The download modules pull in requests and friends, so they are only imported once a client is created
+        import download_workflow
+
+        self._workflow = download_workflow
+        self.config = config.with_defaults()
+
+        self._workflow.configure(self.config)
+        if self.config.output_folder is not None:
+            os.makedirs(self.config.output_folder, exist_ok=True)
+
+        self._extension_filter = self.config.extension_filter_tuple()
+
+        self.ledger = None
+        if self.config.job_database is not None:
+            import job_ledger
+            self.ledger = job_ledger.JobLedger(self.config.job_database)
+
+        self._closed = False
+
+    def iter_download(self, usis):
+        """
+        Yields a DownloadResult per USI as they complete, in input order except for USIs parked on an unavailable host
+        """
+        import usi_input
+
+        usis = usi_input.unique_usis(usis)
+
+        if self.config.largest_first:
+            usis = self._workflow.build_plan(usis, self.config, self._extension_filter).usis(largest_first=True)
+
+        usis = self._workflow.iter_prepared(usis, self.config)
+        for result in self._workflow.iter_downloads(usis, self.config, self._extension_filter, ledger=self.ledger):
+            yield DownloadResult.from_dict(result)
+
+    def download(self, usis):
+        return list(self.iter_download(usis))
+
+    def download_usi(self, usi):
+        results = self.download([usi])
+        return results[0] if len(results) > 0 else None
+
+    def download_dataset(self, dataset, filepath_prefix=""):
+        """
+        Downloads every file of a dataset, listed from the datasetcache
+        """
+        import download_raw
+        import vendor_conversion
+
+        return self.download(download_raw.iter_dataset_usis(dataset, filepath_prefix, cache_url=vendor_conversion.DATASET_CACHE_URL_BASE))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        import vendor_conversion
+        import download_resolver
+        import cache_manager
+
+        vendor_conversion.stop_pipeline()
+        download_resolver.save_resolution_cache()
+
+        if self.ledger is not None:
+            self.ledger.close()
+
+        if self.config.cache_max_size is not None and self.config.cache_directory is not None and os.path.isdir(self.config.cache_directory) and not self.config.dryrun:
+            cache_index = cache_manager.get_cache_index(self.config.cache_directory)
+            cache_index.sync()
+            cache_index.gc(cache_manager.parse_size(self.config.cache_max_size), policy=self.config.cache_eviction_policy)
+
+        cache_manager.close_cache_indexes()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+_DONE = object()
+
+
+class AsyncDownloadClient:
+    """
+    The DownloadClient for asyncio code, the downloads run in a worker thread so the event loop is never blocked
+    """
+
+    def __init__(self, config):
+        self._client = DownloadClient(config)
+        self.config = self._client.config
+
+    async def download(self, usis):
+        return await asyncio.get_running_loop().run_in_executor(None, self._client.download, list(usis))
+
+    async def download_usi(self, usi):
+        return await asyncio.get_running_loop().run_in_executor(None, self._client.download_usi, usi)
+
+    async def download_dataset(self, dataset, filepath_prefix=""):
+        return await asyncio.get_running_loop().run_in_executor(None, self._client.download_dataset, dataset, filepath_prefix)
+
+    async def iter_download(self, usis):
+        """
+        Yields each DownloadResult as soon as it completes
+        """
+        loop = asyncio.get_running_loop()
+        results = self._client.iter_download(list(usis))
+
+        while True:
+            result = await loop.run_in_executor(None, next, results, _DONE)
+            if result is _DONE:
+                break
+
+            yield result
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(None, self._client.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
@@ -0,0 +1,287 @@
+"""Long running download service on a Unix socket, so concurrent workflow tasks share one set of connections, caches and limits."""
+import os
+import sys
+import json
+import stat
+import time
+import signal
+import socket
+import argparse
+import threading
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+
+import download_client
+
+# Options a job can set for its own downloads, everything else is the configuration of the daemon
+JOB_OPTIONS = ["nestfiles", "extension_filter", "noconversion", "dryrun"]
+
+
+class DaemonError(Exception):
+    pass
+
+
+class DownloadDaemon:
+    """
+    Runs the downloads of every job under one set of --parallel and --host_parallel slots, so the limits hold across
+    all the jobs
+
+    A USI that another job is already downloading with the same options is not downloaded twice, it goes into the
+    output folder of the job that started it. The others then take it from the cache like any cache hit, without a
+    cache the downloaded file is linked into their output folders
+    """
+
+    def __init__(self, config):
+        import download_locks
+
+        self.client = download_client.DownloadClient(config)
+        self.config = self.client.config
+
+        self._workflow = self.client._workflow
+        self._download_slots = download_locks.DownloadSlots(self.config.parallel, self._workflow.parse_host_limits(self.config.host_parallel, self.config.parallel))
+
+        # Every queued USI has a thread, the slots decide which of them are downloading
+        self._executor = ThreadPoolExecutor(max_workers=self.config.parallel * self._workflow.QUEUED_PER_WORKER, thread_name_prefix="daemon")
+
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+    def _job_config(self, job):
+        if not isinstance(job, dict) or "usis" not in job or "output_folder" not in job:
+            raise DaemonError("A job needs usis and an output_folder")
+
+        options = {key: job[key] for key in JOB_OPTIONS if job.get(key) is not None}
+        return replace(self.config, output_folder=os.path.abspath(job["output_folder"]), **options)
+
+    def _download(self, usi, job_config, extension_filter, submit_time):
+        with self._download_slots.hold(self._workflow.download_host(usi)):
+            print("Downloading", usi)
+            return self._workflow.download_usi(usi, job_config, extension_filter, ledger=self.client.ledger, queue_seconds=time.monotonic() - submit_time)
+
+    def _submit(self, usi, job_config, extension_filter):
+        """
+        Returns the future of the download and the output folder it goes into, which is the one of the job that
+        started it
+        """
+        key = (usi, job_config.nestfiles, extension_filter, job_config.noconversion, job_config.dryrun)
+
+        with self._in_flight_lock:
+            in_flight = self._in_flight.get(key)
+            if in_flight is not None:
+                return in_flight
+
+            future = self._executor.submit(self._download, usi, job_config, extension_filter, time.monotonic())
+            self._in_flight[key] = (future, job_config.output_folder)
+
+        # Outside the lock, the callback runs right away if the download is already done
+        future.add_done_callback(lambda _: self._forget(key, future))
+
+        return future, job_config.output_folder
+
+    def _forget(self, key, future):
+        with self._in_flight_lock:
+            in_flight = self._in_flight.get(key)
+            if in_flight is not None and in_flight[0] is future:
+                del self._in_flight[key]
+
+    def _place_result(self, usi, result, download_folder, job_config, extension_filter):
+        """
+        The result of a download that another job started, for the output folder of this job
+        """
+        # A download that went through the cache is in there now, so this job goes the same way as a cache hit and its
+        # link is recorded
+        if result.get("cache_filename") is not None and "ERROR" not in result["status"]:
+            return self._download(usi, job_config, extension_filter, time.monotonic())
+
+        import file_linking
+
+        result = dict(result)
+        target_path = result.get("target_path")
+        if target_path is None:
+            return result
+
+        # The same relative path in the output folder of this job, linked to the file itself rather than to the output of the other job
+        placed_path = os.path.join(job_config.output_folder, os.path.relpath(target_path, download_folder))
+        if os.path.exists(target_path) and not os.path.exists(placed_path):
+            os.makedirs(os.path.dirname(placed_path), exist_ok=True)
+            file_linking.link_file(os.path.realpath(target_path), placed_path)
+
+        result["target_path"] = placed_path
+        return result
+
+    def _iter_results(self, usis, job_config, extension_filter):
+        in_flight = [self._submit(usi, job_config, extension_filter) for usi in usis]
+
+        for usi, (future, download_folder) in zip(usis, in_flight):
+            try:
+                result = future.result()
+                if result is None:
+                    continue
+
+                # Jobs that shared the download each get their own copy
+                if download_folder != job_config.output_folder:
+                    result = self._place_result(usi, result, download_folder, job_config, extension_filter)
+            except Exception as e:
+                # One USI failing in a way download_helper did not catch does not take down the rest of the job
+                print("Error downloading", usi, e, file=sys.stderr)
+                result = {"usi": usi, "status": "ERROR"}
+
+            yield result
+
+    def run_job(self, job):
+        """
+        Downloads the USIs of a job and yields their results in order, USIs whose host was unavailable are retried
+        once its circuit breaker lets requests through again, so their results come at the end
+        """
+        import usi_input
+        import host_control
+
+        job_config = self._job_config(job)
+
+        extension_filter = job_config.extension_filter_tuple()
+
+        os.makedirs(job_config.output_folder, exist_ok=True)
+
+        usis = list(usi_input.unique_usis(job["usis"]))
+        self._workflow.prepare_batch(usis, job_config)
+
+        parked_usis = []
+        for result in self._iter_results(usis, job_config, extension_filter):
+            if result["status"] == "ERROR_HOST_UNAVAILABLE":
+                parked_usis.append(result["usi"])
+            else:
+                yield result
+
+        if len(parked_usis) == 0:
+            return
+
+        time.sleep(host_control.recovery_delay())
+        yield from self._iter_results(parked_usis, job_config, extension_filter)
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self.client.close()
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    """
+    One job per connection, the job is a json line and the results are sent back as json lines as they complete
+    """
+
+    def _send(self, message):
+        self.wfile.write((json.dumps(message) + "\n").encode())
+        self.wfile.flush()
+
+    def _send_unreported(self, job, reported_usis):
+        # An error record for every USI of the job that has no result yet, so the job can still write its summary
+        import usi_input
+
+        unreported_usis = [usi for usi in usi_input.unique_usis(job["usis"]) if len(usi) >= 5 and usi not in reported_usis]
+        for usi in unreported_usis:
+            self._send({"result": {"usi": usi, "status": "ERROR"}})
+
+        return len(unreported_usis)
+
+    def handle(self):
+        job = None
+        reported_usis = set()
+
+        try:
+            job = json.loads(self.rfile.readline())
+
+            for result in self.server.download_daemon.run_job(job):
+                self._send({"result": result})
+                reported_usis.add(result["usi"])
+
+            self._send({"done": True, "count": len(reported_usis)})
+        except BrokenPipeError:
+            # The files the job started are still downloaded, the next job will find them
+            print("Client disconnected before its job was done", file=sys.stderr)
+        except (DaemonError, ValueError) as e:
+            self._send({"error": str(e)})
+        except Exception as e:
+            print("Error running job", e, file=sys.stderr)
+
+            if isinstance(job, dict) and isinstance(job.get("usis"), list):
+                unreported_count = self._send_unreported(job, reported_usis)
+                self._send({"done": True, "count": len(reported_usis) + unreported_count})
+            else:
+                self._send({"error": str(e)})
+
+
+class _DaemonServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(socket_path, download_daemon):
+    # A socket left behind by a daemon that did not shut down cleanly would make the bind fail
+    if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        os.remove(socket_path)
+
+    server = _DaemonServer(socket_path, _JobHandler)
+    server.download_daemon = download_daemon
+
+    return server
+
+
+def submit_job(socket_path, usis, output_folder, **options):
+    """
+    Sends a job to the daemon and yields the result of each USI as the daemon sends it back
+
+    options are the JOB_OPTIONS, anything else comes from the configuration of the daemon
+    """
+    job = {"usis": list(usis), "output_folder": os.path.abspath(output_folder)}
+    job.update({key: value for key, value in options.items() if key in JOB_OPTIONS})
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall((json.dumps(job) + "\n").encode())
+
+        with connection.makefile("r") as f:
+            for line in f:
+                message = json.loads(line)
+
+                if "result" in message:
+                    yield message["result"]
+                elif "error" in message:
+                    raise DaemonError(message["error"])
+                elif message.get("done"):
+                    return
+
+    raise DaemonError("The daemon closed the connection before the job was done")
+
+
+def serve(socket_path, config):
+    download_daemon = DownloadDaemon(config)
+    server = make_server(socket_path, download_daemon)
+
+    # Stopping with SIGTERM goes through the same cleanup as ctrl-c
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    print("Listening on", socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        download_daemon.close()
+        os.remove(socket_path)
+
+
+def main():
+    import download_workflow
+
+    parser = argparse.ArgumentParser(description='Download daemon that takes jobs from download_public_data_usi.py --daemon_socket')
+    parser.add_argument('socket_path', help='Unix socket to listen on')
+
+    # The options of the command line apply to every job, except for the ones in JOB_OPTIONS that a job can set itself
+    download_workflow.add_download_arguments(parser)
+
+    args = parser.parse_args()
+
+    serve(args.socket_path, download_client.DownloadConfig.from_args(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Locks so that each file is only downloaded once, across threads and across processes sharing a cache."""
+import os
+import fcntl
+import threading
+from contextlib import contextmanager
+
+_key_locks = {}
+_key_locks_lock = threading.Lock()
+
+
+@contextmanager
+def key_lock(key, blocking=True):
+    """
+    In process lock per key, e.g. the stripped MRI, the locks are dropped again once nobody is waiting on them
+
+    Yields whether the lock was acquired, which is always True unless blocking is False
+    """
+    with _key_locks_lock:
+        lock_entry = _key_locks.setdefault(key, [threading.Lock(), 0])
+        lock_entry[1] += 1
+
+    try:
+        acquired = lock_entry[0].acquire(blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                lock_entry[0].release()
+    finally:
+        with _key_locks_lock:
+            lock_entry[1] -= 1
+            if lock_entry[1] == 0:
+                del _key_locks[key]
+
+
+def _flock(lock_filename, blocking):
+    # Returns the locked file descriptor, or None when it is held elsewhere and blocking is False
+    while True:
+        fd = os.open(lock_filename, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+
+        # The holder we waited on may have removed the lock file, then the lock is on a file nobody else will see
+        try:
+            if os.fstat(fd).st_ino == os.stat(lock_filename).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+@contextmanager
+def file_lock(lock_filename, blocking=True):
+    """
+    Exclusive lock on lock_filename shared with other processes, the kernel drops it if the holder dies
+
+    Yields whether the lock was acquired, which is always True unless blocking is False. The holder may remove the
+    lock file, e.g. along with the file it protects
+    """
+    # flock may be per process on some network filesystems, so threads also take the in process lock
+    with key_lock(lock_filename, blocking=blocking) as acquired:
+        fd = _flock(lock_filename, blocking) if acquired else None
+        try:
+            yield fd is not None
+        finally:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+
+def cache_entry_lock_filename(cache_filename):
+    # The lock file sits next to the entry, hidden so the cache index does not pick it up
+    return os.path.join(os.path.dirname(cache_filename), "." + os.path.basename(cache_filename) + ".lock")
+
+
+@contextmanager
+def cache_entry_lock(cache_filename, blocking=True):
+    """
+    file_lock on a cache entry. A cache we cannot write the lock file into, e.g. a read only mount, cannot be changed
+    from here either, so nothing is locked there and the lock counts as acquired
+    """
+    lock_filename = cache_entry_lock_filename(cache_filename)
+    if not os.access(os.path.dirname(lock_filename), os.W_OK):
+        yield True
+        return
+
+    with file_lock(lock_filename, blocking=blocking) as acquired:
+        yield acquired
+
+
+# The slots of DownloadSlots held by the current worker thread
+_held_slots = threading.local()
+
+
+class DownloadSlots:
+    """
+    The global --parallel limit and the per host limits, a worker holds a slot of each while it downloads
+    """
+
+    def __init__(self, parallel, host_limits=None):
+        self.parallel = parallel
+        self._host_limits = host_limits or {}
+        self._global_semaphore = threading.Semaphore(parallel)
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+
+    def _host_semaphore(self, host):
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.Semaphore(self._host_limits.get(host, self.parallel))
+
+            return self._host_semaphores[host]
+
+    @contextmanager
+    def hold(self, host):
+        # Always the host first, so workers waiting on the global slot never hold one another's host slot hostage
+        semaphores = [self._host_semaphore(host), self._global_semaphore]
+        for semaphore in semaphores:
+            semaphore.acquire()
+
+        _held_slots.semaphores = semaphores
+        try:
+            yield
+        finally:
+            _held_slots.semaphores = []
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+
+
+@contextmanager
+def released_slots():
+    """
+    Gives the slots of the current worker back while it waits on something other than a transfer, e.g. a vendor
+    conversion, and takes them again afterwards. Does nothing outside of DownloadSlots.hold
+    """
+    semaphores = getattr(_held_slots, "semaphores", [])
+    for semaphore in reversed(semaphores):
+        semaphore.release()
+
+    try:
+        yield
+    finally:
+        for semaphore in semaphores:
+            semaphore.acquire()
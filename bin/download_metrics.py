@@ -0,0 +1,184 @@
+"""Per USI phase timings and per host totals, reported in the summary and optionally as json lines or a Prometheus textfile."""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+PHASES = ["resolve", "queue", "transfer", "conversion_wait", "finalize"]
+
+METRIC_COLUMNS = ["host"] + ["{}_seconds".format(phase) for phase in PHASES] + ["total_seconds", "downloaded_bytes", "throughput_mb_per_second"]
+
+# Files that were not transferred, e.g. cache hits, are counted under this host
+NO_HOST = "none"
+
+PROMETHEUS_PREFIX = "downloadpublicdata"
+
+_current = threading.local()
+
+
+class UsiMetrics:
+    def __init__(self, usi, queue_seconds=0):
+        self.usi = usi
+        self.host = None
+        self.downloaded_bytes = 0
+        self.phase_seconds = {phase: 0.0 for phase in PHASES}
+        self.phase_seconds["queue"] = queue_seconds
+
+        self._start_time = time.monotonic()
+
+    def columns(self):
+        total_seconds = time.monotonic() - self._start_time + self.phase_seconds["queue"]
+
+        columns = {"host": self.host}
+        for phase in PHASES:
+            columns["{}_seconds".format(phase)] = round(self.phase_seconds[phase], 3)
+        columns["total_seconds"] = round(total_seconds, 3)
+        columns["downloaded_bytes"] = self.downloaded_bytes
+
+        throughput = None
+        if self.downloaded_bytes > 0 and self.phase_seconds["transfer"] > 0:
+            throughput = round(self.downloaded_bytes / self.phase_seconds["transfer"] / 1024 / 1024, 3)
+        columns["throughput_mb_per_second"] = throughput
+
+        return columns
+
+
+@contextmanager
+def track_usi(usi, queue_seconds=0):
+    """
+    Collects the phases timed in this thread while working on the USI
+    """
+    usi_metrics = UsiMetrics(usi, queue_seconds=queue_seconds)
+
+    previous_metrics = getattr(_current, "usi_metrics", None)
+    _current.usi_metrics = usi_metrics
+    try:
+        yield usi_metrics
+    finally:
+        _current.usi_metrics = previous_metrics
+
+
+@contextmanager
+def phase(phase_name):
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        usi_metrics = getattr(_current, "usi_metrics", None)
+        if usi_metrics is not None:
+            usi_metrics.phase_seconds[phase_name] += time.monotonic() - start_time
+
+
+def add_bytes(byte_count):
+    usi_metrics = getattr(_current, "usi_metrics", None)
+    if usi_metrics is not None:
+        usi_metrics.downloaded_bytes += byte_count
+
+
+def set_host(url):
+    # The host the file is transferred from, which for conversions is the datasetcache
+    usi_metrics = getattr(_current, "usi_metrics", None)
+    if usi_metrics is not None:
+        usi_metrics.host = urlparse(url).netloc or "local"
+
+
+def path_size(path):
+    # Size of a file, or of everything in a folder for .d bundles
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    total_size = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            total_size += os.path.getsize(os.path.join(root, filename))
+
+    return total_size
+
+
+class MetricsCollector:
+    """
+    Totals per host across all the results, written out with metrics_output at the end of the run
+
+    A metrics_output ending in .prom is written as a Prometheus textfile, anything else gets one json line per file
+    as they come in followed by one line per host
+    """
+
+    def __init__(self, metrics_output=None):
+        self.metrics_output = metrics_output
+        self.hosts = {}
+
+        self._file = None
+        if metrics_output is not None and not metrics_output.endswith(".prom"):
+            self._file = open(metrics_output, "w")
+
+    def add(self, result):
+        host = result.get("host") or NO_HOST
+        host_totals = self.hosts.setdefault(host, {"files": 0, "errors": 0, "downloaded_bytes": 0, "phase_seconds": {phase: 0.0 for phase in PHASES}})
+
+        host_totals["files"] += 1
+        if "ERROR" in str(result.get("status")):
+            host_totals["errors"] += 1
+        host_totals["downloaded_bytes"] += result.get("downloaded_bytes") or 0
+        for phase in PHASES:
+            host_totals["phase_seconds"][phase] += result.get("{}_seconds".format(phase)) or 0
+
+        if self._file is not None:
+            file_metrics = {"type": "file", "usi": result.get("usi"), "status": result.get("status")}
+            file_metrics.update({column: result.get(column) for column in METRIC_COLUMNS})
+            self._file.write(json.dumps(file_metrics) + "\n")
+
+    def _host_throughput(self, host_totals):
+        transfer_seconds = host_totals["phase_seconds"]["transfer"]
+        if transfer_seconds == 0:
+            return None
+
+        return host_totals["downloaded_bytes"] / transfer_seconds / 1024 / 1024
+
+    def print_summary(self):
+        print("Host", "Files", "Errors", "Downloaded Bytes", "MB/s", *["{} s".format(phase) for phase in PHASES], sep="\t")
+        for host, host_totals in sorted(self.hosts.items()):
+            throughput = self._host_throughput(host_totals)
+            print(host, host_totals["files"], host_totals["errors"], host_totals["downloaded_bytes"],
+                  "" if throughput is None else "{:.2f}".format(throughput),
+                  *["{:.1f}".format(host_totals["phase_seconds"][phase]) for phase in PHASES], sep="\t")
+
+    def _write_prometheus(self):
+        lines = []
+
+        def _metric(name, help_text, metric_type, samples):
+            lines.append("# HELP {}_{} {}".format(PROMETHEUS_PREFIX, name, help_text))
+            lines.append("# TYPE {}_{} {}".format(PROMETHEUS_PREFIX, name, metric_type))
+            for labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(key, label_value) for key, label_value in labels.items())
+                lines.append("{}_{}{{{}}} {}".format(PROMETHEUS_PREFIX, name, label_text, value))
+
+        host_items = sorted(self.hosts.items())
+        _metric("files_total", "Files processed per host", "counter", [({"host": host}, host_totals["files"]) for host, host_totals in host_items])
+        _metric("errors_total", "Files that ended in an error per host", "counter", [({"host": host}, host_totals["errors"]) for host, host_totals in host_items])
+        _metric("downloaded_bytes_total", "Bytes downloaded per host", "counter", [({"host": host}, host_totals["downloaded_bytes"]) for host, host_totals in host_items])
+        _metric("phase_seconds_total", "Seconds spent in each phase per host", "counter",
+                [({"host": host, "phase": phase}, round(host_totals["phase_seconds"][phase], 3)) for host, host_totals in host_items for phase in PHASES])
+
+        # Written next to the target and renamed, so the node exporter never reads half a file
+        temp_filename = self.metrics_output + ".tmp"
+        with open(temp_filename, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_filename, self.metrics_output)
+
+    def close(self):
+        if self.metrics_output is None:
+            return
+
+        if self._file is not None:
+            for host, host_totals in sorted(self.hosts.items()):
+                host_metrics = {"type": "host", "host": host, "files": host_totals["files"], "errors": host_totals["errors"],
+                                "downloaded_bytes": host_totals["downloaded_bytes"], "throughput_mb_per_second": self._host_throughput(host_totals)}
+                host_metrics.update({"{}_seconds".format(phase): round(host_totals["phase_seconds"][phase], 3) for phase in PHASES})
+                self._file.write(json.dumps(host_metrics) + "\n")
+
+            self._file.close()
+            self._file = None
+        else:
+            self._write_prometheus()
@@ -0,0 +1,107 @@
+"""The options of a download run, shared by the command line, download_client and download_daemon."""
+from dataclasses import dataclass, fields, replace
+
+
+@dataclass
+class DownloadConfig:
+    """
+    The options of the command line, with the same names and meanings
+
+    None means the default of the module the option belongs to, extension_filter is a list of extensions, e.g. [".mzml"]
+    """
+    output_folder: str = None
+    cache_directory: str = None
+    existing_dataset_directory: str = None
+    existing_dataset_manifest: str = None
+    nestfiles: str = "flat"
+    extension_filter: list = None
+    noconversion: bool = False
+    dryrun: bool = False
+    verify_cache: bool = False
+
+    parallel: int = 1
+    host_parallel: str = None
+
+    http_pool_size: int = None
+    connect_timeout: float = None
+    read_timeout: float = None
+    http_retries: int = None
+
+    host_rate: float = None
+    host_max_concurrency: int = None
+    host_latency_target: float = None
+    breaker_failures: int = None
+    breaker_cooldown: float = None
+
+    dashboard_url: str = None
+    resolution_cache_file: str = None
+    resolution_cache_ttl: float = None
+    resolve_first: bool = False
+    resolve_parallel: int = None
+
+    datasetcache_url: str = None
+    pipeline_conversions: bool = False
+    conversion_timeout: float = None
+    bundle_parallel: int = None
+
+    job_database: str = None
+    cache_max_size: str = None
+    cache_eviction_policy: str = "lru"
+    largest_first: bool = False
+    chunk_size_mb: float = None
+    segments: int = None
+    segment_threshold_mb: float = None
+    hash_segmented_downloads: bool = False
+    link_mode: str = None
+    bandwidth_limit_mb: float = None
+    min_free_space: str = None
+
+    @classmethod
+    def from_args(cls, args):
+        # From the parsed command line, which has the extension filter as a semicolon separated list
+        config = cls(**{field.name: getattr(args, field.name) for field in fields(cls) if hasattr(args, field.name)})
+        if isinstance(config.extension_filter, str):
+            config.extension_filter = config.extension_filter.split(";")
+
+        return config
+
+    def extension_filter_tuple(self):
+        # The lowercase extensions as the target filename is matched against them, None for no filter
+        if not self.extension_filter:
+            return None
+
+        return tuple([extension.lower() for extension in self.extension_filter])
+
+    def with_defaults(self):
+        # Filling in the module defaults here rather than in the fields, so importing this module stays cheap
+        import http_session
+        import host_control
+        import download_resolver
+        import download_raw
+        import download_stream
+        import vendor_conversion
+        import file_linking
+        import download_admission
+
+        defaults = {
+            "http_pool_size": http_session.DEFAULT_POOL_SIZE,
+            "connect_timeout": http_session.DEFAULT_CONNECT_TIMEOUT,
+            "read_timeout": http_session.DEFAULT_READ_TIMEOUT,
+            "http_retries": http_session.DEFAULT_RETRIES,
+            "host_rate": host_control.DEFAULT_HOST_RATE,
+            "host_max_concurrency": host_control.DEFAULT_HOST_MAX_CONCURRENCY,
+            "host_latency_target": host_control.DEFAULT_LATENCY_TARGET,
+            "breaker_failures": host_control.DEFAULT_FAILURE_THRESHOLD,
+            "breaker_cooldown": host_control.DEFAULT_BREAKER_COOLDOWN,
+            "resolution_cache_ttl": download_resolver.DEFAULT_RESOLUTION_CACHE_TTL,
+            "resolve_parallel": download_resolver.DEFAULT_RESOLVE_PARALLEL,
+            "conversion_timeout": vendor_conversion.DEFAULT_CONVERSION_TIMEOUT,
+            "bundle_parallel": download_raw.DEFAULT_BUNDLE_PARALLEL,
+            "chunk_size_mb": download_stream.DEFAULT_CHUNK_SIZE / 1024 / 1024,
+            "segments": download_stream.DEFAULT_SEGMENTS,
+            "segment_threshold_mb": download_stream.DEFAULT_SEGMENT_THRESHOLD / 1024 / 1024,
+            "link_mode": file_linking.DEFAULT_LINK_MODE,
+            "bandwidth_limit_mb": download_admission.DEFAULT_BANDWIDTH_LIMIT,
+        }
+
+        return replace(self, **{key: value for key, value in defaults.items() if getattr(self, key) is None})
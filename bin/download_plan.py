@@ -0,0 +1,152 @@
+"""Planning pass over the whole USI list, grouping the files by host and dataset and looking up their sizes up front."""
+import os
+import sys
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import http_session
+import download_resolver
+import download_stream
+
+PLAN_COLUMNS = ["usi", "mri", "host", "dataset", "method", "target_path", "download_url", "expected_size", "duplicate_of"]
+
+# How each file is fetched, only direct downloads have a size we can look up before downloading
+METHOD_DIRECT = "direct"
+METHOD_CONVERSION = "conversion"
+METHOD_RAW = "raw"
+
+# USIs whose target could not be determined, they are still downloaded so the download reports what is wrong
+METHOD_UNKNOWN = "unknown"
+
+
+def _content_length(download_url):
+    local_path = download_stream._local_source_path(download_url)
+    if local_path is not None:
+        return os.path.getsize(local_path)
+
+    r = http_session.head(download_url)
+    if r.status_code != 200 or "Content-Length" not in r.headers:
+        return None
+
+    return int(r.headers["Content-Length"])
+
+
+def _lookup_size(plan_entry):
+    try:
+        download_url = download_resolver.determine_download_url(plan_entry["usi"])
+        if download_url is None:
+            return None, None
+
+        return download_url, _content_length(download_url)
+    except KeyboardInterrupt:
+        raise
+    except Exception as e:
+        print("Error looking up size", plan_entry["usi"], e, file=sys.stderr)
+        return None, None
+
+
+class DownloadPlan:
+    """
+    Every USI of the run with where it goes and how big it is expected to be
+
+    Entries with the same target path as an earlier one are marked as duplicates of it, these are either the same file
+    with different scans or different files that would overwrite each other in the output folder. Entries with
+    METHOD_UNKNOWN have no target path
+    """
+
+    def __init__(self):
+        self.entries = []
+        self._target_paths = {}
+
+    def add(self, usi, host, dataset, method, target_path):
+        plan_entry = {
+            "usi": usi,
+            "mri": download_resolver.strip_mri(usi),
+            "host": host,
+            "dataset": dataset,
+            "method": method,
+            "target_path": target_path,
+            "download_url": None,
+            "expected_size": None,
+            "duplicate_of": self._target_paths.get(target_path) if target_path is not None else None,
+        }
+
+        if plan_entry["duplicate_of"] is None and target_path is not None:
+            self._target_paths[target_path] = usi
+
+        self.entries.append(plan_entry)
+
+        return plan_entry
+
+    def target_dirs(self):
+        return sorted(set(os.path.dirname(plan_entry["target_path"]) for plan_entry in self.entries if plan_entry["target_path"] is not None))
+
+    def lookup_sizes(self, parallel=download_resolver.DEFAULT_RESOLVE_PARALLEL):
+        """
+        Resolves the download links of the direct downloads and asks the hosts for their sizes
+        """
+        sized_entries = [plan_entry for plan_entry in self.entries if plan_entry["method"] == METHOD_DIRECT and plan_entry["duplicate_of"] is None]
+
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            for plan_entry, (download_url, expected_size) in zip(sized_entries, executor.map(_lookup_size, sized_entries)):
+                plan_entry["download_url"] = download_url
+                plan_entry["expected_size"] = expected_size
+
+    def usis(self, largest_first=False):
+        """
+        The USIs in the order to download them, with largest_first the biggest files start first so they do not end
+        up as the long tail of the run, files of unknown size go after the known ones
+        """
+        if not largest_first:
+            return [plan_entry["usi"] for plan_entry in self.entries]
+
+        ordered_entries = sorted(self.entries, key=lambda plan_entry: -1 if plan_entry["expected_size"] is None else plan_entry["expected_size"], reverse=True)
+
+        return [plan_entry["usi"] for plan_entry in ordered_entries]
+
+    def groups(self):
+        """
+        Totals per host and dataset, in order of first appearance
+        """
+        groups = {}
+        for plan_entry in self.entries:
+            group = groups.setdefault((plan_entry["host"], plan_entry["dataset"]), {"files": 0, "duplicates": 0, "expected_size": 0, "unknown_size": 0})
+
+            if plan_entry["duplicate_of"] is not None:
+                group["duplicates"] += 1
+                continue
+
+            group["files"] += 1
+            if plan_entry["expected_size"] is None:
+                group["unknown_size"] += 1
+            else:
+                group["expected_size"] += plan_entry["expected_size"]
+
+        return groups
+
+    def print_summary(self):
+        print("Host", "Dataset", "Files", "Duplicates", "Expected Bytes", "Unknown Size", sep="\t")
+
+        total_size = 0
+        for (host, dataset), group in self.groups().items():
+            print(host, dataset, group["files"], group["duplicates"], group["expected_size"], group["unknown_size"], sep="\t")
+            total_size += group["expected_size"]
+
+        print("Total", len(self.entries), "files,", total_size, "expected bytes")
+
+    def write(self, plan_filename):
+        # A json plan also has the per dataset totals, a tsv plan is one row per USI
+        if plan_filename.endswith(".json"):
+            plan = {
+                "entries": self.entries,
+                "groups": [dict(host=host, dataset=dataset, **group) for (host, dataset), group in self.groups().items()],
+            }
+
+            with open(plan_filename, "w") as f:
+                json.dump(plan, f, indent=4)
+        else:
+            with open(plan_filename, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=PLAN_COLUMNS, delimiter="\t")
+                writer.writeheader()
+                writer.writerows(self.entries)
@@ -1,144 +1,231 @@
 import os
-import requests
+import sys
+import uuid
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import http_session
+import host_control
+import download_resolver
+import download_stream
+
+DEFAULT_BUNDLE_PARALLEL = 4
+
+# Rows per request when paging through the datasetcache file listing
+DATASET_LISTING_PAGE_SIZE = 1000
+
+def iter_dataset_files(dataset_accession, filepath_prefix="", cache_url="https://datasetcache.gnps2.org", page_size=DATASET_LISTING_PAGE_SIZE):
+    """
+    Yields the rows of the datasetcache file listing of a dataset, fetched a page at a time
+
+    Raises a DownloadError if a page cannot be fetched
+    """
+    # We need to go to the dataset cache and grab all the files
+    #https://datasetcache.gnps2.org/datasette/database/filename.json?_sort=usi&dataset__exact=MSV000093337&filepath__startswith=ccms_parameters%2Fparams.xml
+    params = {}
+    params["_shape"] = "objects"
+    params["_sort"] = "usi"
+    params["_size"] = page_size
+    params["dataset__exact"] = dataset_accession
+    if filepath_prefix:
+        params["filepath__startswith"] = filepath_prefix
+
+    url =  "{}/datasette/database/filename.json".format(cache_url)
+
+    while True:
+        r = http_session.get(url, params=params)
+
+        if r.status_code != 200:
+            raise download_stream.DownloadError("Unable to list files for {}".format(dataset_accession), status_code=r.status_code)
+
+        listing = r.json()
+        yield from listing["rows"]
+
+        # datasette hands out a token for the next page until we are at the end
+        if listing.get("next") is None:
+            break
+
+        params["_next"] = listing["next"]
+
+def _list_dataset_files(dataset_accession, filepath_prefix, cache_url):
+    try:
+        return list(iter_dataset_files(dataset_accession, filepath_prefix, cache_url))
+    except download_stream.DownloadError as e:
+        print(e, file=sys.stderr)
+        return None
+
+def iter_dataset_usis(dataset_accession, filepath_prefix="", cache_url="https://datasetcache.gnps2.org"):
+    """
+    Yields the USIs of every file in a dataset, for whole dataset downloads
+
+    The files inside .d folders are collapsed into the USI of the folder, and .wiff.scan files are left out since they
+    come along with their .wiff
+    """
+    seen_bundles = set()
+
+    for file_row in iter_dataset_files(dataset_accession, filepath_prefix, cache_url):
+        filepath_parts = file_row["filepath"].split("/")
+
+        bundle_depth = None
+        for i, filepath_part in enumerate(filepath_parts):
+            if filepath_part.lower().endswith(".d"):
+                bundle_depth = i
+                break
+
+        if bundle_depth is not None:
+            bundle_filepath = "/".join(filepath_parts[:bundle_depth + 1])
+            if bundle_filepath in seen_bundles:
+                continue
+
+            seen_bundles.add(bundle_filepath)
+            yield "mzspec:{}:{}".format(dataset_accession, bundle_filepath)
+        elif file_row["filepath"].lower().endswith(".wiff.scan"):
+            continue
+        else:
+            yield file_row["usi"]
+
+def _download_mri_file(mri, target_filename):
+    """
+    Resolves the MRI and streams it to disk with bounded memory, returns True if the file was downloaded
+    """
+    # Now we need to figure out how to get this file given the MRI
+    download_url = download_resolver.determine_download_url(mri)
+
+    if download_url is None:
+        print("Error resolving", mri, file=sys.stderr)
+        return False
+
+    print("DOWNLOAD LINK", download_url)
+
+    try:
+        download_stream.download_url_to_file_atomic(download_url, target_filename)
+    except download_stream.DownloadError as e:
+        print(e, file=sys.stderr)
+        return False
+
+    return True
+
+def _download_bundle(mri, members, bundle_parallel=DEFAULT_BUNDLE_PARALLEL):
+    """
+    Downloads all the member files of a vendor bundle concurrently, members is a list of (usi, target filepath)
+
+    Returns the list of members that did not make it to disk
+    """
+    progress_lock = threading.Lock()
+    progress = {"files": 0, "bytes": 0}
+
+    def _download_member(member):
+        member_usi, member_filepath = member
+
+        try:
+            os.makedirs(os.path.dirname(member_filepath), exist_ok=True)
+            downloaded = _download_mri_file(member_usi, member_filepath)
+        except (KeyboardInterrupt, host_control.HostUnavailableError):
+            raise
+        except Exception as e:
+            print("Error downloading", member_usi, e, file=sys.stderr)
+            downloaded = False
+
+        with progress_lock:
+            progress["files"] += 1
+            if downloaded:
+                progress["bytes"] += os.path.getsize(member_filepath)
+            print("Bundle {} {}/{} files {} bytes".format(mri, progress["files"], len(members), progress["bytes"]))
+
+        return downloaded
+
+    with ThreadPoolExecutor(max_workers=max(1, bundle_parallel)) as executor:
+        downloaded_list = list(executor.map(_download_member, members))
+
+    # Checking we have everything in the listing
+    missing_members = []
+    for member, downloaded in zip(members, downloaded_list):
+        if not downloaded or not os.path.isfile(member[1]):
+            missing_members.append(member)
+
+    return missing_members
+
+def _place_bundle(staging_folder, target_file, extension):
+    # The .wiff goes in last, so its companion files are already next to it once it shows up
+    if extension == "d":
+        os.rename(staging_folder, target_file)
+        return
+
+    target_folder = os.path.dirname(target_file)
+    for filename in sorted(os.listdir(staging_folder), key=lambda filename: filename == os.path.basename(target_file)):
+        os.replace(os.path.join(staging_folder, filename), os.path.join(target_folder, filename))
+
+    os.rmdir(staging_folder)
+
+def download_raw_mri(mri, target_file, cache_url="https://datasetcache.gnps2.org", bundle_parallel=DEFAULT_BUNDLE_PARALLEL):
+    """
+    Downloads the raw vendor file for the MRI to target_file, for .d and .wiff all the member files in the listing are fetched
 
-def download_raw_mri(mri, target_file, cache_url="https://datasetcache.gnps2.org"):
+    Bundles are downloaded into a temporary folder next to target_file and only moved into place once every member is
+    there, so an incomplete bundle is never taken for a finished one
+
+    Raises a DownloadError when the download is incomplete
+    """
     # lets get the extension of the filename
     mri_splits = mri.split(":")
-    
+
     dataset_accession = mri_splits[1]
 
     filename = mri_splits[2]
-    raw_filename = os.path.basename(filename)
-    extension = filename.split(".")[-1]
+    extension = filename.split(".")[-1].lower()
 
     path_to_full_raw_filename = target_file
 
-    if extension == "d":
-        # We need to go to the dataset cache and grab all the files
-        #https://datasetcache.gnps2.org/datasette/database/filename.json?_sort=usi&dataset__exact=MSV000093337&filepath__startswith=ccms_parameters%2Fparams.xml
-        
-        params = {}
-        params["_shape"] = "array"
-        params["dataset__exact"] = mri_splits[1]
-        params["filepath__startswith"] = filename
-
-        url =  "{}/datasette/database/filename.json".format(cache_url)
+    if extension == "d" or extension == "wiff":
+        file_rows = _list_dataset_files(dataset_accession, filename, cache_url)
 
-        r = requests.get(url, params=params)
+        if file_rows is None:
+            raise download_stream.DownloadError("Unable to list files for {}".format(mri))
 
-        if r.status_code == 200:
-            # lets get all he files
-            file_rows = r.json()
+        staging_folder = os.path.join(os.path.dirname(target_file), ".{}.{}.bundle".format(os.path.basename(target_file), uuid.uuid4().hex[:8]))
 
-            for file_row in file_rows:
-                mri_specific_usi = file_row["usi"]
-                mri_specific_filepath = file_row["filepath"]
+        members = []
+        for file_row in file_rows:
+            mri_specific_usi = file_row["usi"]
+            mri_specific_filepath = file_row["filepath"]
 
+            if extension == "d":
                 if mri_specific_filepath.lower().endswith(".zip"):
                     continue
 
                 # file relative file path to original filename
                 relative_filepath = os.path.relpath(mri_specific_filepath, filename)
-                target_specific_filepath = os.path.join(target_file, relative_filepath)
 
-                if relative_filepath == ".":
+                # Skipping the folder itself and anything that only shares the prefix
+                if relative_filepath == "." or relative_filepath.startswith(".."):
                     continue
 
-                os.makedirs(os.path.dirname(target_specific_filepath), exist_ok=True)
-
-                # Now we need to figure out how to get this file given the MRI
-                url = "https://dashboard.gnps2.org/downloadlink"
-                params = {}
-                params["usi"] = mri_specific_usi
-
-                #print("GETTING Dashboard Download link")
-
-                r = requests.get(url, params=params)
-
-                # This gives us the download
-                if r.status_code == 200:
-                    download_url = r.text
-
-                    print("DOWNLOAD LINK", download_url)
-
-                    r = requests.get(download_url)
-
-                    if r.status_code == 200:
-                        with open(target_specific_filepath, "wb") as f:
-                            f.write(r.content)
-                    else:
-                        import sys
-                        print("Error downloading", download_url, file=sys.stderr)
-
-    elif extension == "wiff":
-        # We need to go to the dataset cache and grab all the files
-        #https://datasetcache.gnps2.org/datasette/database/filename.json?_sort=usi&dataset__exact=MSV000093337&filepath__startswith=MSV000093337%2Fccms_parameters%2Fparams.xml
-        params = {}
-        params["_shape"] = "array"
-        params["dataset__exact"] = mri_splits[1]
-        params["filepath__startswith"] = filename
-
-        url =  "{}/datasette/database/filename.json".format(cache_url)
-
-        r = requests.get(url, params=params)
-
-        if r.status_code == 200:
-            # lets get all he files
-            file_rows = r.json()
-
-            for file_row in file_rows:
-                mri_specific_usi = file_row["usi"]
-                mri_specific_filepath = file_row["filepath"]
-
-                target_specific_filepath = os.path.join(conversion_folder, os.path.basename(mri_specific_filepath))
-
-                # Now we need to figure out how to get this file given the MRI
-                url = "https://dashboard.gnps2.org/downloadlink"
-                params = {}
-                params["usi"] = mri_specific_usi
+                target_specific_filepath = os.path.join(staging_folder, relative_filepath)
+            else:
+                # the .wiff comes with companion files like the .wiff.scan, they need to sit next to it with the same name
+                if not mri_specific_filepath.startswith(filename):
+                    continue
 
-                #print("GETTING Dashboard Download link")
+                target_specific_filepath = os.path.join(staging_folder, os.path.basename(target_file) + mri_specific_filepath[len(filename):])
 
-                r = requests.get(url, params=params)
+            members.append((mri_specific_usi, target_specific_filepath))
 
-                # This gives us the download
-                if r.status_code == 200:
-                    download_url = r.text
+        if len(members) == 0:
+            raise download_stream.DownloadError("No files listed for {}".format(mri))
 
-                    #print("DOWNLOAD LINK", download_url)
+        try:
+            missing_members = _download_bundle(mri, members, bundle_parallel=bundle_parallel)
 
-                    r = requests.get(download_url)
+            if len(missing_members) > 0:
+                raise download_stream.DownloadError("Incomplete download of {}, missing {} of {} files".format(mri, len(missing_members), len(members)))
 
-                    if r.status_code == 200:
-                        with open(target_specific_filepath, "wb") as f:
-                            f.write(r.content)
-                    else:
-                        import sys
-                        #print("Error downloading", download_url, file=sys.stderr)
-            
+            _place_bundle(staging_folder, target_file, extension)
+        finally:
+            shutil.rmtree(staging_folder, ignore_errors=True)
 
     elif extension == "raw":
-        # Now we need to figure out how to get this file given the MRI
-        url = "https://dashboard.gnps2.org/downloadlink"
-        params = {}
-        params["usi"] = mri
-
-        r = requests.get(url, params=params)
-
-        # This gives us the download
-        if r.status_code == 200:
-            download_url = r.text
-
-            print("DOWNLOAD LINK", download_url)
-
-            r = requests.get(download_url)
-
-            # TODO: Maybe we should stream this? 
-            if r.status_code == 200:
-                with open(path_to_full_raw_filename, "wb") as f:
-                    f.write(r.content)
-            else:
-                import sys
-                print("Error downloading", download_url, file=sys.stderr)
+        if not _download_mri_file(mri, path_to_full_raw_filename):
+            raise download_stream.DownloadError("Error downloading {}".format(mri))
 
-    return path_to_full_raw_filename
\ No newline at end of file
+    return path_to_full_raw_filename
@@ -0,0 +1,222 @@
+"""Resolving USIs to download links through the dashboard, memoized per MRI."""
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import http_session
+
+DASHBOARD_URL_BASE = "https://dashboard.gnps2.org"
+
+DEFAULT_RESOLUTION_CACHE_TTL = 7 * 24 * 60 * 60
+DEFAULT_RESOLVE_PARALLEL = 8
+DEFAULT_RESOLVE_BATCH_SIZE = 1000
+
+# stripped mri -> (download url, resolution time)
+_resolution_cache = {}
+_resolution_cache_lock = threading.Lock()
+_resolution_key_locks = {}
+
+# MRIs that failed the up front bulk resolution, so we can fail fast on them
+_unresolvable_mris = set()
+
+# Stands in for the link of an MRI the dashboard could not be asked about
+_UNREACHED = object()
+
+_resolution_cache_file = None
+_resolution_cache_ttl = DEFAULT_RESOLUTION_CACHE_TTL
+
+
+def strip_mri(usi):
+    # Make sure usi is actually only the MRI portions, so that every scan in the same file maps to the same entry
+    return ":".join(usi.split(":")[0:3])
+
+
+def configure_resolution_cache(cache_file=None, ttl=None):
+    """
+    Optionally persists the resolutions to a json file so reruns can skip the dashboard, entries older than ttl seconds are ignored
+    """
+    global _resolution_cache_file
+    global _resolution_cache_ttl
+
+    with _resolution_cache_lock:
+        _resolution_cache_file = cache_file
+        if ttl is not None:
+            _resolution_cache_ttl = ttl
+
+        if cache_file is None or not os.path.isfile(cache_file):
+            return
+
+        try:
+            with open(cache_file) as f:
+                persisted = json.load(f)
+        except ValueError:
+            print("Unable to read resolution cache", cache_file)
+            return
+
+        now = time.time()
+        for mri, entry in persisted.items():
+            if now - entry["time"] < _resolution_cache_ttl:
+                _resolution_cache[mri] = (entry["url"], entry["time"])
+
+
+def save_resolution_cache():
+    with _resolution_cache_lock:
+        if _resolution_cache_file is None:
+            return
+
+        persisted = {mri: {"url": url, "time": resolution_time} for mri, (url, resolution_time) in _resolution_cache.items()}
+
+        # Writing to a temp file first so an interrupted write does not leave us with a corrupt cache
+        temp_filename = _resolution_cache_file + ".tmp"
+        with open(temp_filename, "w") as f:
+            json.dump(persisted, f)
+        os.replace(temp_filename, _resolution_cache_file)
+
+
+def configure_resolver(dashboard_url=None):
+    """
+    Points the resolver at a different dashboard, e.g. a mirror or a local stand-in for testing
+    """
+    global DASHBOARD_URL_BASE
+
+    if dashboard_url is not None:
+        DASHBOARD_URL_BASE = dashboard_url.rstrip("/")
+
+
+def clear_resolution_cache():
+    with _resolution_cache_lock:
+        _resolution_cache.clear()
+        _resolution_key_locks.clear()
+        _unresolvable_mris.clear()
+
+
+def _get_cached(mri):
+    with _resolution_cache_lock:
+        entry = _resolution_cache.get(mri)
+
+        if entry is None:
+            return None
+
+        url, resolution_time = entry
+        if time.time() - resolution_time >= _resolution_cache_ttl:
+            del _resolution_cache[mri]
+            return None
+
+        return url
+
+
+def cached_download_url(usi):
+    # The download link if we already resolved it, without going to the dashboard
+    return _get_cached(strip_mri(usi))
+
+
+def _set_cached(mri, url):
+    with _resolution_cache_lock:
+        _resolution_cache[mri] = (url, time.time())
+
+
+def _request_download_url(usi):
+    # TODO: this likely shoudl be in the datasetcache as well as the dashboard so there is redundancy
+    url = "{}/downloadlink".format(DASHBOARD_URL_BASE)
+    params = {"usi": usi}
+    r = http_session.get(url, params=params)
+
+    if r.status_code == 200:
+        return r.text
+
+    # A dashboard in trouble says nothing about the USI, only its other answers mean there is no link
+    if r.status_code >= 500:
+        r.raise_for_status()
+
+    return None
+
+
+def determine_download_url(usi):
+    """
+    Getting the path to the original file, each MRI only goes to the dashboard once
+    """
+    mri = strip_mri(usi)
+
+    download_url = _get_cached(mri)
+    if download_url is not None:
+        return download_url
+
+    # Making sure concurrent callers for the same MRI wait on a single request
+    with _resolution_cache_lock:
+        key_lock = _resolution_key_locks.setdefault(mri, threading.Lock())
+
+    with key_lock:
+        download_url = _get_cached(mri)
+        if download_url is not None:
+            return download_url
+
+        download_url = _request_download_url(mri)
+
+        # We don't remember failures so they can be retried
+        if download_url is not None:
+            _set_cached(mri, download_url)
+
+        # Once the link is cached the lock is not needed anymore, later callers find the link first
+        with _resolution_cache_lock:
+            if _resolution_key_locks.get(mri) is key_lock:
+                del _resolution_key_locks[mri]
+
+    return download_url
+
+
+def _determine_download_url_or_unreached(usi):
+    try:
+        return determine_download_url(usi)
+    except KeyboardInterrupt:
+        raise
+    except Exception as e:
+        # Timeouts, resets and hosts behind an open circuit breaker, the download resolves it again later
+        print("Error resolving", usi, e)
+        return _UNREACHED
+
+
+def resolve_download_urls(usi_list, parallel=DEFAULT_RESOLVE_PARALLEL, batch_size=DEFAULT_RESOLVE_BATCH_SIZE):
+    """
+    Resolves a whole list of USIs up front, deduplicated by MRI, and primes the resolution cache for the downloads
+
+    The dashboard has no bulk endpoint, so each batch is resolved with concurrent requests over the pooled session
+
+    Returns a dictionary of stripped mri to download url, None when the dashboard has no link for it. MRIs the
+    dashboard could not be reached for are left out, they are not taken for unresolvable
+    """
+    mri_list = []
+    seen_mris = set()
+    for usi in usi_list:
+        if len(usi) < 5:
+            continue
+
+        mri = strip_mri(usi)
+        if mri in seen_mris:
+            continue
+
+        seen_mris.add(mri)
+        mri_list.append(mri)
+
+    resolved = {}
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        for i in range(0, len(mri_list), batch_size):
+            batch = mri_list[i:i + batch_size]
+            for mri, download_url in zip(batch, executor.map(_determine_download_url_or_unreached, batch)):
+                if download_url is not _UNREACHED:
+                    resolved[mri] = download_url
+
+    with _resolution_cache_lock:
+        for mri, download_url in resolved.items():
+            if download_url is None:
+                _unresolvable_mris.add(mri)
+            else:
+                _unresolvable_mris.discard(mri)
+
+    return resolved
+
+
+def is_unresolvable(usi):
+    with _resolution_cache_lock:
+        return strip_mri(usi) in _unresolvable_mris
@@ -0,0 +1,609 @@
+"""Streaming downloads to disk with large buffers, and zero copy fast paths for local sources."""
+import os
+import re
+import json
+import uuid
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse, unquote
+
+import requests
+
+import http_session
+import file_linking
+import download_admission
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Files at least this large are fetched as this many byte ranges over parallel connections when the server allows it
+DEFAULT_SEGMENTS = 4
+DEFAULT_SEGMENT_THRESHOLD = 64 * 1024 * 1024
+
+# How often the progress of each segment is written next to the partial file, so a killed process can resume from there
+SEGMENT_PROGRESS_INTERVAL = 5
+
+
+class DownloadError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+
+        # Set when the server answered with an error status
+        self.status_code = status_code
+
+
+class RangeNotSupportedError(DownloadError):
+    """
+    Raised when the server sends the whole file instead of the byte range we asked for
+    """
+
+
+_stream_config = {
+    "chunk_size": DEFAULT_CHUNK_SIZE,
+    "segments": DEFAULT_SEGMENTS,
+    "segment_threshold": DEFAULT_SEGMENT_THRESHOLD,
+    "hash_segments": False,
+}
+
+
+def configure_stream(chunk_size=None, segments=None, segment_threshold=None, hash_segments=None):
+    if chunk_size is not None:
+        _stream_config["chunk_size"] = max(int(chunk_size), 1024)
+
+    if segments is not None:
+        _stream_config["segments"] = max(int(segments), 1)
+
+    if segment_threshold is not None:
+        _stream_config["segment_threshold"] = segment_threshold
+
+    if hash_segments is not None:
+        _stream_config["hash_segments"] = hash_segments
+
+
+def _preallocate(fd, size):
+    # Reserving the space up front keeps the file contiguous and fails early when the disk is full
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return False
+
+    try:
+        os.posix_fallocate(fd.fileno(), 0, size)
+        return True
+    except OSError:
+        # Not all filesystems support this, its just an optimization
+        return False
+
+
+def _iter_chunks(response, chunk_size):
+    # A connection lost halfway through the body is an incomplete download like a short body, so it is resumed later
+    try:
+        yield from response.iter_content(chunk_size=chunk_size)
+    except requests.exceptions.RequestException as e:
+        raise DownloadError("Connection lost downloading {}: {}".format(response.url, e))
+
+
+def stream_response_to_file(response, target_filename, chunk_size=None, resume_from=0, preallocate=True, hasher=None, reservation=None):
+    """
+    Writes a streamed requests response to target_filename, returns the number of bytes written
+
+    With resume_from, the response is written after the first resume_from bytes already in the file.
+    With a hashlib hasher, the checksum is computed on the fly as the chunks go by.
+    With a disk reservation from download_admission, it is used up as the bytes land on disk.
+    """
+    if chunk_size is None:
+        chunk_size = _stream_config["chunk_size"]
+
+    content_length = response.headers.get("Content-Length")
+
+    # When the content is encoded, the decoded size is not the Content-Length
+    if response.headers.get("Content-Encoding") not in (None, "identity"):
+        content_length = None
+
+    bytes_written = 0
+    with open(target_filename, "r+b" if resume_from > 0 else "wb") as fd:
+        fd.seek(resume_from)
+
+        if preallocate and content_length is not None:
+            if _preallocate(fd, resume_from + int(content_length)) and reservation is not None:
+                reservation.consume(int(content_length))
+
+        for chunk in _iter_chunks(response, chunk_size):
+            download_admission.throttle(len(chunk))
+
+            fd.write(chunk)
+            bytes_written += len(chunk)
+
+            if reservation is not None:
+                reservation.consume(len(chunk))
+
+            if hasher is not None:
+                hasher.update(chunk)
+
+        # Trimming in case we preallocated more than we got
+        fd.truncate(resume_from + bytes_written)
+
+    return bytes_written
+
+
+def _local_source_path(url):
+    # file:// mirrors and plain local paths can be copied without going through python
+    parsed_url = urlparse(url)
+
+    if parsed_url.scheme == "file":
+        return unquote(parsed_url.path)
+
+    if parsed_url.scheme == "" and os.path.isfile(url):
+        return url
+
+    return None
+
+
+def _hash_file(filename, hasher, length=None):
+    with open(filename, "rb") as f:
+        remaining = length
+        while remaining is None or remaining > 0:
+            read_size = _stream_config["chunk_size"] if remaining is None else min(_stream_config["chunk_size"], remaining)
+            chunk = f.read(read_size)
+            if not chunk:
+                break
+
+            hasher.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+
+
+def _copy_local_file_hashed(source_filename, target_filename, hasher):
+    # When we need the checksum we have to see the bytes anyway, so one buffered pass does both
+    bytes_copied = 0
+    with open(source_filename, "rb") as source_fd, open(target_filename, "wb") as target_fd:
+        for chunk in iter(lambda: source_fd.read(_stream_config["chunk_size"]), b""):
+            target_fd.write(chunk)
+            hasher.update(chunk)
+            bytes_copied += len(chunk)
+
+    return bytes_copied
+
+
+def copy_local_file(source_filename, target_filename, hasher=None):
+    """
+    Copies a local file with copy_file_range or sendfile so the data stays in the kernel, returns the number of bytes copied
+    """
+    if hasher is not None:
+        return _copy_local_file_hashed(source_filename, target_filename, hasher)
+
+    file_size = os.path.getsize(source_filename)
+
+    with open(source_filename, "rb") as source_fd, open(target_filename, "wb") as target_fd:
+        source_fileno = source_fd.fileno()
+        target_fileno = target_fd.fileno()
+
+        bytes_copied = 0
+
+        try:
+            if hasattr(os, "copy_file_range"):
+                while bytes_copied < file_size:
+                    copied = os.copy_file_range(source_fileno, target_fileno, file_size - bytes_copied)
+                    if copied == 0:
+                        break
+                    bytes_copied += copied
+            else:
+                while bytes_copied < file_size:
+                    copied = os.sendfile(target_fileno, source_fileno, bytes_copied, file_size - bytes_copied)
+                    if copied == 0:
+                        break
+                    bytes_copied += copied
+        except OSError:
+            # e.g. cross device copies on older kernels, falling back to a plain buffered copy
+            source_fd.seek(bytes_copied)
+            target_fd.seek(bytes_copied)
+            shutil.copyfileobj(source_fd, target_fd, _stream_config["chunk_size"])
+            bytes_copied = target_fd.tell()
+
+    return bytes_copied
+
+
+def _place_local_source(local_path, target_filename, hasher=None):
+    """
+    With a hardlink or reflink link mode, local mirrors are linked rather than copied, and the checksum is read back
+    from the linked file. Symlinks are left to the output folder, the download itself is always a real file
+    """
+    if file_linking.link_mode() in ["hardlink", "reflink"]:
+        file_linking.link_file(local_path, target_filename)
+        if hasher is not None:
+            _hash_file(target_filename, hasher)
+
+        return os.path.getsize(target_filename)
+
+    return copy_local_file(local_path, target_filename, hasher=hasher)
+
+
+def _get_admitted(url, target_filename, params=None, headers=None):
+    """
+    Sends the request and reserves disk space for the body once its Content-Length is known, returns the response
+    and the reservation. When it does not fit yet, the response is closed while waiting for space and sent again
+    """
+    r = http_session.get(url, params=params, headers=headers, stream=True)
+
+    body_length = _body_length(r)
+    reservation = download_admission.try_reserve(target_filename, body_length)
+    if reservation is None:
+        r.close()
+
+        reservation = download_admission.reserve(target_filename, body_length)
+        try:
+            r = http_session.get(url, params=params, headers=headers, stream=True)
+        except:
+            reservation.release()
+            raise
+
+    return r, reservation
+
+
+def _body_length(response):
+    # Error bodies are small, only the data we are going to write needs space
+    if response.status_code not in (200, 206) or response.headers.get("Content-Encoding") not in (None, "identity"):
+        return 0
+
+    return int(response.headers.get("Content-Length") or 0)
+
+
+def _expected_length(response):
+    if response.status_code != 200 or response.headers.get("Content-Encoding") not in (None, "identity"):
+        return None
+
+    if response.headers.get("Content-Length") is None:
+        return None
+
+    return int(response.headers["Content-Length"])
+
+
+def _range_validator(response):
+    # Weak ETags cannot be used with If-Range
+    etag = response.headers.get("ETag")
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+
+    return response.headers.get("Last-Modified")
+
+
+def _can_segment(response, total_length):
+    return (_stream_config["segments"] > 1 and total_length is not None and total_length >= _stream_config["segment_threshold"]
+            and response.status_code == 200 and response.headers.get("Accept-Ranges", "").lower() == "bytes")
+
+
+def _split_segments(total_length):
+    # [first byte, last byte, bytes written so far] for each range
+    segment_size = -(-total_length // _stream_config["segments"])
+    return [[start, min(start + segment_size, total_length) - 1, 0] for start in range(0, total_length, segment_size)]
+
+
+def _fetch_segment(url, fd, segment, params, validator, reservation, stop_event, response=None):
+    """
+    Writes one byte range of the file with pwrite, keeping the count of bytes written in segment up to date so an
+    interrupted download can carry on from there. response is the already open response when it is the first segment
+    """
+    start, end, written = segment
+    offset = start + written
+    if offset > end:
+        return
+
+    if response is None:
+        headers = {"Accept-Encoding": "identity", "Range": "bytes={}-{}".format(offset, end)}
+        if validator is not None:
+            headers["If-Range"] = validator
+
+        response = http_session.get(url, params=params, headers=headers, stream=True)
+
+        range_start, _ = _parse_content_range(response)
+        if response.status_code != 206 or range_start != offset:
+            response.close()
+            if response.status_code == 200:
+                raise RangeNotSupportedError("{} did not return the range {}-{}".format(url, offset, end))
+            raise DownloadError("Error downloading {} range {}-{} status {}".format(url, offset, end, response.status_code), status_code=response.status_code)
+
+    try:
+        for chunk in _iter_chunks(response, _stream_config["chunk_size"]):
+            # The first segment reads from a response for the whole file, so it stops at the end of its range
+            chunk = chunk[:end + 1 - offset]
+            download_admission.throttle(len(chunk))
+
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+            segment[2] += len(chunk)
+
+            if reservation is not None:
+                reservation.consume(len(chunk))
+
+            if offset > end or stop_event.is_set():
+                break
+    finally:
+        response.close()
+
+    if offset <= end and not stop_event.is_set():
+        raise DownloadError("Incomplete download of {}, range {}-{} stopped at {}".format(url, start, end, offset))
+
+
+def _download_segmented(url, partial_filename, segments, params=None, validator=None, first_response=None, hasher=None, reservation=None, metadata=None):
+    """
+    Fetches the segments over parallel connections into the partial file, which is preallocated when the download
+    starts with first_response, whose body becomes the first segment. Returns the size of the file
+
+    With metadata, the segments and how far each got are kept next to the partial file for download_url_resumable,
+    and brought up to date every SEGMENT_PROGRESS_INTERVAL seconds while the segments are fetched
+
+    The ranges arrive out of order, so the checksum can only be had by reading the finished file back. That is only
+    done with configure_stream(hash_segments=True), otherwise the hasher is marked unknown
+    """
+    total_length = segments[-1][1] + 1
+
+    if first_response is not None:
+        with open(partial_filename, "wb") as f:
+            if _preallocate(f, total_length) and reservation is not None:
+                reservation.consume(total_length)
+
+    if metadata is not None:
+        metadata["segments"] = segments
+        _write_partial_metadata(partial_filename, metadata)
+
+    # The first failure stops the other segments, whatever they got so far is kept
+    stop_event = threading.Event()
+
+    def _fetch(segment, response):
+        try:
+            _fetch_segment(url, fd, segment, params, validator, reservation, stop_event, response=response)
+        except:
+            stop_event.set()
+            raise
+
+    fd = os.open(partial_filename, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=len(segments), thread_name_prefix="segment") as executor:
+            futures = [executor.submit(_fetch, segment, first_response if i == 0 else None) for i, segment in enumerate(segments)]
+
+            while len(wait(futures, timeout=SEGMENT_PROGRESS_INTERVAL).not_done) > 0:
+                if metadata is not None:
+                    _write_partial_metadata(partial_filename, metadata)
+
+            errors = [future.exception() for future in futures]
+    finally:
+        os.close(fd)
+
+        if metadata is not None:
+            _write_partial_metadata(partial_filename, metadata)
+
+    for error in errors:
+        if error is not None:
+            raise error
+
+    if hasher is not None:
+        if _stream_config["hash_segments"]:
+            _hash_file(partial_filename, hasher)
+        else:
+            hasher.mark_unknown()
+
+    return total_length
+
+
+def download_url_to_file(url, target_filename, params=None, require_ok=False, hasher=None, segmented=True):
+    """
+    Downloads url into target_filename, local sources are copied directly, returns the number of bytes written
+
+    With require_ok, anything but a 200 raises a DownloadError instead of writing the error body to disk,
+    and a DownloadError is raised if we get fewer bytes than the Content-Length
+    """
+    local_path = _local_source_path(url)
+    if local_path is not None:
+        return _place_local_source(local_path, target_filename, hasher=hasher)
+
+    r, reservation = _get_admitted(url, target_filename, params=params)
+    try:
+        if require_ok and r.status_code != 200:
+            raise DownloadError("Error downloading {} status {}".format(url, r.status_code), status_code=r.status_code)
+
+        expected_length = _expected_length(r)
+        if segmented and _can_segment(r, expected_length):
+            try:
+                return _download_segmented(url, target_filename, _split_segments(expected_length), params=params, validator=_range_validator(r),
+                                           first_response=r, hasher=hasher, reservation=reservation)
+            except RangeNotSupportedError as e:
+                print(e, "downloading in a single stream")
+                fall_back = True
+        else:
+            bytes_written = stream_response_to_file(r, target_filename, hasher=hasher, reservation=reservation)
+            fall_back = False
+    finally:
+        r.close()
+        reservation.release()
+
+    if fall_back:
+        return download_url_to_file(url, target_filename, params=params, require_ok=require_ok, hasher=hasher, segmented=False)
+
+    expected_length = _expected_length(r)
+    if expected_length is not None and bytes_written != expected_length:
+        raise DownloadError("Incomplete download of {}, got {} of {} bytes".format(url, bytes_written, expected_length))
+
+    return bytes_written
+
+
+def _partial_metadata_filename(partial_filename):
+    return partial_filename + ".json"
+
+
+def _read_partial_metadata(partial_filename):
+    try:
+        with open(_partial_metadata_filename(partial_filename)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_partial_metadata(partial_filename, metadata):
+    # Writing to a temp file first, a process killed halfway through a write must not lose the progress
+    metadata_filename = _partial_metadata_filename(partial_filename)
+    temp_filename = metadata_filename + ".tmp"
+    with open(temp_filename, "w") as f:
+        json.dump(metadata, f)
+    os.replace(temp_filename, metadata_filename)
+
+
+def remove_partial(partial_filename):
+    for filename in [partial_filename, _partial_metadata_filename(partial_filename), _partial_metadata_filename(partial_filename) + ".tmp"]:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def _parse_content_range(response):
+    # Content-Range: bytes 100-199/200, the total can be * when the server does not know it
+    match = re.match(r"bytes (\d+)-(\d+)/(\d+|\*)", response.headers.get("Content-Range", ""))
+    if match is None:
+        return None, None
+
+    total = None if match.group(3) == "*" else int(match.group(3))
+
+    return int(match.group(1)), total
+
+
+def _unallocated_bytes(partial_filename, segments):
+    missing_bytes = sum(end + 1 - start - written for start, end, written in segments)
+    unallocated_bytes = segments[-1][1] + 1 - os.stat(partial_filename).st_blocks * 512
+
+    return max(0, min(missing_bytes, unallocated_bytes))
+
+
+def download_url_resumable(url, partial_filename, params=None, require_ok=False, hasher=None, segmented=True):
+    """
+    Downloads url into partial_filename, continuing from whatever a previous interrupted attempt left behind
+
+    The ETag/Last-Modified and expected size are kept next to the partial file so that we only resume against the
+    same remote file, and a DownloadError is raised if we end up with fewer bytes than the server promised.
+    On failure the partial file is kept so the next attempt can pick up from there.
+    With require_ok, an error status raises a DownloadError instead of writing the error body to disk.
+    With a hasher, it ends up with the checksum of the whole file, the part a previous attempt left behind is read back
+    from disk. Segmented downloads mark the hasher unknown unless configure_stream(hash_segments=True).
+    Large files are fetched in segments over parallel connections when the server supports byte ranges, and an
+    interrupted segmented download carries on with each segment from where it stopped.
+
+    Returns the total size of the downloaded file
+    """
+    local_path = _local_source_path(url)
+    if local_path is not None:
+        return _place_local_source(local_path, partial_filename, hasher=hasher)
+
+    resume_from = 0
+    metadata = _read_partial_metadata(partial_filename)
+
+    if metadata is not None and metadata.get("segments") is not None and os.path.isfile(partial_filename):
+        # The space for the ranges still missing, unless it was preallocated when the download started
+        reservation = download_admission.reserve(partial_filename, _unallocated_bytes(partial_filename, metadata["segments"]))
+        try:
+            print("Resuming segmented download of", url)
+            return _download_segmented(url, partial_filename, metadata["segments"], params=params, validator=metadata.get("validator"),
+                                       hasher=hasher, reservation=reservation, metadata=metadata)
+        except RangeNotSupportedError:
+            print("Unable to resume download of", url, "starting over")
+            remove_partial(partial_filename)
+            metadata = None
+        finally:
+            reservation.release()
+    if metadata is not None and os.path.isfile(partial_filename):
+        resume_from = os.path.getsize(partial_filename)
+
+        if metadata.get("content_length") is not None and resume_from > metadata["content_length"]:
+            resume_from = 0
+
+    # Byte offsets are only meaningful without content encoding
+    headers = {"Accept-Encoding": "identity"}
+    if resume_from > 0:
+        headers["Range"] = "bytes={}-".format(resume_from)
+
+        validator = metadata.get("etag") or metadata.get("last_modified")
+        if validator is not None:
+            headers["If-Range"] = validator
+
+    r, reservation = _get_admitted(url, partial_filename, params=params, headers=headers)
+    try:
+        etag = r.headers.get("ETag")
+
+        if resume_from > 0 and r.status_code == 416 and resume_from == metadata.get("content_length"):
+            # We already have everything
+            if hasher is not None:
+                _hash_file(partial_filename, hasher)
+            return resume_from
+
+        # An error answer says nothing about the bytes we have, e.g. a host that is overloaded for a moment
+        if resume_from > 0 and r.status_code not in (200, 206):
+            raise DownloadError("Error resuming download of {} status {}".format(url, r.status_code), status_code=r.status_code)
+
+        range_start, total_length = _parse_content_range(r)
+        same_file = metadata is not None and (etag is None or metadata.get("etag") in (None, etag))
+
+        if resume_from > 0 and r.status_code == 206 and range_start == resume_from and same_file:
+            print("Resuming download of", url, "from byte", resume_from)
+        else:
+            if resume_from > 0:
+                print("Unable to resume download of", url, "starting over")
+            resume_from = 0
+
+            total_length = _expected_length(r)
+
+        if require_ok and r.status_code not in (200, 206):
+            raise DownloadError("Error downloading {} status {}".format(url, r.status_code), status_code=r.status_code)
+
+        partial_metadata = {
+            "etag": etag,
+            "last_modified": r.headers.get("Last-Modified"),
+            "content_length": total_length,
+        }
+
+        fall_back = False
+        if resume_from == 0 and segmented and _can_segment(r, total_length):
+            partial_metadata["validator"] = _range_validator(r)
+            try:
+                return _download_segmented(url, partial_filename, _split_segments(total_length), params=params, validator=_range_validator(r),
+                                           first_response=r, hasher=hasher, reservation=reservation, metadata=partial_metadata)
+            except RangeNotSupportedError as e:
+                print(e, "downloading in a single stream")
+                remove_partial(partial_filename)
+                fall_back = True
+        else:
+            if r.status_code in (200, 206):
+                _write_partial_metadata(partial_filename, partial_metadata)
+            else:
+                remove_partial(partial_filename)
+
+            # The bytes we already have are part of the checksum too
+            if hasher is not None and resume_from > 0:
+                _hash_file(partial_filename, hasher, length=resume_from)
+
+            # Not preallocating, the size on disk is what tells us where to resume from
+            bytes_written = stream_response_to_file(r, partial_filename, resume_from=resume_from, preallocate=False, hasher=hasher, reservation=reservation)
+    finally:
+        r.close()
+        reservation.release()
+
+    if fall_back:
+        return download_url_resumable(url, partial_filename, params=params, require_ok=require_ok, hasher=hasher, segmented=False)
+
+    downloaded_size = resume_from + bytes_written
+    if total_length is not None and downloaded_size != total_length:
+        raise DownloadError("Incomplete download of {}, got {} of {} bytes".format(url, downloaded_size, total_length))
+
+    return downloaded_size
+
+
+def download_url_to_file_atomic(url, target_filename, params=None):
+    """
+    Downloads into a temp file next to target_filename and only renames it into place once it is complete,
+    so an interrupted download never leaves a partial file at the target
+    """
+    target_folder = os.path.dirname(target_filename)
+    temp_filename = os.path.join(target_folder, "temp_" + str(uuid.uuid4()))
+
+    try:
+        bytes_written = download_url_to_file(url, temp_filename, params=params, require_ok=True)
+        os.replace(temp_filename, target_filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+    return bytes_written
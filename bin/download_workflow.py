@@ -0,0 +1,945 @@
+"""The downloads of the command line, download_client and download_daemon, from a single USI up to a whole run."""
+import sys
+import os
+import errno
+from collections import defaultdict, deque
+import shutil
+import uuid
+import time
+import threading
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import download_raw
+import http_session
+import host_control
+import download_resolver
+import download_stream
+import vendor_conversion
+import cache_manager
+import download_locks
+import file_validation
+import file_linking
+import download_admission
+import download_metrics
+from sanitize_filename import sanitize
+
+# With --parallel, how many USIs per worker are read ahead of the downloads
+QUEUED_PER_WORKER = 4
+
+def _determine_download_url(usi):
+    # Getting the path to the original file, this is memoized per MRI so all the call sites share one dashboard request
+    with download_metrics.phase("resolve"):
+        return download_resolver.determine_download_url(usi)
+
+def _determine_dataset_reconstructed_foldername(usi):
+    """
+    We are going to get the folder name that contains the datasetid together with the original folder structure in the usi
+    """ 
+
+    usi_splits = usi.split(":")
+    dataset_id = usi_splits[1]
+    fileportion = usi_splits[2]
+    folder_name = os.path.dirname(fileportion)
+    data_folder = os.path.join(dataset_id, folder_name)
+
+    return data_folder
+
+def _determine_ms_filename(usi):
+    """
+    We are going to get the URL and the filename, the URL will be omitted if we can figure it out with an API call
+    """
+
+    usi_splits = usi.split(":")
+    fileportion = usi_splits[2]
+
+    # Checking if filename is valid extension that we could infer the filename
+    lower_fileportion = fileportion.lower()
+    if lower_fileportion.endswith(".mzml") or lower_fileportion.endswith(".mzxml") or lower_fileportion.endswith(".mgf") or \
+        lower_fileportion.endswith(".d") or lower_fileportion.endswith(".wiff") or lower_fileportion.endswith(".raw"):
+        fileportion = os.path.basename(fileportion)
+
+        # make this safe on disk
+        fileportion = sanitize(fileportion)
+
+        return fileportion
+
+    # Checking if we can get the filename from the API
+    download_url = _determine_download_url(usi)
+   
+    if download_url is None:
+        return None
+
+    if "metabolomicsworkbench.org" in download_url:
+        # Lets parse the arguments, using urlparse
+        from urllib.parse import urlparse, parse_qs
+        parsed_params = urlparse(download_url)
+        filename = parse_qs(parsed_params.query)['F'][0]
+
+        filename = os.path.basename(filename)
+
+        # make this safe on disk
+        filename = sanitize(filename)
+
+        return filename
+
+    # MassIVE and GNPS
+    if "massive.ucsd.edu" in download_url:
+        # Lets parse the arguments, using urlparse
+        from urllib.parse import urlparse, parse_qs
+        parsed_params = urlparse(download_url)
+        filename = parse_qs(parsed_params.query)['file'][0]
+
+        filename = os.path.basename(filename)
+
+        # make this safe on disk
+        filename = sanitize(filename)
+
+        return filename
+    
+    # Norman
+    if "files.dsfp.norman-data.eu" in download_url:
+        # Lets parse the arguments, using urlparse
+        from urllib.parse import urlparse, parse_qs
+        # removing parameters
+        parsed_params = urlparse(download_url)
+        filename = parsed_params.path
+        
+        filename = os.path.basename(filename)
+
+        # make this safe on disk
+        filename = sanitize(filename)
+
+        return filename
+
+    # TODO: Work for PRIDE
+    # TODO: Work for Metabolights
+
+    return os.path.basename(download_url)
+
+def _determine_caching_paths(usi, cache_directory, target_filename):
+    # Make sure usi is actually only the MRI portions, or else we can get a bunch of repetition
+    stripped_mri = download_resolver.strip_mri(usi)
+
+    namespace = uuid.UUID('6ba7b810-9dad-11d1-80b4-00c04fd430c8')
+    hashed_id = str(uuid.uuid3(namespace, stripped_mri)).replace("-", "")
+
+    # embedding with one level of hierarchy
+    hash_folder = hashed_id[:2]
+
+    cache_path = os.path.join(cache_directory, hash_folder)
+    cache_path = os.path.realpath(cache_path)
+
+    cache_filename = os.path.join(cache_path, hashed_id + "-" + target_filename[-50:].rstrip())
+
+    return cache_filename, cache_path
+
+def _determine_partial_filename(mri, target_filename):
+    # The partial download is named after the MRI so an interrupted download can be resumed by the next run,
+    # and it sits next to the target so promoting it is a rename on the same filesystem
+    namespace = uuid.UUID('6ba7b810-9dad-11d1-80b4-00c04fd430c8')
+    hashed_id = str(uuid.uuid3(namespace, download_resolver.strip_mri(mri))).replace("-", "")
+
+    return os.path.join(os.path.dirname(os.path.abspath(target_filename)), ".partial_" + hashed_id)
+
+def _download(mri, target_filename, datafile_extension, download_info=None):
+    """
+    Downloads the MRI to target_filename, converting vendor formats, and returns a status code
+
+    0 is success, 99 the download was empty or too small to be a file we recognize, 98 the conversion was not ready,
+    97 the content is not the format we expected, e.g. an html error page
+
+    If download_info is a dictionary, the checksum of the downloaded file is added to it
+    """
+    partial_filename = _determine_partial_filename(mri, target_filename)
+    hasher = file_validation.new_hasher()
+
+    if datafile_extension.lower() == ".mzml":
+        return_value = _download_mzml(mri, partial_filename, hasher=hasher)
+    elif datafile_extension.lower() == ".mzxml":
+        return_value = _download_mzml(mri, partial_filename, hasher=hasher)
+    elif datafile_extension.lower() == ".mgf":
+        return_value = _download_mzml(mri, partial_filename, hasher=hasher)
+    elif datafile_extension.lower() == ".d":
+        return_value = _download_vendor(mri, partial_filename, hasher=hasher)
+    elif datafile_extension.lower() == ".wiff":
+        return_value = _download_vendor(mri, partial_filename, hasher=hasher)
+    elif datafile_extension.lower() == ".raw":
+        return_value = _download_vendor(mri, partial_filename, hasher=hasher)
+    else:
+         raise Exception("Unsupported")
+
+    if return_value == 98:
+        # Nothing was downloaded, any earlier partial download is kept to resume from
+        return return_value
+    
+    # Now we can try to move this file from the temp to the target
+    # return_value is 0 even when the mri is invalid. 
+    # And when the mri is invalid, MassIVE returns a html file that contains error message
+    # and MTBLS return a small file that contains a message indicating that the no permission to access the requested resource
+    # and the ST/MWB returns nothing
+    # so we sniff the first bytes to make sure it is the format we expect before moving it to the final location,
+    # otherwise just delete the temp file
+    with download_metrics.phase("finalize"):
+        return _finalize_download(mri, partial_filename, target_filename, download_info=download_info, hasher=hasher)
+
+def _finalize_download(mri, partial_filename, target_filename, download_info=None, hasher=None):
+    """
+    Moves the partial download into place if it looks like the file we expected, returns the status code like _download
+    """
+    return_value = 0
+    invalid_reason = file_validation.validate_file(partial_filename, file_validation.expected_format(target_filename))
+
+    if invalid_reason is not None:
+        print(f"{mri} downloading failed ({invalid_reason}), remove temporary file {partial_filename}")
+        if invalid_reason in ["empty", "too small"]:
+            return_value = 99
+        else:
+            return_value = 97
+        download_stream.remove_partial(partial_filename)
+    else:
+        print(f"{mri} downloaded successfully to target location at {target_filename}")
+        shutil.move(partial_filename, target_filename)
+        download_stream.remove_partial(partial_filename)
+
+        if download_info is not None:
+            download_info["checksum"] = hasher.hexdigest()
+    return return_value
+
+def _download_mzml(usi, target_filename, hasher=None):
+    # here we don't need to do any conversion and can get directly from the source
+    download_url = _determine_download_url(usi)
+    
+    # This picks up from an earlier interrupted download if there is one, and raises if the download is incomplete
+    download_metrics.set_host(download_url)
+    with download_metrics.phase("transfer"):
+        downloaded_size = download_stream.download_url_resumable(download_url, target_filename, hasher=hasher)
+    download_metrics.add_bytes(downloaded_size)
+    
+    # is it possible to check if the download failed or not and return different value accordingly
+    return 0
+
+def _determine_target_subfolder(usi):
+    # to determine the target subfolder based on the source of the dataset
+    # a dataset starts with "MSV" goes to massive subfolder, a dataset starts with "MTBLS" goes to MTBLS subfolder 
+    # and a dataset starts with "ST" goes to ST subfoldre
+    target_subfolder = "other"
+    if usi.startswith("mzspec:MSV"):
+        target_subfolder = "MassIVE" # GNPS is also MassIVE
+    elif usi.startswith("mzspec:MTBLS"):
+        target_subfolder = "MTBLS"
+    elif usi.startswith("mzspec:ST"):
+        target_subfolder = "ST"
+    elif usi.startswith("mzspec:NORMAN"):
+        target_subfolder = "NORMAN"
+    else:
+        target_subfolder = "other"
+
+    return target_subfolder
+
+    
+def _download_vendor(mri, target_filename, hasher=None):
+    # we do need to do conversion so we'll hit the conversion service to 
+    params = {}
+    params["mri"] = download_resolver.strip_mri(mri)
+
+    # waiting for the status, with --pipeline_conversions this was already requested up front
+    # the parallel slots go to other downloads in the meantime
+    with download_metrics.phase("conversion_wait"), download_locks.released_slots():
+        conversion_ready = vendor_conversion.wait_for_conversion(mri)
+
+    if not conversion_ready:
+        print("Conversion still pending, trying the download anyway")
+
+    # Lets download
+    download_url = vendor_conversion.conversion_download_url()
+    download_metrics.set_host(download_url)
+
+    try:
+        with download_metrics.phase("transfer"):
+            downloaded_size = download_stream.download_url_resumable(download_url, target_filename, params=params, require_ok=True, hasher=hasher)
+        download_metrics.add_bytes(downloaded_size)
+    except download_stream.DownloadError as e:
+        if e.status_code is None:
+            raise
+
+        print("CONVERSION not ready")
+        # change the return value from "CONVERSION NOT READY" to 98
+        return 98
+
+    # change return value to 0 from original "CONVERTED"
+    return 0
+
+def _download_error_status(return_value):
+    if return_value == 99:
+        # downloaded data file is too small
+        print(f"File size might be too small")
+        return "ERROR_DATA_TOO_SMALL"
+    elif return_value == 98:
+        # data file conversion is incorrect
+        print(f"Vendor conversion not ready")
+        return "ERROR_CONVERSION_NOT_READY"
+    elif return_value == 97:
+        # e.g. an html error page instead of the data
+        print(f"Downloaded data is not the expected format")
+        return "ERROR_DATA_INVALID"
+
+    return "DOWNLOAD_ERROR"
+
+def _verify_cache_entry(cache_directory, cache_filename, full_verify=False):
+    """
+    Cheap checks that a cache entry is what it claims to be, the format from the first bytes and the size in the index,
+    with full_verify the checksum recorded at download time is checked as well
+    """
+    if file_validation.validate_file(cache_filename, file_validation.expected_format(cache_filename)) is not None:
+        return False
+
+    try:
+        cache_entry = cache_manager.get_cache_index(cache_directory).get_entry(cache_filename)
+    except (sqlite3.Error, OSError):
+        return True
+
+    if cache_entry is None:
+        return True
+
+    if cache_entry["file_size"] is not None and cache_entry["file_size"] != os.path.getsize(cache_filename):
+        return False
+
+    if full_verify and cache_entry["checksum"] is not None and cache_entry["checksum"] != file_validation.file_checksum(cache_filename):
+        return False
+
+    return True
+
+def _record_cache_use(cache_directory, cache_filename, usi, target_path, downloaded=False, checksum=None):
+    # Keeping the cache index up to date for eviction, this is best effort since the cache might be read only
+    try:
+        cache_index = cache_manager.get_cache_index(cache_directory)
+
+        if downloaded:
+            cache_index.record_entry(cache_filename, download_resolver.strip_mri(usi), checksum=checksum)
+        else:
+            cache_index.record_access(cache_filename, mri=download_resolver.strip_mri(usi))
+
+        # The links from the output folders keep the file from being evicted
+        if os.path.islink(target_path):
+            cache_index.record_link(cache_filename, target_path)
+    except (sqlite3.Error, OSError) as e:
+        print("Unable to update cache index", e, file=sys.stderr)
+
+def _determine_target_filename(usi, extension_filter=None, noconversion=False):
+    """
+    Returns the target filename, which is the converted name for vendor formats, the original extension, and whether
+    the raw vendor files are downloaded as is. The target filename is None when the extension is filtered out
+    """
+    ms_filename = _determine_ms_filename(usi)
+
+    if extension_filter is not None:
+        if not ms_filename.lower().endswith(extension_filter):
+            return None, None, False
+
+    # Here we determine the actual extension of the ms_filename
+    filename_without_extension, mri_original_extension = os.path.splitext(ms_filename)
+
+    if mri_original_extension.lower() in [".d", ".wiff", ".raw"]:
+        if noconversion:
+            return ms_filename, mri_original_extension, True
+
+        return filename_without_extension + ".mzML", mri_original_extension, False
+
+    return ms_filename, mri_original_extension, False
+
+def _determine_target_dir(usi, args):
+    """
+    Output folder of the USI depending on --nestfiles, None when the USI cannot be placed in the recreated structure
+    """
+    target_folder = args.output_folder 
+
+    if args.nestfiles == "nest":
+        usi_hash = uuid.uuid3(uuid.NAMESPACE_DNS, usi)
+        folder_hash = str(usi_hash)[:2]
+
+        return os.path.join(target_folder, folder_hash)
+    elif args.nestfiles == "recreate":
+        target_subfolder_name = _determine_target_subfolder(usi)
+        target_folder = os.path.join(args.output_folder, target_subfolder_name)
+        if target_subfolder_name == "other":
+            return None
+        
+        # recreate the folder structure
+        # add data source folder to output_folder
+        dataset_folder = _determine_dataset_reconstructed_foldername(usi)
+
+        return os.path.join(target_folder, dataset_folder)
+
+    # flat as default
+    return target_folder
+
+_created_directories = set()
+_created_directories_lock = threading.Lock()
+
+def _ensure_directory(target_dir):
+    # Each output directory is only created once per run, the planning pass creates all of them up front
+    with _created_directories_lock:
+        if target_dir in _created_directories:
+            return
+
+    os.makedirs(target_dir, exist_ok=True)
+
+    with _created_directories_lock:
+        _created_directories.add(target_dir)
+
+def download_helper(usi, args, extension_filter=None, noconversion=False, dryrun=False):
+    processdownloadraw = False
+
+    try:
+        if len(usi) < 5:
+            return None
+    
+        output_result_dict = {}
+        output_result_dict["usi"] = usi
+        target_filename = None # This is the target converted filename
+        mri_original_extension = None
+
+        # Failing fast on anything the up front resolution could not find
+        if download_resolver.is_unresolvable(usi):
+            print("Unable to resolve download link for", usi, file=sys.stderr)
+            output_result_dict["status"] = "ERROR_UNRESOLVABLE"
+            return output_result_dict
+
+        # USI Filename
+        try:
+            target_filename, mri_original_extension, processdownloadraw = _determine_target_filename(usi, extension_filter=extension_filter, noconversion=noconversion)
+
+            # Filtering extensions
+            if target_filename is None:
+                return None
+        except (KeyboardInterrupt, host_control.HostUnavailableError):
+            raise
+        except Exception as e:
+            print("Error determining ms filename for", usi, e, file=sys.stderr)
+            output_result_dict["status"] = "ERROR"
+            return output_result_dict
+
+        if target_filename is not None:
+            target_dir = _determine_target_dir(usi, args)
+            if target_dir is None:
+                return None
+
+            _ensure_directory(target_dir)
+
+            target_path = os.path.join(target_dir, target_filename)
+
+            output_result_dict["target_path"] = target_path
+
+            if os.path.exists(target_path):
+                output_result_dict["status"] = "EXISTS_IN_OUTPUT"
+
+            # Checking if the file is already in the dataset directory
+            if args.existing_dataset_directory is not None:
+                # Checking
+                print("Checking existing dataset directory")
+                path_in_dataset_folder = _determine_dataset_reconstructed_foldername(usi)
+                collection_name = _determine_target_subfolder(usi)
+
+                # Checking the in memory index rather than the filesystem, the dataset directory is often a network mount
+                import dataset_index
+                dataset_filepath = dataset_index.get_dataset_index(args.existing_dataset_directory).lookup(collection_name, path_in_dataset_folder, target_filename)
+
+                if dataset_filepath is not None:
+                    print(dataset_filepath, "exists")
+
+                    # Let's link it into the output
+                    if not os.path.exists(target_path):
+                        file_linking.link_file(dataset_filepath, target_path)
+
+                    output_result_dict["status"] = "EXISTS_IN_DATASET"
+
+                    return output_result_dict
+
+            # Checking the cache, raw vendor downloads are not cached since they can be whole folders
+            if args.cache_directory is not None and os.path.exists(args.cache_directory) and not processdownloadraw:
+                print("Checking in the cache now")
+
+                cache_filename, cache_directory = _determine_caching_paths(usi, args.cache_directory, target_filename)
+
+                output_result_dict["cache_filename"] = os.path.basename(cache_filename)
+
+                # Making sure we never link to a bad cache entry, it gets downloaded again instead
+                if os.path.exists(cache_filename) and not _verify_cache_entry(args.cache_directory, cache_filename, full_verify=args.verify_cache):
+                    print("Removing invalid cache entry", cache_filename, file=sys.stderr)
+                    try:
+                        with download_locks.cache_entry_lock(cache_filename):
+                            os.remove(cache_filename)
+                            cache_manager.get_cache_index(args.cache_directory).remove_entry(cache_filename)
+                    except (sqlite3.Error, OSError) as e:
+                        print("Unable to remove invalid cache entry", e, file=sys.stderr)
+                        output_result_dict["status"] = "ERROR_INVALID_CACHE_ENTRY"
+                        return output_result_dict
+
+                # If we find it in the cache, we can create a link to it. The entry lock keeps gc from evicting it
+                # before the link is recorded
+                with download_locks.cache_entry_lock(cache_filename):
+                    cache_hit = os.path.exists(cache_filename)
+                    if cache_hit:
+                        print("Found in cache", cache_filename)
+
+                        if not os.path.exists(target_path):
+                            file_linking.link_file(cache_filename, target_path)
+                            output_result_dict["status"] = "EXISTS_IN_CACHE"
+
+                        _record_cache_use(args.cache_directory, cache_filename, usi, target_path)
+
+                if not cache_hit:
+                    download_url = _determine_download_url(usi)
+
+                    if download_url is None:
+                        output_result_dict["status"] = "ERROR"
+                    else:
+                        # Saving file to cache if we don't have it in the cache
+                        
+                        try:
+                            # Making sure the cache directory exists
+                            if not os.path.exists(cache_directory):
+                                os.makedirs(cache_directory, exist_ok=True)
+
+                            if not dryrun:
+                                # Only one process sharing the cache downloads the entry, the others wait and then link to it
+                                with download_locks.cache_entry_lock(cache_filename):
+                                    if os.path.exists(cache_filename):
+                                        print("Downloaded into cache by another process", cache_filename)
+                                        cache_status = "EXISTS_IN_CACHE"
+                                    else:
+                                        return_value = _download(usi, cache_filename, mri_original_extension, download_info=output_result_dict)
+                                        if return_value == 0:
+                                            cache_status = "DOWNLOADED_INTO_OUTPUT_WITH_CACHE"
+                                        else:
+                                            cache_status = None
+                                            output_result_dict["status"] = _download_error_status(return_value)
+
+                                    # Linking the cache entry into the output, still under the lock so gc cannot evict it in between
+                                    if cache_status is not None and not os.path.exists(target_path):
+                                        file_linking.link_file(cache_filename, target_path)
+                                        output_result_dict["status"] = cache_status
+
+                                    if cache_status is not None and os.path.isfile(cache_filename):
+                                        _record_cache_use(args.cache_directory, cache_filename, usi, target_path,
+                                                          downloaded=(cache_status == "DOWNLOADED_INTO_OUTPUT_WITH_CACHE"), checksum=output_result_dict.get("checksum"))
+                            else:
+                                print("Would have downloaded", usi, "to", cache_filename)
+                                output_result_dict["status"] = "DRYRUN_TO_DOWNLOAD"
+
+                                return output_result_dict
+
+                        except (KeyboardInterrupt, host_control.HostUnavailableError):
+                            raise
+
+                        except download_stream.DownloadError as e:
+                            # The partial download stays in the cache for the next run to resume
+                            print(e, file=sys.stderr)
+                            output_result_dict["status"] = "DOWNLOAD_ERROR"
+
+                        except OSError as e:
+                            # Only a read only or not writable cache falls back to downloading straight into the output
+                            if e.errno not in (errno.EROFS, errno.EACCES):
+                                raise
+
+                            print("Unable to write to the cache", e, file=sys.stderr)
+                            try:
+                                if not dryrun:
+                                    return_value = _download(usi, target_path, mri_original_extension, download_info=output_result_dict)
+                                else:
+                                    print("Would have downloaded", usi, "to", cache_filename)
+                                    output_result_dict["status"] = "DRYRUN_TO_DOWNLOAD"
+
+                                    return output_result_dict
+                                
+
+                                if return_value == 0:
+                                    output_result_dict["status"] = "CACHE_ERROR_DOWNLOAD_DIRECT"
+                                else:
+                                    output_result_dict["status"] = _download_error_status(return_value)
+                            except (KeyboardInterrupt, host_control.HostUnavailableError, download_admission.DiskSpaceError):
+                                raise
+                            except:
+                                output_result_dict["status"] = "DOWNLOAD_ERROR"
+
+            # No Caching
+            else:
+                # if the target path file is already there, then we don't need to do anything
+                if os.path.exists(target_path):
+                    output_result_dict["status"] = "EXISTS_IN_OUTPUT"
+                else:
+                    if processdownloadraw:
+                        print("Downloading the raw data without conversion", target_path)
+
+                        if not dryrun:
+                            try:
+                                with download_metrics.phase("transfer"):
+                                    download_raw.download_raw_mri(usi, target_path, cache_url=vendor_conversion.DATASET_CACHE_URL_BASE, bundle_parallel=args.bundle_parallel)
+                                download_metrics.add_bytes(download_metrics.path_size(target_path))
+                                output_result_dict["status"] = "DOWNLOADED_INTO_OUTPUT_WITHOUT_CACHE"
+                            except download_stream.DownloadError as e:
+                                print(e, file=sys.stderr)
+                                output_result_dict["status"] = "DOWNLOAD_ERROR"
+                        else:
+                            print("Would have downloaded", usi, "to", target_path)
+                            output_result_dict["status"] = "DRYRUN_TO_DOWNLOAD"
+
+                        return output_result_dict
+
+                    download_url = _determine_download_url(usi)
+
+                    if download_url is None:
+                        output_result_dict["status"] = "ERROR"
+                    else:
+                        
+                        if not dryrun:
+                            # download in chunks using requests
+                            return_value = _download(usi, target_path, mri_original_extension, download_info=output_result_dict)
+                        else:
+                            print("Would have downloaded", usi, "to", target_path)
+                            output_result_dict["status"] = "DRYRUN_TO_DOWNLOAD"
+
+                            return output_result_dict
+                        
+                        if return_value == 0:
+                            output_result_dict["status"] = "DOWNLOADED_INTO_OUTPUT_WITHOUT_CACHE"
+                        else:
+                            output_result_dict["status"] = _download_error_status(return_value)
+
+
+        else:
+            output_result_dict["status"] = "ERROR"
+    except KeyboardInterrupt:
+        raise
+    except host_control.HostUnavailableError as e:
+        print(e, file=sys.stderr)
+        output_result_dict["status"] = "ERROR_HOST_UNAVAILABLE"
+    except download_admission.DiskSpaceError as e:
+        print(e, file=sys.stderr)
+        output_result_dict["status"] = "ERROR_DISK_SPACE"
+    except Exception as e:
+        print("Error", e, file=sys.stderr)
+        output_result_dict["status"] = "ERROR"
+    finally:    
+        return output_result_dict
+
+def parse_host_limits(host_parallel, parallel):
+    """
+    Parses the per host concurrency caps, formatted as a semicolon separated list, e.g. MassIVE=4;ST=2;NORMAN=1
+
+    Hosts are the collection names from _determine_target_subfolder, anything not listed gets the global parallel limit
+    """
+    host_limits = {}
+
+    if host_parallel is None:
+        return host_limits
+
+    for host_limit in host_parallel.split(";"):
+        host_limit = host_limit.strip()
+        if len(host_limit) == 0:
+            continue
+
+        host, limit = host_limit.split("=")
+        host_limits[host.strip()] = max(1, min(int(limit), parallel))
+
+    return host_limits
+
+def download_host(usi):
+    # The host a USI counts against for the --host_parallel limits
+    return _determine_target_subfolder(usi)
+
+def _determine_target_path(usi, config, extension_filter):
+    # Where download_helper puts the USI with these options, None when it is not placed anywhere or we cannot tell yet
+    try:
+        target_filename, _, _ = _determine_target_filename(usi, extension_filter=extension_filter, noconversion=config.noconversion)
+    except KeyboardInterrupt:
+        raise
+    except:
+        # download_helper runs into the same error and reports it
+        return None
+
+    if target_filename is None:
+        return None
+
+    target_dir = _determine_target_dir(usi, config)
+    if target_dir is None:
+        return None
+
+    return os.path.join(target_dir, target_filename)
+
+def download_usi(usi, config, extension_filter, ledger=None, queue_seconds=0):
+    """
+    Downloads a single USI with the options of config, a download_options.DownloadConfig, skipping it if the job ledger
+    says an earlier run already completed it. extension_filter is config.extension_filter_tuple()
+
+    The timings of the phases of the download are added to the result
+    """
+    target_path = _determine_target_path(usi, config, extension_filter) if ledger is not None else None
+    if target_path is not None:
+        completed_result = ledger.get_completed(usi, target_path=target_path)
+        if completed_result is not None:
+            print("Already completed", usi)
+            return completed_result
+
+    # The same file with different scans is only worked on by one thread at a time, the later ones then find it in place
+    with download_metrics.track_usi(usi, queue_seconds=queue_seconds) as usi_metrics:
+        with download_locks.key_lock(download_resolver.strip_mri(usi)):
+            result = download_helper(usi, config, extension_filter, noconversion=config.noconversion, dryrun=config.dryrun)
+
+    if result is not None:
+        result.update(usi_metrics.columns())
+
+    if ledger is not None and result is not None and not config.dryrun:
+        ledger.record(usi, result, download_url=download_resolver.cached_download_url(usi), checksum=result.get("checksum"))
+
+    return result
+
+def _iter_download_parallel(usis, config, extension_filter, ledger=None):
+    """
+    Runs download_helper concurrently, each host has its own limit so a slow repository cannot starve the others,
+    and a global limit keeps the total number of in flight downloads at --parallel. Workers waiting on a vendor
+    conversion give their slots to other downloads in the meantime
+
+    Results are yielded in the same order as usis, which is read lazily so only a window of USIs is queued at a time
+    """
+    download_slots = download_locks.DownloadSlots(config.parallel, parse_host_limits(config.host_parallel, config.parallel))
+    max_queued = config.parallel * QUEUED_PER_WORKER
+
+    def _run(usi, submit_time):
+        with download_slots.hold(download_host(usi)):
+            print("Downloading", usi)
+            return download_usi(usi, config, extension_filter, ledger=ledger, queue_seconds=time.monotonic() - submit_time)
+
+    # Every queued USI has a thread, the slots decide which of them are downloading
+    executor = ThreadPoolExecutor(max_workers=max_queued, thread_name_prefix="download")
+
+    # Keeping the input ordering for the summary
+    futures = deque()
+    try:
+        for usi in usis:
+            if len(usi) < 5:
+                continue
+
+            futures.append(executor.submit(_run, usi, time.monotonic()))
+
+            while len(futures) >= max_queued:
+                result = futures.popleft().result()
+                if result is not None:
+                    yield result
+
+        while len(futures) > 0:
+            result = futures.popleft().result()
+            if result is not None:
+                yield result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def _download_parallel(usi_list, config, extension_filter, ledger=None):
+    return list(_iter_download_parallel(usi_list, config, extension_filter, ledger=ledger))
+
+def _iter_download_sequential(usis, config, extension_filter, ledger=None):
+    for usi in usis:
+        print("Downloading", usi)
+
+        if len(usi) < 5:
+            continue
+
+        result = download_usi(usi, config, extension_filter, ledger=ledger)
+        if result is not None:
+            yield result
+
+def iter_downloads(usis, config, extension_filter, ledger=None):
+    """
+    Downloads the USIs like download_usi and yields their results, USIs whose host was unavailable are parked and retried once its circuit breaker lets requests
+    through again, so their results come at the end
+    """
+    if config.parallel > 1:
+        results = _iter_download_parallel(usis, config, extension_filter, ledger=ledger)
+    else:
+        results = _iter_download_sequential(usis, config, extension_filter, ledger=ledger)
+
+    parked_usis = []
+    for result in results:
+        if result["status"] == "ERROR_HOST_UNAVAILABLE":
+            parked_usis.append(result["usi"])
+        else:
+            yield result
+
+    if len(parked_usis) == 0:
+        return
+
+    recovery_delay = host_control.recovery_delay()
+    print("Retrying", len(parked_usis), "files from unavailable hosts in", int(recovery_delay), "seconds")
+    time.sleep(recovery_delay)
+
+    if config.parallel > 1:
+        yield from _iter_download_parallel(parked_usis, config, extension_filter, ledger=ledger)
+    else:
+        yield from _iter_download_sequential(parked_usis, config, extension_filter, ledger=ledger)
+
+def prepare_batch(usi_batch, config):
+    # Bulk resolution and conversion requests for a batch of USIs, before they are downloaded
+    if config.resolve_first:
+        resolved = download_resolver.resolve_download_urls(usi_batch, parallel=config.resolve_parallel)
+        resolved_count = len([mri for mri in resolved if resolved[mri] is not None])
+        print("Resolved", resolved_count, "of", len(resolved), "download links")
+
+    if config.pipeline_conversions and not config.noconversion and not config.dryrun:
+        submitted_count = vendor_conversion.submit_conversions(usi_batch)
+        print("Requested", submitted_count, "vendor format conversions")
+
+def iter_prepared(usis, config):
+    """
+    Resolves links with --resolve_first and requests conversions with --pipeline_conversions a batch at a time, ahead
+    of the downloads, so the input never has to be read in full
+    """
+    if not config.resolve_first and not (config.pipeline_conversions and not config.noconversion and not config.dryrun):
+        yield from usis
+        return
+
+    usi_batch = []
+    for usi in usis:
+        usi_batch.append(usi)
+
+        if len(usi_batch) >= download_resolver.DEFAULT_RESOLVE_BATCH_SIZE:
+            prepare_batch(usi_batch, config)
+            yield from usi_batch
+            usi_batch = []
+
+    if len(usi_batch) > 0:
+        prepare_batch(usi_batch, config)
+        yield from usi_batch
+
+def build_plan(usis, config, extension_filter):
+    """
+    Planning pass over all the USIs, grouping them by host and dataset, looking up the expected sizes and creating
+    every output directory once. This reads the whole input, so it only runs with --plan_output, --largest_first or --dryrun
+    """
+    # Only imported for the planning pass, a plain run never needs it
+    import download_plan
+
+    plan = download_plan.DownloadPlan()
+
+    for usi in usis:
+        # USIs that cannot be planned stay in the plan with an unknown method and size, download_helper then reports
+        # their errors, skips the filtered ones and parks the ones on an unavailable host like in a plain run
+        try:
+            target_filename, mri_original_extension, processdownloadraw = _determine_target_filename(usi, extension_filter=extension_filter, noconversion=config.noconversion)
+        except Exception as e:
+            print("Error determining ms filename for", usi, e, file=sys.stderr)
+            target_filename = None
+
+        target_dir = _determine_target_dir(usi, config) if target_filename is not None else None
+        if target_dir is None:
+            plan.add(usi, _determine_target_subfolder(usi), usi.split(":")[1] if ":" in usi else None, download_plan.METHOD_UNKNOWN, None)
+            continue
+
+        if processdownloadraw:
+            method = download_plan.METHOD_RAW
+        elif mri_original_extension.lower() in vendor_conversion.VENDOR_EXTENSIONS:
+            method = download_plan.METHOD_CONVERSION
+        else:
+            method = download_plan.METHOD_DIRECT
+
+        plan.add(usi, _determine_target_subfolder(usi), usi.split(":")[1], method, os.path.join(target_dir, target_filename))
+
+    plan.lookup_sizes(parallel=config.resolve_parallel)
+
+    for target_dir in plan.target_dirs():
+        _ensure_directory(target_dir)
+
+    return plan
+
+def add_download_arguments(parser):
+    """
+    Options shared by the command line and download_daemon.py, download_options.DownloadConfig.from_args turns them
+    into a config
+    """
+    parser.add_argument('--cache_directory', default=None, help='cache folder of existing data')
+
+    parser.add_argument('--existing_dataset_directory', default=None, help='Directory with a proper dataset structure to avoid downloading the same dataset multiple times')
+    parser.add_argument('--existing_dataset_manifest', default=None, help='Manifest of the files in --existing_dataset_directory from dataset_index.py build, instead of scanning the directory')
+
+    parser.add_argument('--nestfiles', help='Nest mass spec files in a hashed folder so its not all in the same directory', default='flat')
+    
+    parser.add_argument('--extension_filter', default=None, help="Filter to only download certain extensions. Should be formatted as a semicolon separated list")
+    
+    parser.add_argument('--noconversion', action='store_true', default=False, help="Specifying to turn off conversion and download the full raw file")
+
+    parser.add_argument('--dryrun', action='store_true', default=False, help="This is a dry run flag that does not do the actual download, but reports what is to be downloaded and what has been downloaded")
+
+    parser.add_argument('--parallel', type=int, default=1, help="Number of files to download concurrently")
+    parser.add_argument('--host_parallel', default=None, help="Per host concurrency caps when running with --parallel. Should be formatted as a semicolon separated list, e.g. MassIVE=4;ST=2;NORMAN=1")
+
+    parser.add_argument('--http_pool_size', type=int, default=http_session.DEFAULT_POOL_SIZE, help="Number of kept alive connections per host")
+    parser.add_argument('--connect_timeout', type=float, default=http_session.DEFAULT_CONNECT_TIMEOUT, help="HTTP connect timeout in seconds")
+    parser.add_argument('--read_timeout', type=float, default=http_session.DEFAULT_READ_TIMEOUT, help="HTTP read timeout in seconds")
+    parser.add_argument('--http_retries', type=int, default=http_session.DEFAULT_RETRIES, help="Number of retries with exponential backoff on connection errors and 429/5xx responses")
+
+    parser.add_argument('--host_rate', type=float, default=host_control.DEFAULT_HOST_RATE, help="Maximum requests per second to each host, 0 for no limit")
+    parser.add_argument('--host_max_concurrency', type=int, default=host_control.DEFAULT_HOST_MAX_CONCURRENCY, help="Maximum concurrent requests to each host, the actual limit adapts to the errors and latency of the host")
+    parser.add_argument('--host_latency_target', type=float, default=host_control.DEFAULT_LATENCY_TARGET, help="Seconds to the response headers above which a host is considered overloaded and gets fewer concurrent requests")
+    parser.add_argument('--breaker_failures', type=int, default=host_control.DEFAULT_FAILURE_THRESHOLD, help="Failures in a row after which requests to a host are stopped and its files are retried at the end of the run")
+    parser.add_argument('--breaker_cooldown', type=float, default=host_control.DEFAULT_BREAKER_COOLDOWN, help="Seconds before a host with a tripped circuit breaker is tried again")
+
+    parser.add_argument('--resolution_cache_file', default=None, help="JSON file to persist resolved download links across runs")
+    parser.add_argument('--resolution_cache_ttl', type=float, default=download_resolver.DEFAULT_RESOLUTION_CACHE_TTL, help="Seconds a persisted download link stays valid")
+    parser.add_argument('--resolve_first', action='store_true', default=False, help="Resolve all the download links in bulk before downloading, and fail fast on the ones that cannot be resolved")
+    parser.add_argument('--resolve_parallel', type=int, default=download_resolver.DEFAULT_RESOLVE_PARALLEL, help="Number of concurrent requests to the dashboard when resolving with --resolve_first")
+    parser.add_argument('--dashboard_url', default=None, help="Base URL of the dashboard used to resolve download links")
+
+    parser.add_argument('--bundle_parallel', type=int, default=download_raw.DEFAULT_BUNDLE_PARALLEL, help="Number of member files fetched concurrently for .d and .wiff bundles with --noconversion")
+
+    parser.add_argument('--pipeline_conversions', action='store_true', default=False, help="Request all vendor format conversions up front and poll them in the background while other files download")
+    parser.add_argument('--conversion_timeout', type=float, default=vendor_conversion.DEFAULT_CONVERSION_TIMEOUT, help="Seconds to wait for each vendor format conversion")
+    parser.add_argument('--datasetcache_url', default=None, help="Base URL of the datasetcache used for vendor format conversions and dataset listings")
+
+    parser.add_argument('--job_database', default=None, help="SQLite database recording the status of every USI as it completes, reruns with the same database skip completed files")
+
+    parser.add_argument('--cache_max_size', default=None, help="Evict files from the cache directory after the run until it fits in this size, e.g. 500G. Only links made by this tool are known, so files that were in the cache before its index existed are kept until a download uses them")
+    parser.add_argument('--cache_eviction_policy', default='lru', choices=cache_manager.EVICTION_POLICIES, help="Evict the least recently (lru) or least frequently (lfu) used files first")
+
+    parser.add_argument('--verify_cache', action='store_true', default=False, help="Verify the checksum of cache hits against the one recorded when they were downloaded")
+
+    parser.add_argument('--bandwidth_limit_mb', type=float, default=download_admission.DEFAULT_BANDWIDTH_LIMIT, help="Total MB per second across all the downloads, so co-located jobs keep some of the uplink, 0 for no limit")
+    parser.add_argument('--min_free_space', default=None, help="Free space to always leave on the output and cache filesystems, e.g. 50G, downloads that do not fit wait for the ones in flight")
+
+    parser.add_argument('--link_mode', default=file_linking.DEFAULT_LINK_MODE, choices=file_linking.LINK_MODES, help="How files from the cache, --existing_dataset_directory and local mirrors are placed in the output folder, falling back from reflink to hardlink to copy where the filesystem does not support it")
+
+    parser.add_argument('--chunk_size_mb', type=float, default=download_stream.DEFAULT_CHUNK_SIZE / 1024 / 1024, help="Size in MB of the buffer used when streaming downloads to disk")
+    parser.add_argument('--segments', type=int, default=download_stream.DEFAULT_SEGMENTS, help="Number of parallel connections large files are downloaded over as byte ranges, 1 to always use a single stream")
+    parser.add_argument('--segment_threshold_mb', type=float, default=download_stream.DEFAULT_SEGMENT_THRESHOLD / 1024 / 1024, help="Size in MB above which files are downloaded in segments")
+    parser.add_argument('--hash_segmented_downloads', action='store_true', default=False, help="Also compute the checksum of files downloaded in segments, which reads them back from disk once they are complete")
+
+def configure(config):
+    """
+    Applies the connection, host control, resolver, conversion and cache settings of config, a
+    download_options.DownloadConfig, to the modules they belong to
+
+    These are process wide, the command line, download_client and download_daemon all go through here
+    """
+    http_session.configure_session(pool_size=max(config.http_pool_size, config.parallel),
+                                   connect_timeout=config.connect_timeout,
+                                   read_timeout=config.read_timeout,
+                                   retries=config.http_retries)
+
+    host_control.configure_host_control(rate=config.host_rate,
+                                        max_concurrency=config.host_max_concurrency,
+                                        latency_target=config.host_latency_target,
+                                        failure_threshold=config.breaker_failures,
+                                        cooldown=config.breaker_cooldown)
+
+    download_resolver.configure_resolver(dashboard_url=config.dashboard_url)
+    download_stream.configure_stream(chunk_size=config.chunk_size_mb * 1024 * 1024, segments=config.segments, segment_threshold=config.segment_threshold_mb * 1024 * 1024,
+                                     hash_segments=config.hash_segmented_downloads)
+    vendor_conversion.configure_conversion(dataset_cache_url=config.datasetcache_url, timeout=config.conversion_timeout)
+    download_resolver.configure_resolution_cache(cache_file=config.resolution_cache_file, ttl=config.resolution_cache_ttl)
+    file_linking.configure_linking(mode=config.link_mode)
+    download_admission.configure_admission(bandwidth_limit=config.bandwidth_limit_mb * 1024 * 1024,
+                                           min_free_space=cache_manager.parse_size(config.min_free_space) if config.min_free_space is not None else download_admission.DEFAULT_MIN_FREE_SPACE)
+
+    # The dataset index is only loaded when there is an existing dataset directory to look files up in
+    if config.existing_dataset_directory is not None:
+        import dataset_index
+        dataset_index.configure_dataset_index(manifest=config.existing_dataset_manifest)
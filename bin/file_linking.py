@@ -0,0 +1,97 @@
+"""Placing files from the cache, the dataset directory and local mirrors into the output folder with the configured link mode."""
+import os
+import uuid
+import fcntl
+import shutil
+
+LINK_MODES = ["symlink", "hardlink", "reflink", "copy"]
+DEFAULT_LINK_MODE = "symlink"
+
+# What each mode falls back to when the filesystem refuses it, e.g. hardlinks across devices or reflinks on ext4
+FALLBACKS = {
+    "symlink": ["symlink"],
+    "hardlink": ["hardlink", "copy"],
+    "reflink": ["reflink", "hardlink", "copy"],
+    "copy": ["copy"],
+}
+
+# From linux/fs.h, shares the blocks of the source file on Btrfs and XFS
+FICLONE = 0x40049409
+
+_link_config = {
+    "mode": DEFAULT_LINK_MODE,
+}
+
+
+def configure_linking(mode=None):
+    if mode is not None:
+        _link_config["mode"] = mode
+
+
+def link_mode():
+    return _link_config["mode"]
+
+
+def clone_file(source_filename, target_filename):
+    """
+    Makes target_filename a reflink copy of source_filename, raises OSError where the filesystem does not support it
+    """
+    with open(source_filename, "rb") as source_fd, open(target_filename, "wb") as target_fd:
+        fcntl.ioctl(target_fd.fileno(), FICLONE, source_fd.fileno())
+
+
+def _place_file(source_filename, target_filename, method):
+    if method == "hardlink":
+        os.link(source_filename, target_filename)
+    elif method == "reflink":
+        clone_file(source_filename, target_filename)
+    else:
+        # copyfile stays in the kernel with sendfile on Linux
+        shutil.copyfile(source_filename, target_filename)
+
+
+def _place_tree(source_folder, target_folder, method):
+    # Vendor .d folders are placed file by file
+    for root, dirs, files in os.walk(source_folder):
+        target_root = os.path.join(target_folder, os.path.relpath(root, source_folder))
+        os.makedirs(target_root, exist_ok=True)
+
+        for filename in files:
+            _place_file(os.path.join(root, filename), os.path.join(target_root, filename), method)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def link_file(source_path, target_path, mode=None):
+    """
+    Places source_path at target_path, trying the methods of the link mode in order, and returns the one that worked
+
+    Anything but a symlink is built under a temporary name and renamed into place, so a half copied file is never
+    taken for a finished one
+    """
+    methods = FALLBACKS[mode or _link_config["mode"]]
+
+    for method in methods:
+        if method == "symlink":
+            os.symlink(source_path, target_path)
+            return method
+
+        temp_path = "{}.{}.linking".format(target_path, uuid.uuid4().hex[:8])
+        try:
+            if os.path.isdir(source_path):
+                _place_tree(source_path, temp_path, method)
+            else:
+                _place_file(source_path, temp_path, method)
+
+            os.replace(temp_path, target_path)
+            return method
+        except OSError:
+            _remove(temp_path)
+
+            if method == methods[-1]:
+                raise
@@ -0,0 +1,122 @@
+"""Cheap checks that a downloaded file really is the mass spec file we asked for, and not an error page."""
+import os
+import hashlib
+
+SNIFF_BYTES = 64 * 1024
+
+# Below this we consider a download that we cannot recognize to be an error message
+MIN_UNRECOGNIZED_SIZE = 10000
+
+CHECKSUM_ALGORITHM = "sha256"
+
+THERMO_RAW_MAGIC = b"\x01\xa1" + "Finnigan".encode("utf-16-le")
+OLE_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+
+EXTENSION_FORMATS = {
+    ".mzml": "mzml",
+    ".mzxml": "mzxml",
+    ".mgf": "mgf",
+    ".raw": "raw",
+    ".wiff": "wiff",
+}
+
+
+class DownloadHasher:
+    """
+    The checksum of a download, computed as its bytes are written. A download that does not see its bytes in order,
+    e.g. a segmented one, can mark the checksum unknown instead of reading the file back
+    """
+
+    def __init__(self):
+        self._hasher = hashlib.new(CHECKSUM_ALGORITHM)
+        self.known = True
+
+    def update(self, chunk):
+        self._hasher.update(chunk)
+
+    def mark_unknown(self):
+        self.known = False
+
+    def hexdigest(self):
+        # None when the checksum is unknown, so it is never recorded for a file it was not computed over
+        return self._hasher.hexdigest() if self.known else None
+
+
+def new_hasher():
+    return DownloadHasher()
+
+
+def file_checksum(filename):
+    hasher = new_hasher()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(4 * 1024 * 1024), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def sniff_format(head):
+    """
+    Guesses the format from the first bytes of a file, returns mzml, mzxml, mgf, raw, wiff, html or None
+    """
+    if head.startswith(THERMO_RAW_MAGIC):
+        return "raw"
+
+    if head.startswith(OLE_MAGIC):
+        return "wiff"
+
+    # Text formats, skipping a byte order mark and leading whitespace
+    text_head = head.lstrip(b"\xef\xbb\xbf").lstrip()
+    lower_text_head = text_head.lower()
+
+    if lower_text_head.startswith(b"<!doctype html") or lower_text_head.startswith(b"<html") or b"<html" in lower_text_head[:1024]:
+        return "html"
+
+    if text_head.startswith(b"<"):
+        if b"<mzML" in text_head or b"<indexedmzML" in text_head:
+            return "mzml"
+        if b"<mzXML" in text_head:
+            return "mzxml"
+        return None
+
+    if b"BEGIN IONS" in text_head:
+        return "mgf"
+
+    return None
+
+
+def read_head(filename):
+    with open(filename, "rb") as f:
+        return f.read(SNIFF_BYTES)
+
+
+def expected_format(filename):
+    return EXTENSION_FORMATS.get(os.path.splitext(filename)[1].lower())
+
+
+def validate_file(filename, expected):
+    """
+    Returns None if the file looks like the expected format, otherwise the reason it does not
+
+    Files we cannot recognize are accepted as long as they are not tiny, since there are valid files our sniffing does
+    not know about, e.g. mgf files with a long header
+    """
+    file_size = os.path.getsize(filename)
+    if file_size == 0:
+        return "empty"
+
+    detected = sniff_format(read_head(filename))
+
+    if detected is not None and detected == expected:
+        return None
+
+    if detected == "html":
+        return "html error page"
+
+    if detected is not None and expected is not None:
+        return "expected {} but found {}".format(expected, detected)
+
+    if file_size < MIN_UNRECOGNIZED_SIZE:
+        return "too small"
+
+    return None
@@ -0,0 +1,202 @@
+"""Per host rate limiting, adaptive concurrency and circuit breaking for all the requests that go through http_session."""
+import time
+import threading
+from urllib.parse import urlparse
+
+import requests
+
+# 0 means no rate limit
+DEFAULT_HOST_RATE = 0
+DEFAULT_HOST_MAX_CONCURRENCY = 32
+DEFAULT_LATENCY_TARGET = 10
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_BREAKER_COOLDOWN = 60
+
+# Responses that mean the host is struggling rather than that the file is missing
+FAILURE_STATUSES = [429, 500, 502, 503, 504]
+
+# The concurrency is halved at most once per this many seconds, so one burst of errors does not take it to 1
+DECREASE_INTERVAL = 1
+
+_host_control_config = {
+    "rate": DEFAULT_HOST_RATE,
+    "max_concurrency": DEFAULT_HOST_MAX_CONCURRENCY,
+    "latency_target": DEFAULT_LATENCY_TARGET,
+    "failure_threshold": DEFAULT_FAILURE_THRESHOLD,
+    "cooldown": DEFAULT_BREAKER_COOLDOWN,
+}
+
+
+class HostUnavailableError(requests.exceptions.ConnectionError):
+    """
+    Raised instead of sending a request while the circuit breaker of the host is open
+    """
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+
+    def take(self, count=1):
+        """
+        Blocks until count tokens are available. A count larger than the burst, e.g. a large chunk of bytes, is taken on
+        credit and the next takers wait until it is paid back
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+
+            self._tokens -= count
+            wait_time = -self._tokens / self.rate
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class HostController:
+    """
+    Admission control for one host
+
+    The number of concurrent requests follows AIMD, it grows by about one per round of requests while they are
+    quick and succeed, and halves on errors or slow responses. After failure_threshold failures in a row the circuit
+    breaker opens and requests fail right away with HostUnavailableError for cooldown seconds, after which a single
+    trial request decides whether it closes again
+    """
+
+    def __init__(self, host, rate=DEFAULT_HOST_RATE, max_concurrency=DEFAULT_HOST_MAX_CONCURRENCY, latency_target=DEFAULT_LATENCY_TARGET,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD, cooldown=DEFAULT_BREAKER_COOLDOWN):
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self.concurrency_limit = float(max_concurrency)
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+        self._condition = threading.Condition()
+        self._last_decrease = 0
+        self._trial_in_flight = False
+        self._token_bucket = TokenBucket(rate) if rate else None
+
+    def _check_breaker(self):
+        # Returns whether this request is the trial of a half open breaker
+        if self.opened_at is None:
+            return False
+
+        if time.monotonic() - self.opened_at < self.cooldown or self._trial_in_flight:
+            raise HostUnavailableError("Host {} is unavailable, circuit breaker is open".format(self.host))
+
+        self._trial_in_flight = True
+        return True
+
+    def acquire(self):
+        """
+        Waits for a slot, returns whether the request is the trial of a half open breaker, which has to be passed back
+        to release
+        """
+        with self._condition:
+            trial = self._check_breaker()
+
+        if self._token_bucket is not None:
+            self._token_bucket.take()
+
+        with self._condition:
+            while self.in_flight >= int(self.concurrency_limit):
+                self._condition.wait()
+
+            self.in_flight += 1
+
+        return trial
+
+    def release(self, failed=False, latency=None, trial=False):
+        with self._condition:
+            self.in_flight -= 1
+
+            slow = latency is not None and self.latency_target is not None and latency > self.latency_target
+
+            if failed or slow:
+                now = time.monotonic()
+                if now - self._last_decrease >= DECREASE_INTERVAL:
+                    self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+                    self._last_decrease = now
+            else:
+                self.concurrency_limit = min(float(self.max_concurrency), self.concurrency_limit + 1 / self.concurrency_limit)
+
+            if trial:
+                self._trial_in_flight = False
+
+            # While the breaker is open only the trial decides, requests sent before it opened neither close nor re-arm it
+            if self.opened_at is None or trial:
+                if failed:
+                    self.consecutive_failures += 1
+
+                    if trial or self.consecutive_failures >= self.failure_threshold:
+                        print("Circuit breaker open for", self.host, "after", self.consecutive_failures, "failures")
+                        self.opened_at = time.monotonic()
+                else:
+                    if self.opened_at is not None:
+                        print("Circuit breaker closed for", self.host)
+                    self.consecutive_failures = 0
+                    self.opened_at = None
+
+            self._condition.notify_all()
+
+    def recovery_delay(self):
+        # Seconds until the breaker lets a trial request through, 0 if it is closed
+        with self._condition:
+            if self.opened_at is None:
+                return 0
+
+            return max(0, self.cooldown - (time.monotonic() - self.opened_at))
+
+
+_host_controllers = {}
+_host_controllers_lock = threading.Lock()
+
+
+def configure_host_control(rate=None, max_concurrency=None, latency_target=None, failure_threshold=None, cooldown=None):
+    """
+    Updates the configuration, the hosts start over with the new settings
+    """
+    with _host_controllers_lock:
+        if rate is not None:
+            _host_control_config["rate"] = rate
+        if max_concurrency is not None:
+            _host_control_config["max_concurrency"] = max_concurrency
+        if latency_target is not None:
+            _host_control_config["latency_target"] = latency_target
+        if failure_threshold is not None:
+            _host_control_config["failure_threshold"] = failure_threshold
+        if cooldown is not None:
+            _host_control_config["cooldown"] = cooldown
+
+        _host_controllers.clear()
+
+
+def get_host_controller(url):
+    host = urlparse(url).netloc
+
+    with _host_controllers_lock:
+        if host not in _host_controllers:
+            _host_controllers[host] = HostController(host, **_host_control_config)
+
+        return _host_controllers[host]
+
+
+def recovery_delay():
+    """
+    Seconds until every host with an open circuit breaker takes requests again
+    """
+    with _host_controllers_lock:
+        host_controllers = list(_host_controllers.values())
+
+    return max([host_controller.recovery_delay() for host_controller in host_controllers], default=0)
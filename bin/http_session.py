@@ -0,0 +1,143 @@
+"""Shared pooled HTTP session used by all the resolvers and downloaders."""
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import host_control
+
+DEFAULT_POOL_SIZE = 16
+DEFAULT_CONNECT_TIMEOUT = 30
+DEFAULT_READ_TIMEOUT = 300
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 1.0
+
+# These are the statuses we consider transient and worth retrying with backoff
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+_session_config = {
+    "pool_size": DEFAULT_POOL_SIZE,
+    "connect_timeout": DEFAULT_CONNECT_TIMEOUT,
+    "read_timeout": DEFAULT_READ_TIMEOUT,
+    "retries": DEFAULT_RETRIES,
+    "backoff_factor": DEFAULT_BACKOFF_FACTOR,
+}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure_session(pool_size=None, connect_timeout=None, read_timeout=None, retries=None, backoff_factor=None):
+    """
+    Updates the session configuration, the next call to get_session will build a new session with these settings
+    """
+    global _session
+
+    with _session_lock:
+        if pool_size is not None:
+            _session_config["pool_size"] = pool_size
+        if connect_timeout is not None:
+            _session_config["connect_timeout"] = connect_timeout
+        if read_timeout is not None:
+            _session_config["read_timeout"] = read_timeout
+        if retries is not None:
+            _session_config["retries"] = retries
+        if backoff_factor is not None:
+            _session_config["backoff_factor"] = backoff_factor
+
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def _build_session():
+    retry = Retry(
+        total=_session_config["retries"],
+        backoff_factor=_session_config["backoff_factor"],
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=["GET", "HEAD"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+    # pool_maxsize is the number of kept alive connections per host
+    adapter = HTTPAdapter(pool_connections=_session_config["pool_size"], pool_maxsize=_session_config["pool_size"], max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+def get_session():
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = _build_session()
+
+        return _session
+
+
+def get_timeout():
+    return (_session_config["connect_timeout"], _session_config["read_timeout"])
+
+
+def _request(method, url, **kwargs):
+    """
+    Sends the request through the shared session with the configured timeouts, under the admission control of the host
+
+    Streamed responses hold on to their slot with the host until they are closed
+    """
+    kwargs.setdefault("timeout", get_timeout())
+
+    host_controller = host_control.get_host_controller(url)
+    trial = host_controller.acquire()
+
+    start_time = time.monotonic()
+    try:
+        r = get_session().request(method, url, **kwargs)
+    except requests.exceptions.RequestException:
+        host_controller.release(failed=True, trial=trial)
+        raise
+    except BaseException:
+        host_controller.release(trial=trial)
+        raise
+
+    failed = r.status_code in host_control.FAILURE_STATUSES
+    latency = time.monotonic() - start_time
+
+    if not kwargs.get("stream", False):
+        host_controller.release(failed=failed, latency=latency, trial=trial)
+        return r
+
+    response_close = r.close
+    released = threading.Event()
+
+    def _close():
+        try:
+            response_close()
+        finally:
+            if not released.is_set():
+                released.set()
+                host_controller.release(failed=failed, latency=latency, trial=trial)
+
+    r.close = _close
+
+    return r
+
+
+def get(url, **kwargs):
+    """
+    Drop in replacement for requests.get that goes through the shared session with the configured timeouts
+    """
+    return _request("GET", url, **kwargs)
+
+
+def head(url, **kwargs):
+    kwargs.setdefault("allow_redirects", True)
+
+    return _request("HEAD", url, **kwargs)
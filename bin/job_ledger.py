@@ -0,0 +1,134 @@
+"""SQLite ledger of the download status of every USI, so interrupted runs can be restarted without redoing work."""
+import os
+import sys
+import csv
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+# Statuses where the file is in place and does not need to be looked at again
+COMPLETED_STATUSES = [
+    "EXISTS_IN_OUTPUT",
+    "EXISTS_IN_DATASET",
+    "EXISTS_IN_CACHE",
+    "DOWNLOADED_INTO_OUTPUT_WITH_CACHE",
+    "DOWNLOADED_INTO_OUTPUT_WITHOUT_CACHE",
+    "CACHE_ERROR_DOWNLOAD_DIRECT",
+]
+
+
+class JobLedger:
+    def __init__(self, database_filename):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(database_filename, check_same_thread=False)
+
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS downloads (
+                    usi TEXT PRIMARY KEY,
+                    status TEXT,
+                    target_path TEXT,
+                    download_url TEXT,
+                    file_size INTEGER,
+                    checksum TEXT,
+                    result TEXT,
+                    updated REAL
+                )
+            """)
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def get_completed(self, usi, target_path=None):
+        """
+        Returns the recorded result if this USI was completed in an earlier run and the file is still there
+
+        With target_path, only a result that put the file there counts, a run with another output folder or other
+        options that change the file needs to do its own download
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT status, target_path, result FROM downloads WHERE usi = ?", (usi,)).fetchone()
+
+        if row is None:
+            return None
+
+        status, recorded_target_path, result = row
+        if status not in COMPLETED_STATUSES or recorded_target_path is None or not os.path.exists(recorded_target_path):
+            return None
+
+        if target_path is not None and os.path.abspath(recorded_target_path) != os.path.abspath(target_path):
+            return None
+
+        return json.loads(result)
+
+    def record(self, usi, result, download_url=None, checksum=None):
+        target_path = result.get("target_path")
+
+        file_size = None
+        if target_path is not None and os.path.isfile(target_path):
+            file_size = os.path.getsize(target_path)
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO downloads (usi, status, target_path, download_url, file_size, checksum, result, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (usi, result.get("status"), target_path, download_url, file_size, checksum, json.dumps(result), time.time()))
+            self._connection.commit()
+
+    def results(self):
+        with self._lock:
+            rows = self._connection.execute("SELECT result FROM downloads ORDER BY rowid").fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+    def status_counts(self):
+        with self._lock:
+            return dict(self._connection.execute("SELECT status, COUNT(*) FROM downloads GROUP BY status").fetchall())
+
+
+def write_summary(results, output_summary):
+    # Same layout as the summary the download script writes, columns in order of first appearance
+    columns = []
+    for result in results:
+        for key in result:
+            if key not in columns:
+                columns.append(key)
+
+    with open(output_summary, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, delimiter="\t")
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspecting the job database of a download run')
+    parser.add_argument('command', choices=['summary', 'stats'])
+    parser.add_argument('job_database', help='job database from --job_database')
+    parser.add_argument('output_summary', nargs='?', default=None, help='Output Summary for the summary command')
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.job_database):
+        print("Job database does not exist")
+        exit(1)
+
+    job_ledger = JobLedger(args.job_database)
+
+    if args.command == "summary":
+        if args.output_summary is None:
+            print("Output summary is required", file=sys.stderr)
+            exit(1)
+
+        write_summary(job_ledger.results(), args.output_summary)
+    else:
+        for status, count in sorted(job_ledger.status_counts().items()):
+            print(status, count, sep="\t")
+
+    job_ledger.close()
+
+if __name__ == "__main__":
+    main()
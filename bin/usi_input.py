@@ -0,0 +1,144 @@
+"""Streaming the USIs in from the input file and the results out to the summary, without holding either in memory."""
+import os
+import sys
+import csv
+import gzip
+
+import download_metrics
+
+# Columns of the summary in order, anything else a result has is appended after them
+SUMMARY_COLUMNS = ["usi", "target_path", "status", "cache_filename", "checksum"] + download_metrics.METRIC_COLUMNS
+
+
+def _open_text(input_filename):
+    if input_filename == "-":
+        return sys.stdin
+
+    if input_filename.endswith(".gz"):
+        return gzip.open(input_filename, "rt", newline="")
+
+    return open(input_filename, newline="")
+
+
+def _input_format(input_filename):
+    # The format comes from the extension under any .gz, stdin and unknown extensions are sniffed from the header
+    base_filename, extension = os.path.splitext(input_filename[:-3] if input_filename.endswith(".gz") else input_filename)
+    extension = extension.lower()
+
+    if extension in [".yaml", ".yml"]:
+        return "yaml"
+    if extension == ".tsv":
+        return "tsv"
+    if extension == ".csv":
+        return "csv"
+    if extension == ".txt":
+        return "txt"
+
+    return None
+
+
+def _iter_table(f, delimiter, header_line=None):
+    """
+    Yields the usi column of a delimited file, header_line is the already read first line when sniffing
+    """
+    if header_line is None:
+        header_line = f.readline()
+
+    header = next(csv.reader([header_line], delimiter=delimiter))
+    usi_column = header.index("usi")
+
+    for row in csv.reader(f, delimiter=delimiter):
+        if len(row) > usi_column:
+            yield row[usi_column]
+
+
+def iter_usis(input_filename):
+    """
+    Lazily yields the USIs of a tsv/csv file with a usi header, a GNPS2 params yaml, or a plain list with one per line
+
+    input_filename may be - for stdin, and may be gzipped
+    """
+    input_format = _input_format(input_filename)
+
+    with _open_text(input_filename) as f:
+        if input_format == "yaml":
+            # The params file has all the USIs in one string, so it has to be read as a whole
+            import yaml
+
+            parameters = yaml.load(f, Loader=yaml.SafeLoader)
+            try:
+                usi_blob = parameters["usi"]
+            except:
+                # We have a problem parsing
+                usi_blob = ""
+
+            for usi in usi_blob.split("\n"):
+                yield usi
+        elif input_format == "tsv":
+            yield from _iter_table(f, "\t")
+        elif input_format == "csv":
+            yield from _iter_table(f, ",")
+        elif input_format == "txt":
+            for line in f:
+                yield line
+        else:
+            header_line = f.readline()
+            for delimiter in ["\t", ","]:
+                if "usi" in next(csv.reader([header_line], delimiter=delimiter)):
+                    yield from _iter_table(f, delimiter, header_line=header_line)
+                    return
+
+            # No header, so just a list of USIs
+            yield header_line
+            for line in f:
+                yield line
+
+
+def unique_usis(usis):
+    """
+    Cleans up the USIs and drops blank lines and repeats as they stream past
+    """
+    seen_usis = set()
+    for usi in usis:
+        usi = usi.strip()
+
+        if len(usi) < 5 or usi in seen_usis:
+            continue
+
+        seen_usis.add(usi)
+        yield usi
+
+
+class SummaryWriter:
+    """
+    Appends a row to the output summary as each result comes in, the file is only created once there is a result
+    """
+
+    def __init__(self, output_summary):
+        self.output_summary = output_summary
+        self.row_count = 0
+
+        self._file = None
+        self._writer = None
+
+    def write(self, result):
+        if self._writer is None:
+            columns = SUMMARY_COLUMNS + [key for key in result if key not in SUMMARY_COLUMNS]
+
+            self._file = open(self.output_summary, "w", newline="")
+            self._writer = csv.DictWriter(self._file, fieldnames=columns, delimiter="\t", extrasaction="ignore")
+            self._writer.writeheader()
+
+        self._writer.writerow(result)
+        self.row_count += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,233 @@
+"""Requesting vendor format conversions from the datasetcache and waiting for them without blocking everything else."""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import http_session
+import download_resolver
+
+DATASET_CACHE_URL_BASE = "https://datasetcache.gnps2.org"
+
+DEFAULT_CONVERSION_TIMEOUT = 300
+MIN_POLL_INTERVAL = 2
+MAX_POLL_INTERVAL = 30
+POLL_BACKOFF = 1.5
+STATUS_POLL_PARALLEL = 8
+
+VENDOR_EXTENSIONS = [".d", ".wiff", ".raw"]
+
+_conversion_config = {
+    "timeout": DEFAULT_CONVERSION_TIMEOUT,
+}
+
+
+def configure_conversion(dataset_cache_url=None, timeout=None):
+    global DATASET_CACHE_URL_BASE
+
+    if dataset_cache_url is not None:
+        DATASET_CACHE_URL_BASE = dataset_cache_url.rstrip("/")
+
+    if timeout is not None:
+        _conversion_config["timeout"] = timeout
+
+
+def conversion_download_url():
+    return "{}/convert/download".format(DATASET_CACHE_URL_BASE)
+
+
+def is_vendor_usi(usi):
+    fileportion = usi.split(":")[2] if len(usi.split(":")) > 2 else ""
+
+    return any(fileportion.lower().endswith(extension) for extension in VENDOR_EXTENSIONS)
+
+
+def request_conversion(mri):
+    convert_request_url = "{}/convert/request".format(DATASET_CACHE_URL_BASE)
+    params = {"mri": mri}
+
+    print("Requesting Conversion", mri)
+    http_session.get(convert_request_url, params=params)
+
+
+def conversion_status(mri):
+    convert_status_url = "{}/convert/status".format(DATASET_CACHE_URL_BASE)
+    params = {"mri": mri}
+
+    try:
+        r = http_session.get(convert_status_url, params=params)
+        if r.status_code == 200:
+            return r.json()["status"] == True
+    except KeyboardInterrupt:
+        raise
+    except Exception as e:
+        print("Error checking conversion status", mri, e)
+
+    return False
+
+
+def _next_poll_interval(poll_interval, progressed):
+    # Polling quickly while conversions are finishing, and backing off while nothing is happening
+    if progressed:
+        return MIN_POLL_INTERVAL
+
+    return min(poll_interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+
+
+class ConversionPoller:
+    """
+    Tracks all the submitted conversions and polls their status in one background sweep, so each download only has
+    to wait on its own conversion instead of sleeping in its own polling loop
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._ready = set()
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._poll_loop, daemon=True, name="conversion_poller")
+        self._thread.start()
+
+    def submit(self, mri):
+        mri = download_resolver.strip_mri(mri)
+
+        with self._lock:
+            if mri in self._pending or mri in self._ready:
+                return
+
+            self._pending[mri] = threading.Event()
+
+        try:
+            request_conversion(mri)
+        except BaseException:
+            with self._lock:
+                self._pending.pop(mri, None)
+            raise
+
+        self._wakeup.set()
+
+    def wait(self, mri, timeout):
+        """
+        Returns True once the conversion is ready, False if it did not finish within timeout seconds
+        """
+        mri = download_resolver.strip_mri(mri)
+
+        self.submit(mri)
+
+        with self._lock:
+            if mri in self._ready:
+                return True
+            ready_event = self._pending[mri]
+
+        return ready_event.wait(timeout)
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def _poll_loop(self):
+        poll_interval = MIN_POLL_INTERVAL
+
+        with ThreadPoolExecutor(max_workers=STATUS_POLL_PARALLEL) as executor:
+            while not self._stopped:
+                submitted = self._wakeup.wait(poll_interval)
+                self._wakeup.clear()
+
+                # New submissions start over with quick polling instead of counting as a poll that found nothing
+                if submitted:
+                    poll_interval = MIN_POLL_INTERVAL
+
+                with self._lock:
+                    pending_mris = list(self._pending.keys())
+
+                if len(pending_mris) == 0:
+                    poll_interval = MIN_POLL_INTERVAL
+                    continue
+
+                statuses = list(executor.map(conversion_status, pending_mris))
+
+                progressed = False
+                with self._lock:
+                    for mri, ready in zip(pending_mris, statuses):
+                        if ready:
+                            progressed = True
+                            self._ready.add(mri)
+                            self._pending.pop(mri).set()
+
+                if not submitted or progressed:
+                    poll_interval = _next_poll_interval(poll_interval, progressed)
+
+
+_conversion_poller = None
+
+
+def start_pipeline():
+    """
+    Switches to pipelined conversions, where everything is submitted up front and polled in one background sweep
+    """
+    global _conversion_poller
+
+    if _conversion_poller is None:
+        _conversion_poller = ConversionPoller()
+
+    return _conversion_poller
+
+
+def stop_pipeline():
+    global _conversion_poller
+
+    if _conversion_poller is not None:
+        _conversion_poller.stop()
+        _conversion_poller = None
+
+
+def submit_conversions(usi_list):
+    # Kicking off all the conversions so they can run on the server while we are busy with other downloads
+    conversion_poller = start_pipeline()
+
+    submitted_mris = set()
+    for usi in usi_list:
+        if len(usi) < 5 or not is_vendor_usi(usi):
+            continue
+
+        mri = download_resolver.strip_mri(usi)
+        if mri in submitted_mris:
+            continue
+
+        submitted_mris.add(mri)
+        try:
+            conversion_poller.submit(mri)
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            print("Error requesting conversion", mri, e)
+
+    return len(submitted_mris)
+
+
+def wait_for_conversion(mri, timeout=None):
+    """
+    Requests the conversion if needed and waits for it, returns True if it is ready to download
+    """
+    if timeout is None:
+        timeout = _conversion_config["timeout"]
+
+    if _conversion_poller is not None:
+        return _conversion_poller.wait(mri, timeout)
+
+    # Without the pipeline we poll by ourselves, still backing off rather than sleeping a fixed 30 seconds
+    mri = download_resolver.strip_mri(mri)
+    request_conversion(mri)
+
+    start_time = time.time()
+    poll_interval = MIN_POLL_INTERVAL
+    while True:
+        if conversion_status(mri):
+            return True
+
+        if time.time() - start_time + poll_interval > timeout:
+            return False
+
+        time.sleep(poll_interval)
+        poll_interval = _next_poll_interval(poll_interval, False)
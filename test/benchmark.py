@@ -0,0 +1,154 @@
+# Benchmarks the downloads end to end against the local fake server, so they can be run offline and compared across commits
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+from fake_server import FakeServer, SyntheticContent
+
+BIN_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin")
+
+# Named scenarios, anything given on the command line overrides them
+SCENARIOS = {
+    "baseline": {"files": 50, "file_size_mb": 8, "latency": 0, "bandwidth_mb": None, "fail_every": 0, "conversions": 0, "parallel": 4},
+    "latency": {"files": 200, "file_size_mb": 0.5, "latency": 0.05, "bandwidth_mb": None, "fail_every": 0, "conversions": 0, "parallel": 8},
+    "bandwidth": {"files": 20, "file_size_mb": 8, "latency": 0.01, "bandwidth_mb": 20, "fail_every": 0, "conversions": 0, "parallel": 4},
+    "errors": {"files": 50, "file_size_mb": 2, "latency": 0.01, "bandwidth_mb": None, "fail_every": 5, "conversions": 0, "parallel": 4},
+    "conversions": {"files": 20, "file_size_mb": 2, "latency": 0.01, "bandwidth_mb": None, "fail_every": 0, "conversions": 10, "parallel": 4},
+}
+
+# Conversions become ready this many seconds after they are requested
+CONVERSION_TIME = 1
+
+
+def _percentile(values, percentile):
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percentile / 100 * (len(values) - 1))))]
+
+
+def _run_client(command, log_filename):
+    # wait4 gives us the cpu time and peak memory of just this run
+    with open(log_filename, "w") as log_file:
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, cwd=BIN_FOLDER)
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+    return process.returncode, rusage
+
+
+def run_scenario(name, files, file_size_mb, latency, bandwidth_mb, fail_every, conversions, parallel, extra_args=None):
+    """
+    Downloads files synthetic mzML files plus conversions vendor files through main and measures the run
+
+    Returns a dictionary with the throughput, cpu time per GB, peak RSS and per file latency percentiles
+    """
+    temp_folder = tempfile.mkdtemp()
+    file_size = int(file_size_mb * 1024 * 1024)
+    bandwidth = None if bandwidth_mb is None else bandwidth_mb * 1024 * 1024
+
+    with FakeServer(latency=latency, bandwidth=bandwidth) as fake_server:
+        usi_list = []
+        for i in range(files):
+            usi = "mzspec:MSV000000001:peak/file_{}.mzML".format(i)
+            fake_server.add_synthetic_file(usi, "file_{}.mzML".format(i), file_size)
+            if fail_every > 0 and i % fail_every == 0:
+                fake_server.fail_count["file_{}.mzML".format(i)] = 1
+            usi_list.append(usi)
+
+        for i in range(conversions):
+            usi = "mzspec:MSV000000002:raw/vendor_{}.raw".format(i)
+            fake_server.download_links[usi] = "{}/files/vendor_{}.raw".format(fake_server.url, i)
+            fake_server.add_conversion(usi, SyntheticContent("vendor_{}.mzML".format(i), file_size), conversion_time=CONVERSION_TIME)
+            usi_list.append(usi)
+
+        input_filename = os.path.join(temp_folder, "input.tsv")
+        with open(input_filename, "w") as f:
+            f.write("usi\n")
+            for usi in usi_list:
+                f.write(usi + "\n")
+
+        output_summary = os.path.join(temp_folder, "summary.tsv")
+        command = [sys.executable, "download_public_data_usi.py", input_filename, os.path.join(temp_folder, "output"), output_summary,
+                   "--dashboard_url", fake_server.url, "--datasetcache_url", fake_server.url,
+                   "--parallel", str(parallel), "--pipeline_conversions", "--http_pool_size", str(max(parallel, 4))]
+        command += extra_args or []
+
+        start_time = time.time()
+        returncode, rusage = _run_client(command, os.path.join(temp_folder, "client.log"))
+        wall_seconds = time.time() - start_time
+
+    results = []
+    if os.path.isfile(output_summary):
+        with open(output_summary, newline="") as f:
+            results = list(csv.DictReader(f, delimiter="\t"))
+
+    downloaded_bytes = sum(int(result["downloaded_bytes"] or 0) for result in results)
+    latencies = [float(result["total_seconds"]) for result in results if result.get("total_seconds")]
+    cpu_seconds = rusage.ru_utime + rusage.ru_stime
+
+    return {
+        "scenario": name,
+        "returncode": returncode,
+        "files": len(usi_list),
+        "downloaded": len([result for result in results if result["status"].startswith("DOWNLOADED")]),
+        "downloaded_mb": round(downloaded_bytes / 1024 / 1024, 1),
+        "wall_seconds": round(wall_seconds, 2),
+        "throughput_mb_per_second": round(downloaded_bytes / 1024 / 1024 / wall_seconds, 1),
+        "cpu_seconds": round(cpu_seconds, 2),
+        "cpu_seconds_per_gb": round(cpu_seconds / (downloaded_bytes / 1024 ** 3), 2) if downloaded_bytes > 0 else None,
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": round(rusage.ru_maxrss / 1024, 1),
+        "latency_p50_seconds": _percentile(latencies, 50),
+        "latency_p95_seconds": _percentile(latencies, 95),
+        "latency_max_seconds": max(latencies) if len(latencies) > 0 else None,
+        "log": os.path.join(temp_folder, "client.log"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarking the downloads against a local fake repository server')
+    parser.add_argument('--scenario', default="all", choices=["all"] + list(SCENARIOS.keys()), help="Scenario to run, all runs every one of them")
+    parser.add_argument('--files', type=int, default=None, help="Number of mzML files")
+    parser.add_argument('--file_size_mb', type=float, default=None, help="Size of each file in MB")
+    parser.add_argument('--latency', type=float, default=None, help="Seconds every response of the fake server is delayed")
+    parser.add_argument('--bandwidth_mb', type=float, default=None, help="MB per second each file transfer is limited to")
+    parser.add_argument('--fail_every', type=int, default=None, help="Every nth file gets a 503 on its first request, 0 for none")
+    parser.add_argument('--conversions', type=int, default=None, help="Number of vendor files that go through the conversion service")
+    parser.add_argument('--parallel', type=int, default=None, help="--parallel of the download script")
+    parser.add_argument('--output_json', default=None, help="Append the results to this file as json lines")
+
+    args, extra_args = parser.parse_known_args()
+
+    scenario_names = list(SCENARIOS.keys()) if args.scenario == "all" else [args.scenario]
+
+    columns = ["scenario", "files", "downloaded", "downloaded_mb", "wall_seconds", "throughput_mb_per_second", "cpu_seconds_per_gb", "peak_rss_mb",
+               "latency_p50_seconds", "latency_p95_seconds", "latency_max_seconds"]
+    print(*columns, sep="\t")
+
+    for scenario_name in scenario_names:
+        scenario = dict(SCENARIOS[scenario_name])
+        for key in scenario:
+            if getattr(args, key) is not None:
+                scenario[key] = getattr(args, key)
+
+        result = run_scenario(scenario_name, extra_args=extra_args, **scenario)
+        result["parameters"] = scenario
+
+        print(*[result[column] for column in columns], sep="\t")
+        if result["returncode"] != 0:
+            print("Download script failed, see", result["log"], file=sys.stderr)
+
+        if args.output_json is not None:
+            with open(args.output_json, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""Local stand-in for the dashboard, the datasetcache and the file hosts so the downloads can be exercised without the network."""
+import json
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+# Files are written to the socket in chunks of this size, which is also the granularity of the bandwidth limit
+SEND_CHUNK_SIZE = 64 * 1024
+
+
+class SyntheticContent:
+    """
+    Deterministic mzML-looking file content of any size, generated on the fly so benchmarks do not hold the files in memory
+    """
+
+    HEADER = b'<?xml version="1.0" encoding="utf-8"?>\n<indexedmzML>\n'
+
+    def __init__(self, name, size):
+        self.size = max(size, len(self.HEADER))
+        self.etag = '"{}-{}"'.format(hashlib.md5(name.encode()).hexdigest(), self.size)
+        self._pattern = hashlib.sha256(name.encode()).digest() * 2048
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(self.size)
+
+        chunks = []
+        position = start
+        if position < len(self.HEADER):
+            chunks.append(self.HEADER[position:min(stop, len(self.HEADER))])
+            position = min(stop, len(self.HEADER))
+
+        while position < stop:
+            offset = (position - len(self.HEADER)) % len(self._pattern)
+            length = min(stop - position, len(self._pattern) - offset)
+            chunks.append(self._pattern[offset:offset + length])
+            position += length
+
+        return b"".join(chunks)
+
+
+class FakeServer:
+    """
+    Serves /downloadlink from a dictionary of usi to download url, anything unknown is a 404 like the real dashboard,
+    /files/<name> from a dictionary of name to file content, the datasette filename listing from dataset_files,
+    and the /convert/* vendor conversion endpoints from conversions
+
+    latency delays every response and bandwidth caps the bytes per second of each file transfer, for benchmarks
+    """
+
+    def __init__(self, latency=0, bandwidth=None):
+        self.download_links = {}
+        self.files = {}
+        self.dataset_files = []
+        self.request_log = []
+
+        # name -> number of bytes after which the next transfer of the file drops the connection
+        self.interrupt_after = {}
+
+        # name -> error status code the file is served with, like an overloaded host
+        self.fail_status = {}
+
+        # name -> number of requests for the file that get a 503 before it is served
+        self.fail_count = {}
+
+        # names of files served without byte range support
+        self.no_ranges = set()
+
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+        # mri -> converted content and how long the conversion takes once requested
+        self.conversions = {}
+        self._conversion_requested = {}
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self._server.server_address[1])
+
+    def add_file(self, usi, name, content):
+        # Registers a file and its download link, returns the download url
+        self.files[name] = content
+        self.download_links[usi] = "{}/files/{}".format(self.url, name)
+
+        return self.download_links[usi]
+
+    def add_dataset_file(self, dataset, filepath, content):
+        # Registers a file in the datasette listing, returns its usi
+        usi = "mzspec:{}:{}".format(dataset, filepath)
+        self.dataset_files.append({"usi": usi, "dataset": dataset, "filepath": filepath})
+        self.add_file(usi, "{}/{}".format(dataset, filepath), content)
+
+        return usi
+
+    def add_synthetic_file(self, usi, name, size):
+        return self.add_file(usi, name, SyntheticContent(name, size))
+
+    def add_conversion(self, mri, content, conversion_time=0):
+        self.conversions[mri] = (content, conversion_time)
+
+    def _conversion_ready(self, mri):
+        if mri not in self.conversions or mri not in self._conversion_requested:
+            return False
+
+        return time.time() - self._conversion_requested[mri] >= self.conversions[mri][1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _make_handler(self):
+        fake_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            head_only = False
+
+            def do_HEAD(self):
+                # Same headers as a GET without the body
+                self.head_only = True
+                self.do_GET()
+
+            def do_GET(self):
+                parsed_url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(parsed_url.query).items()}
+                fake_server.request_log.append((parsed_url.path, params))
+
+                if fake_server.latency > 0:
+                    time.sleep(fake_server.latency)
+
+                if parsed_url.path == "/downloadlink":
+                    download_url = fake_server.download_links.get(params.get("usi"))
+                    if download_url is None:
+                        self._send(404, b"Not found")
+                    else:
+                        self._send(200, download_url.encode())
+                    return
+
+                if parsed_url.path == "/datasette/database/filename.json":
+                    file_rows = [file_row for file_row in fake_server.dataset_files
+                                 if file_row["dataset"] == params.get("dataset__exact", file_row["dataset"])
+                                 and file_row["filepath"].startswith(params.get("filepath__startswith", ""))]
+
+                    if params.get("_shape") == "array":
+                        self._send(200, json.dumps(file_rows).encode(), content_type="application/json")
+                        return
+
+                    # Paging like datasette, the next token here is just the offset
+                    if "_sort" in params:
+                        file_rows = sorted(file_rows, key=lambda file_row: file_row[params["_sort"]])
+
+                    offset = int(params.get("_next", 0))
+                    page_size = int(params.get("_size", 100))
+                    next_token = str(offset + page_size) if offset + page_size < len(file_rows) else None
+
+                    listing = {"rows": file_rows[offset:offset + page_size], "next": next_token}
+                    self._send(200, json.dumps(listing).encode(), content_type="application/json")
+                    return
+
+                if parsed_url.path == "/convert/request":
+                    fake_server._conversion_requested.setdefault(params.get("mri"), time.time())
+                    self._send(200, b"OK")
+                    return
+
+                if parsed_url.path == "/convert/status":
+                    self._send(200, json.dumps({"status": fake_server._conversion_ready(params.get("mri"))}).encode(), content_type="application/json")
+                    return
+
+                if parsed_url.path == "/convert/download":
+                    if fake_server._conversion_ready(params.get("mri")):
+                        self._send_file("convert/" + params.get("mri"), fake_server.conversions[params.get("mri")][0])
+                    else:
+                        self._send(404, b"Not converted")
+                    return
+
+                if parsed_url.path.startswith("/files/"):
+                    name = parsed_url.path[len("/files/"):]
+                    content = fake_server.files.get(name)
+                    if name in fake_server.fail_status:
+                        self._send(fake_server.fail_status[name], b"Unavailable")
+                    elif fake_server.fail_count.get(name, 0) > 0:
+                        fake_server.fail_count[name] -= 1
+                        self._send(503, b"Unavailable")
+                    elif content is None:
+                        self._send(404, b"Not found")
+                    else:
+                        self._send_file(name, content)
+                    return
+
+                self._send(404, b"Not found")
+
+            def _send_file(self, name, content):
+                etag = getattr(content, "etag", None) or '"{}"'.format(hashlib.md5(content).hexdigest())
+
+                # Honoring byte ranges like a real file host, unless the file changed according to If-Range
+                start = 0
+                end = len(content)
+                ranged = False
+                range_header = self.headers.get("Range")
+                if range_header is not None and self.headers.get("If-Range") in (None, etag) and name not in fake_server.no_ranges:
+                    first_byte, _, last_byte = range_header.replace("bytes=", "").partition("-")
+                    start = int(first_byte)
+                    if last_byte:
+                        end = min(end, int(last_byte) + 1)
+                    ranged = True
+
+                if ranged and start >= len(content):
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */{}".format(len(content)))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                self.send_response(206 if ranged else 200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(end - start))
+                if name not in fake_server.no_ranges:
+                    self.send_header("Accept-Ranges", "bytes")
+                self.send_header("ETag", etag)
+                if ranged:
+                    self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, len(content)))
+                self.end_headers()
+
+                if self.head_only:
+                    return
+
+                interrupt_after = fake_server.interrupt_after.pop(name, None)
+                if interrupt_after is not None:
+                    end = min(end, start + interrupt_after)
+
+                for offset in range(start, end, SEND_CHUNK_SIZE):
+                    chunk = content[offset:min(offset + SEND_CHUNK_SIZE, end)]
+                    self.wfile.write(chunk)
+
+                    if fake_server.bandwidth is not None:
+                        time.sleep(len(chunk) / fake_server.bandwidth)
+
+                if interrupt_after is not None:
+                    self.wfile.flush()
+                    self.close_connection = True
+
+            def _send(self, status_code, body, content_type="text/plain"):
+                self.send_response(status_code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if not self.head_only:
+                    self.wfile.write(body)
+
+        return Handler
+
+
+@contextmanager
+def redirect_endpoints(url, dataset_cache=False):
+    """
+    Points the dashboard, and with dataset_cache the datasetcache too, at url for the duration, e.g. of a FakeServer,
+    starting and ending with an empty resolution cache
+    """
+    # Only the tests have the bin folder on the path, the benchmarks run the script in a subprocess
+    import download_resolver
+    import vendor_conversion
+
+    original_dashboard_url = download_resolver.DASHBOARD_URL_BASE
+    original_dataset_cache_url = vendor_conversion.DATASET_CACHE_URL_BASE
+
+    download_resolver.configure_resolver(dashboard_url=url)
+    if dataset_cache:
+        vendor_conversion.configure_conversion(dataset_cache_url=url)
+    download_resolver.clear_resolution_cache()
+    try:
+        yield
+    finally:
+        download_resolver.configure_resolver(dashboard_url=original_dashboard_url)
+        vendor_conversion.configure_conversion(dataset_cache_url=original_dataset_cache_url)
+        download_resolver.clear_resolution_cache()
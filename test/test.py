@@ -2,21 +2,1366 @@
 
 import sys
 sys.path.append('../bin')
-import download_public_data_usi
+import download_workflow
+import http_session
+import download_resolver
+import download_stream
+import download_raw
+import vendor_conversion
+import job_ledger
+import cache_manager
+import download_locks
+import file_linking
+import file_validation
+import dataset_index
+import usi_input
+import host_control
+import download_metrics
+from fake_server import FakeServer, redirect_endpoints
+
 
 def test():
 
-    print(download_public_data_usi._determine_dataset_reconstructed_foldername("mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML"))
-    
-    cachepath, cachefolder = download_public_data_usi._determine_caching_paths("mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML", "./data/cache", "S_N3.mzML")
-    cachepath2, _ = download_public_data_usi._determine_caching_paths("mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML:scan:1", "./data/cache", "S_N3.mzML")
+    print(download_workflow._determine_dataset_reconstructed_foldername("mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML"))
+
+    cachepath, cachefolder = download_workflow._determine_caching_paths("mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML", "./data/cache", "S_N3.mzML")
+    cachepath2, _ = download_workflow._determine_caching_paths("mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML:scan:1", "./data/cache", "S_N3.mzML")
 
     print(cachefolder)
 
     assert(cachepath == cachepath2)
-    
+
+
+def test_parallel_ordering():
+    import argparse
+    import time
+
+    args = argparse.Namespace(parallel=4, host_parallel="MassIVE=2;ST=1", noconversion=False, dryrun=False)
+
+    assert(download_workflow.parse_host_limits(args.host_parallel, args.parallel) == {"MassIVE": 2, "ST": 1})
+
+    usi_list = ["mzspec:MSV000086206:ccms_peak/raw/S_N{}.mzML".format(i) for i in range(6)] + ["mzspec:ST000001:file_{}.mzML".format(i) for i in range(3)]
+
+    original_download_helper = download_workflow.download_helper
+    def _fake_download_helper(usi, args, extension_filter=None, noconversion=False, dryrun=False):
+        # Finishing out of order on purpose
+        time.sleep(0.01 * (len(usi_list) - usi_list.index(usi)))
+        return {"usi": usi, "status": "DOWNLOADED_INTO_OUTPUT_WITHOUT_CACHE"}
+
+    download_workflow.download_helper = _fake_download_helper
+    try:
+        results = download_workflow._download_parallel(usi_list, args, None)
+    finally:
+        download_workflow.download_helper = original_download_helper
+
+    assert([result["usi"] for result in results] == usi_list)
+
+
+def test_http_session():
+    http_session.configure_session(pool_size=4, connect_timeout=5, read_timeout=60, retries=2)
+
+    session = http_session.get_session()
+    assert(session is http_session.get_session())
+    assert(http_session.get_timeout() == (5, 60))
+
+    adapter = session.get_adapter("https://dashboard.gnps2.org")
+    assert(adapter.max_retries.total == 2)
+    assert(429 in adapter.max_retries.status_forcelist)
+
+    # Reconfiguring gives us a fresh session
+    http_session.configure_session(pool_size=http_session.DEFAULT_POOL_SIZE)
+    assert(session is not http_session.get_session())
+
+
+def test_resolution_cache():
+    import os
+    import tempfile
+
+    requested = []
+    original_request_download_url = download_resolver._request_download_url
+    def _fake_request_download_url(usi):
+        requested.append(usi)
+        return "https://massive.ucsd.edu/ProteoSAFe/DownloadResultFile?file=f.MSV000086206/ccms_peak/raw/S_N3.mzML"
+
+    download_resolver._request_download_url = _fake_request_download_url
+    try:
+        download_resolver.clear_resolution_cache()
+
+        cache_file = os.path.join(tempfile.mkdtemp(), "resolution_cache.json")
+        download_resolver.configure_resolution_cache(cache_file=cache_file)
+
+        # the filename, the caching and the download all share the same resolution
+        assert(download_workflow._determine_ms_filename("mzspec:MSV000086206:ccms_peak/raw/S_N3") == "S_N3.mzML")
+        download_workflow._determine_download_url("mzspec:MSV000086206:ccms_peak/raw/S_N3:scan:1")
+        download_workflow._determine_download_url("mzspec:MSV000086206:ccms_peak/raw/S_N3")
+        assert(requested == ["mzspec:MSV000086206:ccms_peak/raw/S_N3"])
+
+        # A rerun loads it from disk
+        download_resolver.save_resolution_cache()
+        download_resolver.clear_resolution_cache()
+        download_resolver.configure_resolution_cache(cache_file=cache_file)
+        download_workflow._determine_download_url("mzspec:MSV000086206:ccms_peak/raw/S_N3")
+        assert(len(requested) == 1)
+
+        # Unless it has expired
+        download_resolver.clear_resolution_cache()
+        download_resolver.configure_resolution_cache(cache_file=cache_file, ttl=0)
+        download_workflow._determine_download_url("mzspec:MSV000086206:ccms_peak/raw/S_N3")
+        assert(len(requested) == 2)
+    finally:
+        download_resolver._request_download_url = original_request_download_url
+        download_resolver.configure_resolution_cache(cache_file=None, ttl=download_resolver.DEFAULT_RESOLUTION_CACHE_TTL)
+        download_resolver.clear_resolution_cache()
+
+
+def test_bulk_resolution():
+    import socket
+    import argparse
+
+    valid_usi = "mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML"
+    invalid_usi = "mzspec:MSV000079506:XXXXXXXXXXXXXXXX.mzML"
+
+    with FakeServer() as fake_server:
+        fake_server.download_links[valid_usi] = "https://massive.ucsd.edu/ProteoSAFe/DownloadResultFile?file=f.MSV000086206/ccms_peak/raw/S_N3.mzML"
+
+        with redirect_endpoints(fake_server.url):
+            resolved = download_resolver.resolve_download_urls([valid_usi, valid_usi + ":scan:1", invalid_usi, ""], parallel=2)
+
+            assert(resolved[valid_usi] == fake_server.download_links[valid_usi])
+            assert(resolved[invalid_usi] is None)
+            assert(len(fake_server.request_log) == 2)
+
+            # The downloads reuse the bulk resolution and invalid USIs never get further
+            assert(download_workflow._determine_download_url(valid_usi + ":scan:2") == resolved[valid_usi])
+            assert(len(fake_server.request_log) == 2)
+
+            args = argparse.Namespace(output_folder="./data/filedownloads", nestfiles="flat", existing_dataset_directory=None, cache_directory=None)
+            result = download_workflow.download_helper(invalid_usi, args)
+            assert(result["status"] == "ERROR_UNRESOLVABLE")
+
+            # Nothing is kept around per MRI once it is resolved
+            assert(len(download_resolver._resolution_key_locks) == 0)
+
+    # A dashboard that cannot be reached does not make the USIs unresolvable, the downloads try them again
+    unreachable_socket = socket.socket()
+    unreachable_socket.bind(("127.0.0.1", 0))
+    unreachable_url = "http://127.0.0.1:{}".format(unreachable_socket.getsockname()[1])
+    unreachable_socket.close()
+
+    with redirect_endpoints(unreachable_url):
+        original_retries = http_session._session_config["retries"]
+        http_session.configure_session(retries=0)
+        host_control.configure_host_control(failure_threshold=2)
+        try:
+            assert(download_resolver.resolve_download_urls([valid_usi], parallel=1) == {})
+            assert(not download_resolver.is_unresolvable(valid_usi))
+
+            # USIs whose filename needs the dashboard still get a row in the summary, or are parked once the host is down
+            args = argparse.Namespace(output_folder="./data/filedownloads", nestfiles="flat", existing_dataset_directory=None, cache_directory=None)
+            assert(download_workflow.download_helper("mzspec:MSV000086206:ccms_peak/raw/S_N3", args) == {"usi": "mzspec:MSV000086206:ccms_peak/raw/S_N3", "status": "ERROR"})
+            assert(download_workflow.download_helper("mzspec:MSV000086206:ccms_peak/raw/S_N3", args)["status"] == "ERROR_HOST_UNAVAILABLE")
+        finally:
+            http_session.configure_session(retries=original_retries)
+            host_control.configure_host_control(failure_threshold=host_control.DEFAULT_FAILURE_THRESHOLD)
+
+
+def test_stream_download():
+    import os
+    import tempfile
+
+    temp_folder = tempfile.mkdtemp()
+    content = os.urandom(3 * 1024 * 1024 + 17)
+
+    with FakeServer() as fake_server:
+        download_url = fake_server.add_file("mzspec:MSV000000001:large.mzML", "large.mzML", content)
+
+        target_filename = os.path.join(temp_folder, "large.mzML")
+        assert(download_stream.download_url_to_file(download_url, target_filename) == len(content))
+        assert(open(target_filename, "rb").read() == content)
+
+    # Local sources go through the kernel copy
+    copied_filename = os.path.join(temp_folder, "copied.mzML")
+    assert(download_stream.download_url_to_file("file://" + target_filename, copied_filename) == len(content))
+    assert(open(copied_filename, "rb").read() == content)
+
+
+def test_download_raw_streamed():
+    import os
+    import tempfile
+
+    temp_folder = tempfile.mkdtemp()
+    raw_usi = "mzspec:MSV000094721:raw/KV_5_ORG_DROP.raw"
+    missing_usi = "mzspec:MSV000094721:raw/missing.raw"
+    content = os.urandom(2 * 1024 * 1024)
+
+    with FakeServer() as fake_server:
+        fake_server.add_file(raw_usi, "KV_5_ORG_DROP.raw", content)
+        fake_server.download_links[missing_usi] = "{}/files/missing.raw".format(fake_server.url)
+
+        with redirect_endpoints(fake_server.url):
+            target_filename = os.path.join(temp_folder, "KV_5_ORG_DROP.raw")
+            download_raw.download_raw_mri(raw_usi, target_filename)
+            assert(open(target_filename, "rb").read() == content)
+
+            # Errors never leave anything behind
+            missing_filename = os.path.join(temp_folder, "missing.raw")
+            try:
+                download_raw.download_raw_mri(missing_usi, missing_filename)
+                assert(False)
+            except download_stream.DownloadError:
+                pass
+            assert(os.listdir(temp_folder) == ["KV_5_ORG_DROP.raw"])
+
+
+def test_download_raw_bundle():
+    import os
+    import argparse
+    import tempfile
+
+    temp_folder = tempfile.mkdtemp()
+
+    with FakeServer() as fake_server:
+        fake_server.add_dataset_file("MSV000093589", "raw/Jugione_A.d/analysis.tdf", b"tdf" * 1000)
+        fake_server.add_dataset_file("MSV000093589", "raw/Jugione_A.d/analysis.tdf_bin", b"bin" * 100000)
+        fake_server.add_dataset_file("MSV000093589", "raw/Jugione_A.d/sub/method.m", b"method")
+        fake_server.add_dataset_file("MSV000093589", "raw/Jugione_A.d2/other.tdf", b"other")
+
+        fake_server.add_dataset_file("ST001497", "Validation/run.wiff", b"wiff" * 1000)
+        scan_usi = fake_server.add_dataset_file("ST001497", "Validation/run.wiff.scan", b"scan" * 1000)
+
+        with redirect_endpoints(fake_server.url, dataset_cache=True):
+            target_d = os.path.join(temp_folder, "Jugione_A.d")
+            download_raw.download_raw_mri("mzspec:MSV000093589:raw/Jugione_A.d", target_d, cache_url=fake_server.url, bundle_parallel=3)
+            assert(sorted(os.listdir(target_d)) == ["analysis.tdf", "analysis.tdf_bin", "sub"])
+            assert(open(os.path.join(target_d, "sub", "method.m"), "rb").read() == b"method")
+
+            target_wiff = os.path.join(temp_folder, "run.wiff")
+            download_raw.download_raw_mri("mzspec:ST001497:Validation/run.wiff", target_wiff, cache_url=fake_server.url)
+            assert(os.path.isfile(target_wiff) and os.path.isfile(target_wiff + ".scan"))
+
+            # A member that cannot be fetched makes the bundle incomplete
+            del fake_server.download_links[scan_usi]
+            download_resolver.clear_resolution_cache()
+            try:
+                download_raw.download_raw_mri("mzspec:ST001497:Validation/run.wiff", os.path.join(temp_folder, "run2.wiff"), cache_url=fake_server.url)
+                assert(False)
+            except download_stream.DownloadError:
+                pass
+            assert(not os.path.exists(os.path.join(temp_folder, "run2.wiff")))
+
+            # An incomplete bundle leaves nothing at the target, so the next run downloads it again
+            fake_server.fail_status["MSV000093589/raw/Jugione_A.d/analysis.tdf_bin"] = 404
+            args = argparse.Namespace(output_folder=os.path.join(temp_folder, "output"), nestfiles="flat", existing_dataset_directory=None,
+                                      cache_directory=None, verify_cache=False, bundle_parallel=2)
+            for _ in range(2):
+                result = download_workflow.download_helper("mzspec:MSV000093589:raw/Jugione_A.d", args, noconversion=True)
+                assert(result["status"] == "DOWNLOAD_ERROR")
+                assert(os.listdir(args.output_folder) == [])
+
+            del fake_server.fail_status["MSV000093589/raw/Jugione_A.d/analysis.tdf_bin"]
+            result = download_workflow.download_helper("mzspec:MSV000093589:raw/Jugione_A.d", args, noconversion=True)
+            assert(result["status"] == "DOWNLOADED_INTO_OUTPUT_WITHOUT_CACHE")
+            assert(sorted(os.listdir(result["target_path"])) == ["analysis.tdf", "analysis.tdf_bin", "sub"])
+
+
+def test_resume_download():
+    import os
+    import tempfile
+
+    temp_folder = tempfile.mkdtemp()
+    usi = "mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML"
+    content = b'<?xml version="1.0"?>\n<mzML>' + os.urandom(1024 * 1024)
+
+    with FakeServer() as fake_server:
+        fake_server.add_file(usi, "S_N3.mzML", content)
+        fake_server.interrupt_after["S_N3.mzML"] = 300000
+
+        with redirect_endpoints(fake_server.url):
+            http_session.configure_session(retries=0)
+            download_stream.configure_stream(chunk_size=64 * 1024)
+            try:
+                target_filename = os.path.join(temp_folder, "S_N3.mzML")
+
+                # The first attempt gets cut off and leaves the partial file behind
+                try:
+                    download_workflow._download(usi, target_filename, ".mzML")
+                    assert(False)
+                except Exception:
+                    pass
+                partial_filename = download_workflow._determine_partial_filename(usi, target_filename)
+                assert(0 < os.path.getsize(partial_filename) <= 300000)
+                assert(not os.path.exists(target_filename))
+
+                # An error answer to the resume keeps what we have
+                partial_size = os.path.getsize(partial_filename)
+                fake_server.fail_count["S_N3.mzML"] = 1
+                try:
+                    download_workflow._download(usi, target_filename, ".mzML")
+                    assert(False)
+                except download_stream.DownloadError as e:
+                    assert(e.status_code == 503)
+                assert(os.path.getsize(partial_filename) == partial_size)
+                assert(download_stream._read_partial_metadata(partial_filename) is not None)
+
+                # The second attempt only asks for the rest
+                assert(download_workflow._download(usi + ":scan:1", target_filename, ".mzML") == 0)
+                assert(open(target_filename, "rb").read() == content)
+                assert(fake_server.request_log[-1][0] == "/files/S_N3.mzML")
+                assert(os.listdir(temp_folder) == ["S_N3.mzML"])
+            finally:
+                download_stream.configure_stream(chunk_size=download_stream.DEFAULT_CHUNK_SIZE)
+                http_session.configure_session(retries=http_session.DEFAULT_RETRIES)
+
+
+def test_pipelined_conversion():
+    import os
+    import time
+    import argparse
+    import tempfile
+
+    temp_folder = tempfile.mkdtemp()
+    slow_mri = "mzspec:MSV000094721:raw/slow.raw"
+    fast_mri = "mzspec:MSV000094721:raw/fast.raw"
+
+    with FakeServer() as fake_server:
+        fake_server.add_conversion(slow_mri, b"<mzML>" * 5000, conversion_time=0.5)
+        fake_server.add_conversion(fast_mri, b"<mzML>" * 5000)
+
+        with redirect_endpoints(fake_server.url, dataset_cache=True):
+            original_min_poll_interval = vendor_conversion.MIN_POLL_INTERVAL
+            vendor_conversion.configure_conversion(timeout=5)
+            vendor_conversion.MIN_POLL_INTERVAL = 0.05
+            try:
+                # Everything is requested up front in one go
+                assert(vendor_conversion.submit_conversions([slow_mri + ":scan:1", fast_mri, slow_mri, "mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML"]) == 2)
+                assert(len([request for request in fake_server.request_log if request[0] == "/convert/request"]) == 2)
+
+                start_time = time.time()
+                assert(download_workflow._download(fast_mri, os.path.join(temp_folder, "fast.mzML"), ".raw") == 0)
+                assert(time.time() - start_time < 0.5)
+
+                assert(download_workflow._download(slow_mri, os.path.join(temp_folder, "slow.mzML"), ".raw") == 0)
+                assert(sorted(os.listdir(temp_folder)) == ["fast.mzML", "slow.mzML"])
+
+                # Without the pipeline we still wait on our own
+                vendor_conversion.stop_pipeline()
+                other_mri = "mzspec:MSV000094721:raw/other.raw"
+                fake_server.add_conversion(other_mri, b"<mzML>" * 5000, conversion_time=0.1)
+                assert(vendor_conversion.wait_for_conversion(other_mri))
+
+                # A download waiting on its conversion lets the others have its parallel slot
+                waiting_mri = "mzspec:MSV000094721:raw/waiting.raw"
+                fake_server.add_conversion(waiting_mri, b"<mzML>" * 5000, conversion_time=0.5)
+                fake_server.download_links[waiting_mri] = "{}/files/waiting.raw".format(fake_server.url)
+                mzml_usi = "mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML"
+                fake_server.add_file(mzml_usi, "S_N3.mzML", b"<mzML>" * 5000)
+
+                args = argparse.Namespace(parallel=1, host_parallel=None, output_folder=os.path.join(temp_folder, "output"), nestfiles="flat", existing_dataset_directory=None,
+                                          cache_directory=None, verify_cache=False, noconversion=False, dryrun=False)
+                results = list(download_workflow._iter_download_parallel([waiting_mri, mzml_usi], args, None))
+                assert([result["status"] for result in results] == ["DOWNLOADED_INTO_OUTPUT_WITHOUT_CACHE"] * 2)
+                assert(results[1]["queue_seconds"] < 0.4)
+            finally:
+                vendor_conversion.stop_pipeline()
+                vendor_conversion.MIN_POLL_INTERVAL = original_min_poll_interval
+                vendor_conversion.configure_conversion(timeout=vendor_conversion.DEFAULT_CONVERSION_TIMEOUT)
+
+
+def test_job_ledger():
+    import os
+    import argparse
+    import tempfile
+
+    temp_folder = tempfile.mkdtemp()
+    target_path = os.path.join(temp_folder, "S_N3.mzML")
+    usi = "mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML"
+
+    args = argparse.Namespace(output_folder=temp_folder, nestfiles="flat", noconversion=False, dryrun=False)
+
+    download_calls = []
+    original_download_helper = download_workflow.download_helper
+    def _fake_download_helper(usi, args, extension_filter=None, noconversion=False, dryrun=False):
+        download_calls.append(usi)
+        if usi.endswith("missing.mzML"):
+            return {"usi": usi, "status": "ERROR"}
+
+        with open(target_path, "w") as f:
+            f.write("<mzML/>")
+        return {"usi": usi, "target_path": target_path, "status": "DOWNLOADED_INTO_OUTPUT_WITHOUT_CACHE"}
+
+    download_workflow.download_helper = _fake_download_helper
+    try:
+        database_filename = os.path.join(temp_folder, "jobs.sqlite")
+        ledger = job_ledger.JobLedger(database_filename)
+        download_workflow.download_usi(usi, args, None, ledger=ledger)
+        download_workflow.download_usi("mzspec:MSV000086206:missing.mzML", args, None, ledger=ledger)
+        ledger.close()
+
+        # A restart skips what was completed, but retries the errors
+        ledger = job_ledger.JobLedger(database_filename)
+        result = download_workflow.download_usi(usi, args, None, ledger=ledger)
+        download_workflow.download_usi("mzspec:MSV000086206:missing.mzML", args, None, ledger=ledger)
+        assert(result["status"] == "DOWNLOADED_INTO_OUTPUT_WITHOUT_CACHE")
+        assert(download_calls == [usi, "mzspec:MSV000086206:missing.mzML", "mzspec:MSV000086206:missing.mzML"])
+        assert(ledger.status_counts() == {"DOWNLOADED_INTO_OUTPUT_WITHOUT_CACHE": 1, "ERROR": 1})
+
+        summary_filename = os.path.join(temp_folder, "summary.tsv")
+        job_ledger.write_summary(ledger.results(), summary_filename)
+        assert(open(summary_filename).readline().strip().split("\t")[:3] == ["usi", "target_path", "status"])
+
+        # A rerun into another output folder does its own download
+        nested_args = argparse.Namespace(output_folder=temp_folder, nestfiles="nest", noconversion=False, dryrun=False)
+        download_workflow.download_usi(usi, nested_args, None, ledger=ledger)
+        assert(download_calls[-1] == usi and len(download_calls) == 4)
+        ledger.close()
+    finally:
+        download_workflow.download_helper = original_download_helper
+
+
+def test_cache_eviction():
+    import os
+    import tempfile
+
+    temp_folder = tempfile.mkdtemp()
+    cache_directory = os.path.join(temp_folder, "cache")
+    output_folder = os.path.join(temp_folder, "output")
+    os.makedirs(output_folder)
+
+    cache_filenames = []
+    for i in range(3):
+        cache_filename, cache_path = download_workflow._determine_caching_paths("mzspec:MSV000086206:S_N{}.mzML".format(i), cache_directory, "S_N{}.mzML".format(i))
+        os.makedirs(cache_path, exist_ok=True)
+        with open(cache_filename, "wb") as f:
+            f.write(b"0" * 1000)
+        cache_filenames.append(cache_filename)
+
+    cache_index = cache_manager.CacheIndex(cache_directory)
+    cache_index.sync()
+    assert(cache_index.stats()["total_size"] == 3000)
+
+    # Files only found on disk might have links from before the index, so they stay
+    assert(cache_index.gc(0) == [])
+
+    # The oldest one is still linked from an output folder
+    for cache_filename in cache_filenames:
+        cache_index.record_access(cache_filename)
+    os.symlink(cache_filenames[0], os.path.join(output_folder, "S_N0.mzML"))
+    cache_index.record_link(cache_filenames[0], os.path.join(output_folder, "S_N0.mzML"))
+
+    # One that is being downloaded or linked is skipped
+    with download_locks.cache_entry_lock(cache_filenames[1]):
+        assert(cache_index.gc(1500) == [cache_filenames[2]])
+    assert(cache_index.gc(1500) == [cache_filenames[1]])
+    assert(os.path.exists(cache_filenames[0]) and not os.path.exists(cache_filenames[1]))
+    assert(not os.path.exists(download_locks.cache_entry_lock_filename(cache_filenames[1])))
+
+    # Once the link is gone it can be evicted too
+    os.remove(os.path.join(output_folder, "S_N0.mzML"))
+    assert(cache_index.gc(0) == [cache_filenames[0]])
+    assert(cache_index.stats()["entries"] == 0)
+    cache_index.close()
+
+    assert(cache_manager.parse_size("1.5K") == 1536)
+
+
+def test_shared_cache_single_download():
+    import os
+    import argparse
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    temp_folder = tempfile.mkdtemp()
+    cache_directory = os.path.join(temp_folder, "cache")
+    os.makedirs(cache_directory)
+    usi = "mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML"
+
+    with FakeServer() as fake_server:
+        fake_server.add_file(usi, "S_N3.mzML", b"<mzML>" * 100000)
+
+        with redirect_endpoints(fake_server.url):
+            try:
+                # Separate jobs with their own output folders sharing one cache
+                def _download_job(i):
+                    args = argparse.Namespace(output_folder=os.path.join(temp_folder, "output_{}".format(i)), nestfiles="flat", existing_dataset_directory=None, cache_directory=cache_directory, verify_cache=False)
+                    return download_workflow.download_helper(usi + ":scan:{}".format(i), args)
+
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    results = list(executor.map(_download_job, range(4)))
+
+                statuses = sorted(result["status"] for result in results)
+                assert(statuses == ["DOWNLOADED_INTO_OUTPUT_WITH_CACHE"] + ["EXISTS_IN_CACHE"] * 3)
+                assert(len([request for request in fake_server.request_log if request[0] == "/files/S_N3.mzML"]) == 1)
+                assert(all(os.path.islink(os.path.join(temp_folder, "output_{}".format(i), "S_N3.mzML")) for i in range(4)))
+
+                # A gc running while a cache hit is linked does not evict the entry from under it
+                for i in range(4):
+                    os.remove(os.path.join(temp_folder, "output_{}".format(i), "S_N3.mzML"))
+
+                evicted_while_linking = []
+                original_link_file = file_linking.link_file
+                def _link_file_during_gc(source_path, target_path, mode=None):
+                    evicted_while_linking.extend(cache_manager.get_cache_index(cache_directory).gc(0))
+                    return original_link_file(source_path, target_path, mode=mode)
+
+                file_linking.link_file = _link_file_during_gc
+                try:
+                    result = _download_job(4)
+                finally:
+                    file_linking.link_file = original_link_file
+                assert(evicted_while_linking == [] and result["status"] == "EXISTS_IN_CACHE")
+                assert(os.path.isfile(os.path.join(temp_folder, "output_4", "S_N3.mzML")))
+
+                # A dropped connection is a download error, not a read only cache, and the next run resumes the cache partial
+                dropped_usi = "mzspec:MSV000086206:ccms_peak/raw/S_N4.mzML"
+                fake_server.add_file(dropped_usi, "S_N4.mzML", b"<mzML>" * 100000)
+                fake_server.interrupt_after["S_N4.mzML"] = 200000
+                http_session.configure_session(retries=0)
+                download_stream.configure_stream(chunk_size=64 * 1024)
+
+                args = argparse.Namespace(output_folder=os.path.join(temp_folder, "output_0"), nestfiles="flat", existing_dataset_directory=None, cache_directory=cache_directory, verify_cache=False)
+                result = download_workflow.download_helper(dropped_usi, args)
+                assert(result["status"] == "DOWNLOAD_ERROR")
+                assert(not os.path.exists(os.path.join(args.output_folder, "S_N4.mzML")))
+
+                result = download_workflow.download_helper(dropped_usi, args)
+                assert(result["status"] == "DOWNLOADED_INTO_OUTPUT_WITH_CACHE")
+                assert(fake_server.request_log[-1][0] == "/files/S_N4.mzML")
+                assert(len([request for request in fake_server.request_log if request[0] == "/files/S_N4.mzML"]) == 2)
+            finally:
+                download_stream.configure_stream(chunk_size=download_stream.DEFAULT_CHUNK_SIZE)
+                http_session.configure_session(retries=http_session.DEFAULT_RETRIES)
+                cache_manager.close_cache_indexes()
+
+
+def test_integrity_verification():
+    import os
+    import argparse
+    import hashlib
+    import tempfile
+
+    assert(file_validation.sniff_format(b'\xef\xbb\xbf<?xml version="1.0"?>\n<indexedmzML>') == "mzml")
+    assert(file_validation.sniff_format(b'<?xml version="1.0"?>\n<mzXML>') == "mzxml")
+    assert(file_validation.sniff_format(b"BEGIN IONS\nPEPMASS=100\n") == "mgf")
+    assert(file_validation.sniff_format(b"\n<!DOCTYPE html><html><body>Error</body></html>") == "html")
+    assert(file_validation.sniff_format(file_validation.THERMO_RAW_MAGIC + b"\x00" * 10) == "raw")
+
+    temp_folder = tempfile.mkdtemp()
+    cache_directory = os.path.join(temp_folder, "cache")
+    os.makedirs(cache_directory)
+
+    good_usi = "mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML"
+    html_usi = "mzspec:MSV000086206:ccms_peak/raw/S_N4.mzML"
+    content = b'<?xml version="1.0"?>\n<mzML>' + b"0" * 100000
+
+    with FakeServer() as fake_server:
+        fake_server.add_file(good_usi, "S_N3.mzML", content)
+        fake_server.add_file(html_usi, "S_N4.mzML", b"<html><body>" + b"No such file " * 2000 + b"</body></html>")
+
+        with redirect_endpoints(fake_server.url):
+            try:
+                args = argparse.Namespace(output_folder=os.path.join(temp_folder, "output"), nestfiles="flat", existing_dataset_directory=None, cache_directory=cache_directory, verify_cache=True)
+
+                # Error pages never make it into the cache
+                result = download_workflow.download_helper(html_usi, args)
+                assert(result["status"] == "ERROR_DATA_INVALID")
+                assert(not os.path.exists(os.path.join(temp_folder, "output", "S_N4.mzML")))
+
+                # The checksum is computed while downloading and kept in the cache index
+                result = download_workflow.download_helper(good_usi, args)
+                assert(result["status"] == "DOWNLOADED_INTO_OUTPUT_WITH_CACHE")
+                assert(result["checksum"] == hashlib.sha256(content).hexdigest())
+
+                cache_filename, _ = download_workflow._determine_caching_paths(good_usi, cache_directory, "S_N3.mzML")
+                assert(cache_manager.get_cache_index(cache_directory).get_entry(cache_filename)["checksum"] == result["checksum"])
+
+                # A corrupted cache entry is caught on the next hit and downloaded again
+                with open(cache_filename, "r+b") as f:
+                    f.seek(50000)
+                    f.write(b"1")
+                os.remove(os.path.join(temp_folder, "output", "S_N3.mzML"))
+
+                result = download_workflow.download_helper(good_usi, args)
+                assert(result["status"] == "DOWNLOADED_INTO_OUTPUT_WITH_CACHE")
+                assert(open(cache_filename, "rb").read() == content)
+            finally:
+                cache_manager.close_cache_indexes()
+
+
+def test_dataset_index():
+    import os
+    import argparse
+    import tempfile
+
+    temp_folder = tempfile.mkdtemp()
+    dataset_directory = os.path.join(temp_folder, "datasets")
+    os.makedirs(os.path.join(dataset_directory, "MassIVE", "MSV000086206", "ccms_peak", "raw"))
+    os.makedirs(os.path.join(dataset_directory, "MassIVE", "MSV000086206", "raw", "S_N5.d", "AcqData"))
+    with open(os.path.join(dataset_directory, "MassIVE", "MSV000086206", "ccms_peak", "raw", "S_N3.mzML"), "w") as f:
+        f.write("<mzML>")
+
+    usi = "mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML"
+    missing_usi = "mzspec:MSV000086206:ccms_peak/raw/S_N4.mzML"
+
+    with FakeServer() as fake_server:
+        fake_server.add_file(usi, "S_N3.mzML", b"<mzML>")
+        fake_server.add_file(missing_usi, "S_N4.mzML", b"<mzML>")
+
+        with redirect_endpoints(fake_server.url):
+            try:
+                # Scanning each dataset folder once
+                index = dataset_index.get_dataset_index(dataset_directory)
+                assert(index.lookup("MassIVE", "MSV000086206/ccms_peak/raw", "S_N3.mzML") == os.path.join(dataset_directory, "MassIVE", "MSV000086206", "ccms_peak", "raw", "S_N3.mzML"))
+                assert(index.lookup("MassIVE", "MSV000086206/ccms_peak/raw", "S_N4.mzML") is None)
+                assert(index.lookup("MassIVE", "MSV000086206/raw", "S_N5.d") is not None)
+                assert(index.lookup("MassIVE", "MSV000086207", "S_N3.mzML") is None)
+
+                args = argparse.Namespace(output_folder=os.path.join(temp_folder, "output"), nestfiles="flat", existing_dataset_directory=dataset_directory, cache_directory=None, verify_cache=False)
+                result = download_workflow.download_helper(usi, args, dryrun=True)
+                assert(result["status"] == "EXISTS_IN_DATASET")
+                assert(os.path.islink(os.path.join(temp_folder, "output", "S_N3.mzML")))
+
+                # Loading a manifest instead, only the hits are looked at on disk
+                manifest_filename = os.path.join(temp_folder, "manifest.txt.gz")
+                assert(dataset_index.build_manifest(dataset_directory, manifest_filename) == 2)
+
+                dataset_index.clear_dataset_indexes()
+                dataset_index.configure_dataset_index(manifest=manifest_filename)
+                os.remove(os.path.join(dataset_directory, "MassIVE", "MSV000086206", "ccms_peak", "raw", "S_N3.mzML"))
+
+                index = dataset_index.get_dataset_index(dataset_directory)
+                assert(len(index) == 2)
+                assert(index.lookup("MassIVE", "MSV000086206/raw", "S_N5.d") is not None)
+                assert(index.lookup("MassIVE", "MSV000086206/ccms_peak/raw", "S_N4.mzML") is None)
+                assert(download_workflow.download_helper(missing_usi, args, dryrun=True)["status"] == "DRYRUN_TO_DOWNLOAD")
+
+                # A file the manifest has but that is gone is not linked to
+                assert(index.lookup("MassIVE", "MSV000086206/ccms_peak/raw", "S_N3.mzML") is None)
+                args.output_folder = os.path.join(temp_folder, "output_stale")
+                assert(download_workflow.download_helper(usi, args, dryrun=True)["status"] == "DRYRUN_TO_DOWNLOAD")
+                assert(not os.path.lexists(os.path.join(args.output_folder, "S_N3.mzML")))
+            finally:
+                dataset_index.configure_dataset_index(manifest=None)
+                dataset_index.clear_dataset_indexes()
+
+
+def test_streaming_input():
+    import os
+    import gzip
+    import argparse
+    import tempfile
+
+    temp_folder = tempfile.mkdtemp()
+    usi_list = ["mzspec:MSV000086206:ccms_peak/raw/S_N{}.mzML".format(i) for i in range(3)]
+
+    input_filenames = {
+        "input.tsv.gz": "filename\tusi\nS_N0\t{}\nS_N1\t{}\nS_N0\t{}\nS_N2\t{}\n".format(usi_list[0], usi_list[1], usi_list[0], usi_list[2]),
+        "input.csv": "usi,filename\n{},a\n{},b\n\n{},c\n".format(*usi_list),
+        "input.txt": "{}\n  {}  \n{}\n".format(*usi_list),
+        "input_headerless": "\n".join(usi_list) + "\n",
+        "input.yaml": "usi: |\n  {}\n  {}\n  {}\n".format(*usi_list),
+    }
+    for input_filename, content in input_filenames.items():
+        input_filename = os.path.join(temp_folder, input_filename)
+        with (gzip.open(input_filename, "wt") if input_filename.endswith(".gz") else open(input_filename, "w")) as f:
+            f.write(content)
+
+        assert(list(usi_input.unique_usis(usi_input.iter_usis(input_filename))) == usi_list)
+
+    # The input is only read a window ahead of the downloads
+    args = argparse.Namespace(parallel=2, host_parallel=None, noconversion=False, dryrun=False)
+    read_count = [0]
+    def _usis():
+        for i in range(100):
+            read_count[0] += 1
+            yield "mzspec:MSV000086206:ccms_peak/raw/S_N{}.mzML".format(i)
+
+    original_download_helper = download_workflow.download_helper
+    def _fake_download_helper(usi, args, extension_filter=None, noconversion=False, dryrun=False):
+        return {"usi": usi, "status": "DOWNLOADED_INTO_OUTPUT_WITHOUT_CACHE", "target_path": usi.split("/")[-1]}
+
+    download_workflow.download_helper = _fake_download_helper
+    try:
+        results = download_workflow._iter_download_parallel(_usis(), args, None)
+        first_result = next(results)
+        assert(first_result["usi"].endswith("S_N0.mzML"))
+        assert(read_count[0] <= args.parallel * download_workflow.QUEUED_PER_WORKER)
+
+        output_summary = os.path.join(temp_folder, "summary.tsv")
+        with usi_input.SummaryWriter(output_summary) as summary_writer:
+            summary_writer.write(first_result)
+            for result in results:
+                summary_writer.write(result)
+    finally:
+        download_workflow.download_helper = original_download_helper
+
+    summary_lines = open(output_summary).read().splitlines()
+    assert(summary_lines[0].split("\t")[:5] == ["usi", "target_path", "status", "cache_filename", "checksum"])
+    assert(summary_lines[0].split("\t") == usi_input.SUMMARY_COLUMNS)
+    assert(len(summary_lines) == 101)
+    assert(summary_lines[1].split("\t")[1] == "S_N0.mzML")
+
+
+def test_download_plan():
+    import os
+    import json
+    import argparse
+    import tempfile
+
+    temp_folder = tempfile.mkdtemp()
+    small_usi = "mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML"
+    large_usi = "mzspec:MSV000086206:ccms_peak/raw/S_N4.mzML"
+    other_usi = "mzspec:ST000001:file_1.mzML"
+    vendor_usi = "mzspec:MSV000086206:raw/S_N5.raw"
+    unknown_usi = "mzspec:MSV000086206:ccms_peak/raw/S_N6"
+
+    with FakeServer() as fake_server:
+        fake_server.add_file(small_usi, "S_N3.mzML", b"<mzML>" * 10)
+        fake_server.add_file(large_usi, "S_N4.mzML", b"<mzML>" * 1000)
+        fake_server.add_file(other_usi, "file_1.mzML", b"<mzML>" * 100)
+
+        with redirect_endpoints(fake_server.url):
+            args = argparse.Namespace(output_folder=os.path.join(temp_folder, "output"), nestfiles="recreate", noconversion=False, resolve_parallel=2)
+            usi_list = [small_usi, large_usi, small_usi + ":scan:2", other_usi, vendor_usi, unknown_usi]
+
+            plan = download_workflow.build_plan(usi_list, args, None)
+
+    assert([plan_entry["expected_size"] for plan_entry in plan.entries] == [60, 6000, None, 600, None, None])
+    assert(plan.entries[2]["duplicate_of"] == small_usi)
+    assert(plan.entries[4]["method"] == "conversion")
+
+    # A USI without a known filename is still downloaded, so download_helper can report it
+    assert(plan.entries[5]["method"] == "unknown" and plan.entries[5]["target_path"] is None)
+
+    # The directories are created up front
+    assert(os.path.isdir(os.path.join(temp_folder, "output", "MassIVE", "MSV000086206", "ccms_peak", "raw")))
+    assert(os.path.isdir(os.path.join(temp_folder, "output", "ST", "ST000001")))
+
+    assert(plan.usis(largest_first=True) == [large_usi, other_usi, small_usi, small_usi + ":scan:2", vendor_usi, unknown_usi])
+
+    groups = plan.groups()
+    assert(groups[("MassIVE", "MSV000086206")] == {"files": 4, "duplicates": 1, "expected_size": 6060, "unknown_size": 2})
+
+    plan.write(os.path.join(temp_folder, "plan.json"))
+    assert(len(json.load(open(os.path.join(temp_folder, "plan.json")))["entries"]) == 6)
+    plan.write(os.path.join(temp_folder, "plan.tsv"))
+    assert(len(open(os.path.join(temp_folder, "plan.tsv")).read().splitlines()) == 7)
+
+
+def test_dataset_listing():
+    with FakeServer() as fake_server:
+        for i in range(25):
+            fake_server.add_dataset_file("MSV000086206", "peak/S_N{:02d}.mzML".format(i), b"<mzML>")
+        fake_server.add_dataset_file("MSV000086206", "raw/Jugione_A.d/analysis.tdf", b"tdf")
+        fake_server.add_dataset_file("MSV000086206", "raw/Jugione_A.d/analysis.tdf_bin", b"bin")
+        fake_server.add_dataset_file("MSV000086206", "raw/run.wiff", b"wiff")
+        fake_server.add_dataset_file("MSV000086206", "raw/run.wiff.scan", b"scan")
+        fake_server.add_dataset_file("MSV000086207", "peak/other.mzML", b"<mzML>")
+
+        file_rows = list(download_raw.iter_dataset_files("MSV000086206", cache_url=fake_server.url, page_size=10))
+        assert(len(file_rows) == 29)
+        assert(len([request for request in fake_server.request_log if request[0] == "/datasette/database/filename.json"]) == 3)
+
+        usis = list(download_raw.iter_dataset_usis("MSV000086206", cache_url=fake_server.url))
+        assert(len(usis) == 27)
+        assert("mzspec:MSV000086206:raw/Jugione_A.d" in usis)
+        assert("mzspec:MSV000086206:raw/run.wiff" in usis)
+        assert("mzspec:MSV000086206:raw/run.wiff.scan" not in usis)
+
+        assert(len(list(download_raw.iter_dataset_usis("MSV000086206", filepath_prefix="raw/", cache_url=fake_server.url))) == 2)
+
+
+def test_host_control():
+    import os
+    import time
+    import argparse
+    import tempfile
+
+    host_controller = host_control.HostController("example.org", max_concurrency=4, failure_threshold=2, cooldown=0.3)
+
+    # Halving on errors, once per decrease interval
+    host_controller.acquire()
+    host_controller.release(failed=True)
+    assert(host_controller.concurrency_limit == 2)
+    host_controller.acquire()
+    host_controller.release(failed=True)
+    assert(host_controller.concurrency_limit == 2)
+
+    # Two failures in a row open the breaker until the cooldown is over, then a single trial gets through
+    try:
+        host_controller.acquire()
+        assert(False)
+    except host_control.HostUnavailableError:
+        pass
+
+    time.sleep(0.35)
+    assert(host_controller.acquire() is True)
+    try:
+        host_controller.acquire()
+        assert(False)
+    except host_control.HostUnavailableError:
+        pass
+    host_controller.release(latency=0.1, trial=True)
+    assert(host_controller.opened_at is None)
+    assert(host_controller.concurrency_limit == 2.5)
+
+    # A request sent before the breaker opened does not decide for the trial when it finishes
+    host_controller = host_control.HostController("example.org", max_concurrency=4, failure_threshold=1, cooldown=0.1)
+    earlier_trial = host_controller.acquire()
+    host_controller.acquire()
+    host_controller.release(failed=True)
+    time.sleep(0.15)
+    assert(host_controller.acquire() is True)
+    host_controller.release(latency=0.1, trial=earlier_trial)
+    assert(host_controller.opened_at is not None and host_controller._trial_in_flight)
+    host_controller.release(failed=True, trial=True)
+    assert(host_controller.opened_at is not None and not host_controller._trial_in_flight)
+
+    # Files from a host that trips its breaker are parked and retried at the end
+    temp_folder = tempfile.mkdtemp()
+    usi_list = ["mzspec:MSV000086206:ccms_peak/raw/S_N{}.mzML".format(i) for i in range(3)]
+
+    with FakeServer() as dashboard_server, FakeServer() as file_server:
+        for i, usi in enumerate(usi_list):
+            dashboard_server.download_links[usi] = file_server.add_file(usi, "S_N{}.mzML".format(i), b"<mzML>" * 10000)
+        file_server.fail_status["S_N0.mzML"] = 503
+        file_server.fail_status["S_N1.mzML"] = 503
+
+        with redirect_endpoints(dashboard_server.url):
+            original_retries = http_session._session_config["retries"]
+            http_session.configure_session(retries=0)
+            host_control.configure_host_control(failure_threshold=2, cooldown=0.5)
+            try:
+                args = argparse.Namespace(parallel=1, output_folder=os.path.join(temp_folder, "output"), nestfiles="flat", existing_dataset_directory=None,
+                                          cache_directory=None, verify_cache=False, noconversion=False, dryrun=False, bundle_parallel=1)
+
+                results = list(download_workflow.iter_downloads(usi_list, args, None))
+            finally:
+                http_session.configure_session(retries=original_retries)
+                host_control.configure_host_control(failure_threshold=host_control.DEFAULT_FAILURE_THRESHOLD, cooldown=host_control.DEFAULT_BREAKER_COOLDOWN)
+
+    assert([result["usi"] for result in results] == usi_list)
+    assert([result["status"] for result in results] == ["ERROR_DATA_TOO_SMALL", "ERROR_DATA_TOO_SMALL", "DOWNLOADED_INTO_OUTPUT_WITHOUT_CACHE"])
+    assert(len([request for request in file_server.request_log if request[0] == "/files/S_N2.mzML"]) == 1)
+
+
+def test_download_metrics():
+    import os
+    import json
+    import argparse
+    import tempfile
+
+    temp_folder = tempfile.mkdtemp()
+    mzml_usi = "mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML"
+    vendor_usi = "mzspec:MSV000094721:raw/slow.raw"
+
+    with FakeServer() as fake_server:
+        fake_server.add_file(mzml_usi, "S_N3.mzML", b"<mzML>" * 10000)
+        fake_server.add_conversion(vendor_usi, b"<mzML>" * 5000, conversion_time=0.3)
+        fake_server.download_links[vendor_usi] = "{}/files/slow.raw".format(fake_server.url)
+
+        with redirect_endpoints(fake_server.url, dataset_cache=True):
+            original_min_poll_interval = vendor_conversion.MIN_POLL_INTERVAL
+            vendor_conversion.configure_conversion(timeout=5)
+            vendor_conversion.MIN_POLL_INTERVAL = 0.05
+            try:
+                args = argparse.Namespace(output_folder=os.path.join(temp_folder, "output"), nestfiles="flat", existing_dataset_directory=None,
+                                          cache_directory=None, verify_cache=False, noconversion=False, dryrun=False, bundle_parallel=1)
+
+                mzml_result = download_workflow.download_usi(mzml_usi, args, None, queue_seconds=0.5)
+                vendor_result = download_workflow.download_usi(vendor_usi, args, None)
+            finally:
+                vendor_conversion.MIN_POLL_INTERVAL = original_min_poll_interval
+                vendor_conversion.configure_conversion(timeout=vendor_conversion.DEFAULT_CONVERSION_TIMEOUT)
+
+    host = fake_server.url.replace("http://", "")
+
+    assert(mzml_result["status"] == "DOWNLOADED_INTO_OUTPUT_WITHOUT_CACHE")
+    assert(mzml_result["host"] == host)
+    assert(mzml_result["downloaded_bytes"] == 60000)
+    assert(mzml_result["queue_seconds"] == 0.5 and mzml_result["total_seconds"] >= 0.5)
+    assert(mzml_result["resolve_seconds"] > 0 and mzml_result["transfer_seconds"] > 0)
+    assert(mzml_result["conversion_wait_seconds"] == 0)
+
+    assert(vendor_result["status"] == "DOWNLOADED_INTO_OUTPUT_WITHOUT_CACHE")
+    assert(vendor_result["conversion_wait_seconds"] >= 0.2)
+
+    # Totals per host as json lines and as a Prometheus textfile
+    metrics_filename = os.path.join(temp_folder, "metrics.jsonl")
+    metrics_collector = download_metrics.MetricsCollector(metrics_filename)
+    for result in [mzml_result, vendor_result, {"usi": mzml_usi, "status": "EXISTS_IN_OUTPUT"}]:
+        metrics_collector.add(result)
+    metrics_collector.close()
+
+    metrics_lines = [json.loads(line) for line in open(metrics_filename)]
+    assert([metrics_line["type"] for metrics_line in metrics_lines] == ["file", "file", "file", "host", "host"])
+    host_line = [metrics_line for metrics_line in metrics_lines if metrics_line["type"] == "host" and metrics_line["host"] == host][0]
+    assert(host_line["files"] == 2 and host_line["downloaded_bytes"] == 90000)
+
+    prometheus_filename = os.path.join(temp_folder, "metrics.prom")
+    metrics_collector = download_metrics.MetricsCollector(prometheus_filename)
+    metrics_collector.add(mzml_result)
+    metrics_collector.close()
+    assert('downloadpublicdata_downloaded_bytes_total{{host="{}"}} 60000'.format(host) in open(prometheus_filename).read())
+
+
+def test_download_client():
+    import os
+    import asyncio
+    import tempfile
+    import download_client
+
+    temp_folder = tempfile.mkdtemp()
+    usi_list = ["mzspec:MSV000086206:ccms_peak/raw/S_N{}.mzML".format(i) for i in range(4)]
+
+    with FakeServer() as fake_server:
+        for i, usi in enumerate(usi_list):
+            fake_server.add_file(usi, "S_N{}.mzML".format(i), b"<mzML>" * 1000)
+
+        with redirect_endpoints(fake_server.url, dataset_cache=True):
+            try:
+                config = download_client.DownloadConfig(output_folder=os.path.join(temp_folder, "output"), parallel=2,
+                                                        dashboard_url=fake_server.url, datasetcache_url=fake_server.url)
+
+                with download_client.DownloadClient(config) as client:
+                    # Unset options get the defaults of the command line
+                    assert(client.config.resolve_parallel == download_resolver.DEFAULT_RESOLVE_PARALLEL)
+
+                    results = client.download(usi_list[:2] + [usi_list[0]])
+                    result = client.download_usi(usi_list[0])
+
+                async def _download_async():
+                    async with download_client.AsyncDownloadClient(config) as async_client:
+                        streamed_results = [streamed_result async for streamed_result in async_client.iter_download(usi_list[2:])]
+                        return streamed_results, await async_client.download(usi_list[2:])
+
+                async_results, repeated_results = asyncio.run(_download_async())
+            finally:
+                vendor_conversion.configure_conversion(timeout=vendor_conversion.DEFAULT_CONVERSION_TIMEOUT)
+                http_session.configure_session(pool_size=http_session.DEFAULT_POOL_SIZE)
+
+    assert([result.usi for result in results] == usi_list[:2])
+    assert(all(result.ok and result.status == "DOWNLOADED_INTO_OUTPUT_WITHOUT_CACHE" for result in results))
+    assert(results[0].downloaded_bytes == 6000 and os.path.isfile(results[0].target_path))
+
+    assert(result.status == "EXISTS_IN_OUTPUT")
+
+    assert([result.usi for result in async_results] == usi_list[2:])
+    assert(all(result.ok for result in async_results))
+    assert(all(result.status == "EXISTS_IN_OUTPUT" for result in repeated_results))
+
+    # Every column of the summary is a field of the result
+    result_fields = [field.name for field in download_client.fields(download_client.DownloadResult)]
+    assert(result_fields == usi_input.SUMMARY_COLUMNS)
+
+
+def test_download_daemon():
+    import os
+    import tempfile
+    import threading
+    import download_client
+    import download_daemon
+
+    temp_folder = tempfile.mkdtemp()
+    socket_path = os.path.join(temp_folder, "daemon.sock")
+    output_folders = {"first": os.path.join(temp_folder, "first"), "second": os.path.join(temp_folder, "second")}
+    usi_list = ["mzspec:MSV000086206:ccms_peak/raw/S_N{}.mzML".format(i) for i in range(3)]
+
+    # Slow enough that the two jobs overlap
+    with FakeServer(latency=0.2) as fake_server:
+        for i, usi in enumerate(usi_list):
+            fake_server.add_file(usi, "S_N{}.mzML".format(i), b"<mzML>" * 1000)
+
+        with redirect_endpoints(fake_server.url, dataset_cache=True):
+            try:
+                os.makedirs(os.path.join(temp_folder, "cache"))
+                config = download_client.DownloadConfig(parallel=2, host_parallel="MassIVE=1", cache_directory=os.path.join(temp_folder, "cache"),
+                                                        dashboard_url=fake_server.url, datasetcache_url=fake_server.url)
+                daemon = download_daemon.DownloadDaemon(config)
+
+                # The --host_parallel limits hold across the jobs
+                active_downloads = []
+                max_active_downloads = [0]
+                original_download_usi = daemon._workflow.download_usi
+                def _counting_download_usi(*args, **kwargs):
+                    active_downloads.append(1)
+                    max_active_downloads[0] = max(max_active_downloads[0], len(active_downloads))
+                    try:
+                        return original_download_usi(*args, **kwargs)
+                    finally:
+                        active_downloads.pop()
+
+                daemon._workflow.download_usi = _counting_download_usi
+                server = download_daemon.make_server(socket_path, daemon)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+
+                job_results = {}
+                def _submit(job_name, usis):
+                    job_results[job_name] = list(download_daemon.submit_job(socket_path, usis, output_folders[job_name], nestfiles="flat"))
+
+                job_threads = [threading.Thread(target=_submit, args=("first", usi_list)), threading.Thread(target=_submit, args=("second", usi_list[::-1]))]
+                for job_thread in job_threads:
+                    job_thread.start()
+                for job_thread in job_threads:
+                    job_thread.join()
+
+                daemon._workflow.download_usi = original_download_usi
+                assert(max_active_downloads[0] == 1)
+                shared_request_log = list(fake_server.request_log)
+
+                # A job the daemon cannot run gets an error back instead of results
+                import json
+                import socket
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                    connection.connect(socket_path)
+                    connection.sendall(b'{"usis": []}\n')
+                    error_message = json.loads(connection.makefile("r").readline())
+                assert("output_folder" in error_message["error"])
+
+                # A USI that fails outside of download_helper gets an error result, the rest of the job goes on
+                def _failing_download_usi(usi, *args, **kwargs):
+                    if usi == usi_list[1]:
+                        raise RuntimeError("Unexpected failure")
+                    return original_download_usi(usi, *args, **kwargs)
+
+                daemon._workflow.download_usi = _failing_download_usi
+                try:
+                    failing_results = list(download_daemon.submit_job(socket_path, usi_list, os.path.join(temp_folder, "failing"), nestfiles="flat"))
+                finally:
+                    daemon._workflow.download_usi = original_download_usi
+                assert([result["status"] == "ERROR" for result in failing_results] == [False, True, False])
+
+                # A failure of the job as a whole still sends a result for every USI
+                original_prepare_batch = daemon._workflow.prepare_batch
+                def _failing_prepare_batch(usis, args):
+                    raise RuntimeError("Unexpected failure")
+
+                daemon._workflow.prepare_batch = _failing_prepare_batch
+                try:
+                    failed_job_results = list(download_daemon.submit_job(socket_path, usi_list, os.path.join(temp_folder, "failed_job"), nestfiles="flat"))
+                finally:
+                    daemon._workflow.prepare_batch = original_prepare_batch
+                assert(failed_job_results == [{"usi": usi, "status": "ERROR"} for usi in usi_list])
+            finally:
+                server.shutdown()
+                server.server_close()
+                daemon.close()
+
+            # Without a cache, the jobs that shared a download get a link to the downloaded file
+            fake_server.request_log.clear()
+            uncached_folders = {"first": os.path.join(temp_folder, "uncached_first"), "second": os.path.join(temp_folder, "uncached_second")}
+            try:
+                uncached_daemon = download_daemon.DownloadDaemon(download_client.DownloadConfig(parallel=2, dashboard_url=fake_server.url, datasetcache_url=fake_server.url))
+
+                uncached_results = {}
+                def _run_job(job_name):
+                    uncached_results[job_name] = list(uncached_daemon.run_job({"usis": usi_list[:1], "output_folder": uncached_folders[job_name]}))
+
+                job_threads = [threading.Thread(target=_run_job, args=(job_name,)) for job_name in uncached_folders]
+                for job_thread in job_threads:
+                    job_thread.start()
+                for job_thread in job_threads:
+                    job_thread.join()
+            finally:
+                uncached_daemon.close()
+
+            assert(len([request for request in fake_server.request_log if request[0] == "/files/S_N0.mzML"]) == 1)
+            for job_name, results in uncached_results.items():
+                assert(os.path.dirname(results[0]["target_path"]) == uncached_folders[job_name])
+                assert(os.path.isfile(results[0]["target_path"]))
+                vendor_conversion.configure_conversion(timeout=vendor_conversion.DEFAULT_CONVERSION_TIMEOUT)
+                http_session.configure_session(pool_size=http_session.DEFAULT_POOL_SIZE)
+
+    # Each job gets its results in its own order and its files in its own output folder, but every file is only downloaded once
+    assert([result["usi"] for result in job_results["first"]] == usi_list)
+    assert([result["usi"] for result in job_results["second"]] == usi_list[::-1])
+    for job_name, results in job_results.items():
+        assert(all(os.path.dirname(result["target_path"]) == output_folders[job_name] for result in results))
+        assert(all(os.path.isfile(result["target_path"]) for result in results))
+    for i, usi in enumerate(usi_list):
+        assert(len([request for request in shared_request_log if request[0] == "/files/S_N{}.mzML".format(i)]) == 1)
+
+        # The job that did not download a file got it from the cache, so its link is recorded like any cache hit
+        statuses = [result["status"] for results in job_results.values() for result in results if result["usi"] == usi]
+        assert(sorted(statuses) == ["DOWNLOADED_INTO_OUTPUT_WITH_CACHE", "EXISTS_IN_CACHE"])
+
+
+def test_link_modes():
+    import os
+    import argparse
+    import tempfile
+    import file_linking
+
+    temp_folder = tempfile.mkdtemp()
+    source_filename = os.path.join(temp_folder, "source.mzML")
+    with open(source_filename, "wb") as f:
+        f.write(b"<mzML>" * 1000)
+
+    bruker_folder = os.path.join(temp_folder, "sample.d")
+    os.makedirs(os.path.join(bruker_folder, "pdata"))
+    for filename in ["analysis.tdf", "pdata/proc"]:
+        with open(os.path.join(bruker_folder, filename), "w") as f:
+            f.write(filename)
+
+    # reflink falls back to a hardlink on filesystems without reflinks, and the temporary files never stay behind
+    methods = {}
+    for link_mode in file_linking.LINK_MODES:
+        target_filename = os.path.join(temp_folder, "{}.mzML".format(link_mode))
+        methods[link_mode] = file_linking.link_file(source_filename, target_filename, mode=link_mode)
+        assert(open(target_filename, "rb").read() == open(source_filename, "rb").read())
+
+    assert(methods["symlink"] == "symlink" and os.path.islink(os.path.join(temp_folder, "symlink.mzML")))
+    assert(os.path.samefile(os.path.join(temp_folder, "hardlink.mzML"), source_filename))
+    assert(not os.path.samefile(os.path.join(temp_folder, "copy.mzML"), source_filename))
+    assert(methods["reflink"] in ["reflink", "hardlink"])
+    assert(not any(filename.endswith(".linking") for filename in os.listdir(temp_folder)))
+
+    # Across devices a hardlink becomes a copy
+    original_link = os.link
+    def _cross_device_link(source, target):
+        raise OSError(18, "Invalid cross-device link")
+
+    os.link = _cross_device_link
+    try:
+        assert(file_linking.link_file(source_filename, os.path.join(temp_folder, "cross_device.mzML"), mode="hardlink") == "copy")
+    finally:
+        os.link = original_link
+
+    # Vendor folders are placed as a whole
+    assert(file_linking.link_file(bruker_folder, os.path.join(temp_folder, "copied.d"), mode="copy") == "copy")
+    assert(open(os.path.join(temp_folder, "copied.d", "pdata", "proc")).read() == "pdata/proc")
+
+    # Files placed from the cache with a copy are real files and do not pin the cache entry
+    cache_directory = os.path.join(temp_folder, "cache")
+    os.makedirs(cache_directory)
+    usi = "mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML"
+
+    with FakeServer() as fake_server:
+        fake_server.add_file(usi, "S_N3.mzML", b"<mzML>" * 1000)
+
+        with redirect_endpoints(fake_server.url):
+            file_linking.configure_linking(mode="copy")
+            try:
+                args = argparse.Namespace(output_folder=os.path.join(temp_folder, "output"), nestfiles="flat", existing_dataset_directory=None, cache_directory=cache_directory, verify_cache=False)
+                result = download_workflow.download_helper(usi, args)
+
+                cache_filename, _ = download_workflow._determine_caching_paths(usi, cache_directory, "S_N3.mzML")
+                pinned = cache_manager.get_cache_index(cache_directory)._is_pinned(cache_filename)
+            finally:
+                file_linking.configure_linking(mode=file_linking.DEFAULT_LINK_MODE)
+                cache_manager.close_cache_indexes()
+
+    assert(result["status"] == "DOWNLOADED_INTO_OUTPUT_WITH_CACHE")
+    assert(os.path.isfile(result["target_path"]) and not os.path.islink(result["target_path"]))
+    assert(os.path.isfile(cache_filename) and not pinned)
+
+
+def test_download_admission():
+    import os
+    import time
+    import argparse
+    import tempfile
+    import threading
+    import download_admission
+
+    temp_folder = tempfile.mkdtemp()
+    usi = "mzspec:MSV000086206:ccms_peak/raw/S_N3.mzML"
+
+    # Two downloads share the bandwidth budget, the first second worth goes right away
+    with FakeServer() as fake_server:
+        for name in ["a.mzML", "b.mzML"]:
+            fake_server.files[name] = b"<mzML>" * 50000
+
+        download_admission.configure_admission(bandwidth_limit=200000)
+        try:
+            start_time = time.monotonic()
+            download_threads = [threading.Thread(target=download_stream.download_url_to_file, args=("{}/files/{}".format(fake_server.url, name), os.path.join(temp_folder, name)))
+                                for name in ["a.mzML", "b.mzML"]]
+            for download_thread in download_threads:
+                download_thread.start()
+            for download_thread in download_threads:
+                download_thread.join()
+            elapsed = time.monotonic() - start_time
+        finally:
+            download_admission.configure_admission(bandwidth_limit=download_admission.DEFAULT_BANDWIDTH_LIMIT)
+
+    assert(os.path.getsize(os.path.join(temp_folder, "b.mzML")) == 300000)
+    assert(elapsed >= 0.4)
+
+    # Pretending the disk only has 10MB left
+    stat = os.statvfs(temp_folder)
+    download_admission.configure_admission(min_free_space=stat.f_bavail * stat.f_frsize - 10 * 1024 * 1024)
+    try:
+        first_reservation = download_admission.try_reserve(os.path.join(temp_folder, "first"), 8 * 1024 * 1024)
+        assert(first_reservation is not None)
+        assert(download_admission.try_reserve(os.path.join(temp_folder, "second"), 8 * 1024 * 1024) is None)
+
+        # The second one is deferred until the first is written
+        second_reservations = []
+        waiting_thread = threading.Thread(target=lambda: second_reservations.append(download_admission.reserve(os.path.join(temp_folder, "second"), 8 * 1024 * 1024)))
+        waiting_thread.start()
+        time.sleep(0.2)
+        assert(len(second_reservations) == 0)
+
+        first_reservation.consume(1024 * 1024)
+        first_reservation.release()
+        waiting_thread.join(timeout=5)
+        assert(len(second_reservations) == 1)
+        second_reservations[0].release()
+
+        # With nothing in flight that could free up space, a file that is too large fails right away
+        try:
+            download_admission.reserve(os.path.join(temp_folder, "huge"), 100 * 1024 * 1024)
+            assert(False)
+        except download_admission.DiskSpaceError:
+            pass
+
+        with FakeServer() as fake_server:
+            fake_server.add_file(usi, "S_N3.mzML", b"<mzML>" * 3 * 1024 * 1024)
+
+            with redirect_endpoints(fake_server.url):
+                args = argparse.Namespace(output_folder=os.path.join(temp_folder, "output"), nestfiles="flat", existing_dataset_directory=None, cache_directory=None, verify_cache=False)
+                result = download_workflow.download_helper(usi, args)
+    finally:
+        download_admission.configure_admission(min_free_space=download_admission.DEFAULT_MIN_FREE_SPACE)
+
+    assert(result["status"] == "ERROR_DISK_SPACE")
+    assert(not os.path.exists(result["target_path"]))
+
+
+def test_segmented_download():
+    import os
+    import hashlib
+    import tempfile
+    import file_validation
+    import download_admission
+
+    temp_folder = tempfile.mkdtemp()
+    content = b'<?xml version="1.0"?>\n<mzML>' + os.urandom(1024 * 1024)
+    changed_content = b'<?xml version="1.0"?>\n<mzML>' + os.urandom(1024 * 1024)
+
+    def _file_requests(name):
+        return len([request for request in fake_server.request_log if request[0] == "/files/" + name])
+
+    with FakeServer() as fake_server:
+        for name in ["segmented.mzML", "single.mzML", "resumed.mzML"]:
+            fake_server.files[name] = content
+        fake_server.no_ranges.add("single.mzML")
+
+        http_session.configure_session(retries=0)
+        download_stream.configure_stream(chunk_size=64 * 1024, segments=4, segment_threshold=512 * 1024)
+        try:
+            # Four ranges written in place, without reading the file back for a checksum
+            hasher = file_validation.new_hasher()
+            partial_filename = os.path.join(temp_folder, "segmented.mzML.part")
+            assert(download_stream.download_url_resumable(fake_server.url + "/files/segmented.mzML", partial_filename, hasher=hasher) == len(content))
+            assert(open(partial_filename, "rb").read() == content)
+            assert(hasher.hexdigest() is None)
+            assert(_file_requests("segmented.mzML") == 4)
+
+            # The progress of the segments is saved while they are fetched, not only once they stop
+            progress = []
+            original_write_partial_metadata = download_stream._write_partial_metadata
+            def _recording_write_partial_metadata(partial_filename, metadata):
+                progress.append(sum(segment[2] for segment in metadata["segments"]))
+                original_write_partial_metadata(partial_filename, metadata)
+
+            download_stream._write_partial_metadata = _recording_write_partial_metadata
+            original_progress_interval = download_stream.SEGMENT_PROGRESS_INTERVAL
+            download_stream.SEGMENT_PROGRESS_INTERVAL = 0.02
+            fake_server.bandwidth = 2 * 1024 * 1024
+            try:
+                download_stream.remove_partial(partial_filename)
+                assert(download_stream.download_url_resumable(fake_server.url + "/files/segmented.mzML", partial_filename) == len(content))
+            finally:
+                fake_server.bandwidth = None
+                download_stream.SEGMENT_PROGRESS_INTERVAL = original_progress_interval
+                download_stream._write_partial_metadata = original_write_partial_metadata
+            assert(any(0 < written < len(content) for written in progress))
+
+            # Servers without byte ranges get a single stream
+            target_filename = os.path.join(temp_folder, "single.mzML")
+            assert(download_stream.download_url_to_file(fake_server.url + "/files/single.mzML", target_filename) == len(content))
+            assert(open(target_filename, "rb").read() == content)
+            assert(_file_requests("single.mzML") == 1)
+
+            # An interrupted segmented download carries on where each segment stopped, here in a file that could not be preallocated
+            fake_server.interrupt_after["resumed.mzML"] = 100000
+            partial_filename = os.path.join(temp_folder, "resumed.mzML.part")
+            original_preallocate = download_stream._preallocate
+            download_stream._preallocate = lambda fd, size: False
+            try:
+                download_stream.download_url_resumable(fake_server.url + "/files/resumed.mzML", partial_filename)
+                assert(False)
+            except Exception:
+                pass
+            finally:
+                download_stream._preallocate = original_preallocate
+
+            segments = download_stream._read_partial_metadata(partial_filename)["segments"]
+            assert(len(segments) == 4 and 0 < sum(segment[2] for segment in segments) < len(content))
+
+            # Resuming reserves the space of the missing ranges like a new download
+            download_admission.configure_admission(min_free_space=1 << 60)
+            try:
+                download_stream.download_url_resumable(fake_server.url + "/files/resumed.mzML", partial_filename)
+                assert(False)
+            except download_admission.DiskSpaceError:
+                pass
+            finally:
+                download_admission.configure_admission(min_free_space=download_admission.DEFAULT_MIN_FREE_SPACE)
+
+            # With hash_segments, the checksum is read back from the finished file
+            download_stream.configure_stream(hash_segments=True)
+            hasher = file_validation.new_hasher()
+            assert(download_stream.download_url_resumable(fake_server.url + "/files/resumed.mzML", partial_filename, hasher=hasher) == len(content))
+            assert(open(partial_filename, "rb").read() == content)
+            assert(hasher.hexdigest() == hashlib.sha256(content).hexdigest())
+
+            # If the file changed in between, the ranges do not apply and it starts over
+            fake_server.interrupt_after["resumed.mzML"] = 100000
+            download_stream.remove_partial(partial_filename)
+            try:
+                download_stream.download_url_resumable(fake_server.url + "/files/resumed.mzML", partial_filename)
+                assert(False)
+            except Exception:
+                pass
+
+            fake_server.files["resumed.mzML"] = changed_content
+            assert(download_stream.download_url_resumable(fake_server.url + "/files/resumed.mzML", partial_filename) == len(changed_content))
+            assert(open(partial_filename, "rb").read() == changed_content)
+        finally:
+            download_stream.configure_stream(chunk_size=download_stream.DEFAULT_CHUNK_SIZE, segments=download_stream.DEFAULT_SEGMENTS,
+                                             segment_threshold=download_stream.DEFAULT_SEGMENT_THRESHOLD, hash_segments=False)
+            http_session.configure_session(retries=http_session.DEFAULT_RETRIES)
+
+
 def main():
     test()
+    test_parallel_ordering()
+    test_http_session()
+    test_resolution_cache()
+    test_bulk_resolution()
+    test_stream_download()
+    test_download_raw_streamed()
+    test_download_raw_bundle()
+    test_resume_download()
+    test_pipelined_conversion()
+    test_job_ledger()
+    test_cache_eviction()
+    test_shared_cache_single_download()
+    test_integrity_verification()
+    test_dataset_index()
+    test_streaming_input()
+    test_download_plan()
+    test_dataset_listing()
+    test_host_control()
+    test_download_metrics()
+    test_download_client()
+    test_download_daemon()
+    test_link_modes()
+    test_download_admission()
+    test_segmented_download()
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()